@@ -0,0 +1,532 @@
+#!/usr/bin/env python3
+"""
+Persistent, memory-mapped approximate nearest neighbour index for visitor
+embeddings (IVF-flat: spherical k-means lists, cosine similarity).
+
+On disk (`ann_index_dir`, default index/visitors):
+    CURRENT             name of the live segment, e.g. "v000003"
+    v000003/
+      meta.json         dim, nlist, count, build watermark (max inserted_at)
+      centroids.npy     (nlist, dim) float32
+      offsets.npy       (nlist + 1,) int64, list l is rows offsets[l]:offsets[l+1]
+      vectors.npy       (count, dim) float32, rows grouped by list   (mmap)
+      ids.npy           (count, 16) uint8, visitor UUID bytes          (mmap)
+      ids_sorted.npy    ids.npy sorted, for "already indexed?" lookups (mmap)
+      delta.bin         append-only records of visitors added since the build
+
+Opening the index only maps the files, so startup does not depend on the
+gallery size. Registrations are appended to delta.bin and searched by brute
+force until the next `compact`, which folds them (plus anything other
+processes registered) into the IVF lists.
+
+A build writes a new segment directory and then repoints CURRENT; mapped
+segments are never renamed (Windows refuses that while other processes map
+them). Running processes notice the new CURRENT on their next sync and
+reopen, carrying over delta visitors the new segment doesn't have yet.
+Segments older than the previous one are removed.
+
+Maintenance:
+    python ann_index.py build      # (re)build from the Visitors table
+    python ann_index.py compact    # merge delta + new DB rows, re-cluster
+    python ann_index.py eval       # recall and latency against exact search
+    python ann_index.py info
+"""
+
+import argparse
+import datetime
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+import numpy as np
+import database
+
+CURRENT = 'CURRENT'
+_SEGMENT = re.compile(r'^v(\d{6})$')
+
+
+def current_segment(index_dir):
+    """Directory of the live segment, or None if no index was built yet."""
+    try:
+        with open(os.path.join(index_dir, CURRENT)) as f:
+            return os.path.join(index_dir, f.read().strip())
+    except FileNotFoundError:
+        pass
+    if os.path.exists(os.path.join(index_dir, 'meta.json')):
+        return index_dir  # Unversioned layout from before segments
+    return None
+
+
+def _generation(segment_dir):
+    match = _SEGMENT.match(os.path.basename(segment_dir or ''))
+    return int(match.group(1)) if match else 0
+
+
+def _point_to(index_dir, name, attempts=50):
+    """Atomically repoints CURRENT (retrying while a reader has it open on Windows)."""
+    tmp_path = os.path.join(index_dir, CURRENT + '.tmp')
+    with open(tmp_path, 'w') as f:
+        f.write(name)
+    for attempt in range(attempts):
+        try:
+            os.replace(tmp_path, os.path.join(index_dir, CURRENT))
+            return
+        except PermissionError:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(0.1)
+
+
+def _remove_old_segments(index_dir, keep):
+    """Deletes segments not in `keep`; ones still mapped somewhere are left for a later build."""
+    for name in os.listdir(index_dir):
+        if _SEGMENT.match(name) and name not in keep:
+            shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
+
+
+def _assign(data, centroids, chunk=65536):
+    """Index of the most similar centroid for every row of data."""
+    out = np.empty(len(data), dtype=np.int32)
+    for start in range(0, len(data), chunk):
+        out[start:start + chunk] = np.argmax(data[start:start + chunk] @ centroids.T, axis=1)
+    return out
+
+
+def spherical_kmeans(data, nlist, iterations=10, seed=0):
+    """Cosine k-means. `data` must be L2-normalized."""
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = _assign(data, centroids)
+        counts = np.bincount(assign, minlength=nlist)
+        order = np.argsort(assign, kind='stable')
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        nonempty = counts > 0
+
+        sums = np.zeros_like(centroids)
+        sums[nonempty] = np.add.reduceat(data[order], starts[nonempty], axis=0)
+        # Re-seed empty lists from random points
+        if not nonempty.all():
+            sums[~nonempty] = data[rng.choice(len(data), int((~nonempty).sum()))]
+        centroids = _normalize_rows(sums)
+    return centroids
+
+
+class IVFIndex:
+    """
+    Same search interface as gallery.VisitorGallery (search / match / add /
+    sync / len), so VisitorTracker can use either one.
+    """
+    def __init__(self, index_dir, nprobe=16):
+        self.index_dir = index_dir
+        self.nprobe = nprobe
+        segment_dir = current_segment(index_dir)
+        if segment_dir is None:
+            raise FileNotFoundError(f"No ANN index in {index_dir}")
+        self._open_segment(segment_dir)
+
+    def _open_segment(self, segment_dir):
+        self.segment_dir = segment_dir
+        with open(os.path.join(segment_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.dim = self.meta['dim']
+        # delta.bin record: visitor UUID, first_seen (unix time), embedding
+        self._record = np.dtype([('id', 'S16'), ('ts', '<f8'), ('vec', '<f4', (self.dim,))])
+
+        self.centroids = np.load(os.path.join(segment_dir, 'centroids.npy'))
+        self.offsets = np.load(os.path.join(segment_dir, 'offsets.npy'))
+        count = self.meta['count']
+        if count > 0:
+            self.vectors = np.load(os.path.join(segment_dir, 'vectors.npy'), mmap_mode='r')
+            self.ids = np.load(os.path.join(segment_dir, 'ids.npy'), mmap_mode='r')
+            sorted_path = os.path.join(segment_dir, 'ids_sorted.npy')
+            if os.path.exists(sorted_path):
+                sorted_ids = np.load(sorted_path, mmap_mode='r')
+            else:
+                sorted_ids = np.sort(np.ascontiguousarray(self.ids).view('V16').reshape(-1)).view(np.uint8)
+            # One 16-byte opaque value per visitor, compared like bytes
+            self._sorted_ids = sorted_ids.view('V16').reshape(-1)
+        else:
+            self.vectors = np.zeros((0, self.dim), dtype=np.float32)
+            self.ids = np.zeros((0, 16), dtype=np.uint8)
+            self._sorted_ids = np.zeros(0, dtype='V16')
+
+        watermark = self.meta.get('watermark')
+        self.build_watermark = datetime.datetime.fromisoformat(watermark) if watermark else None
+        self.last_seen_watermark = self.build_watermark
+
+        # Delta segment: visitors added since the build, searched exhaustively
+        self._delta = np.zeros((256, self.dim), dtype=np.float32)
+        self._delta_ids = []
+        self._delta_first_seen = []
+        self._delta_known = set()
+        self._delta_path = os.path.join(segment_dir, 'delta.bin')
+        self._load_delta()
+
+    # --- Construction -----------------------------------------------------
+
+    @staticmethod
+    def default_nlist(count):
+        return int(min(max(1, 4 * np.sqrt(count)), max(1, count)))
+
+    @classmethod
+    def build(cls, index_dir, visitor_ids, embeddings, watermark=None, nlist=None, sample_size=262144):
+        """
+        Writes a fresh index for (visitor_ids, embeddings) and returns it.
+        The files go into a new segment directory and CURRENT is repointed
+        at the end, so a crash mid-build leaves the old index untouched.
+        """
+        count = len(visitor_ids)
+        if count:
+            embeddings = _normalize_rows(np.array(embeddings, dtype=np.float32).reshape(count, -1))
+        else:
+            embeddings = np.zeros((0, 512), dtype=np.float32)
+        dim = embeddings.shape[1]
+        nlist = nlist or cls.default_nlist(count)
+
+        if count > 0:
+            rng = np.random.default_rng(0)
+            sample = embeddings if count <= sample_size else embeddings[rng.choice(count, sample_size, replace=False)]
+            centroids = spherical_kmeans(sample, min(nlist, len(sample)))
+            assign = _assign(embeddings, centroids)
+            order = np.argsort(assign, kind='stable')
+            counts = np.bincount(assign, minlength=len(centroids))
+        else:
+            centroids = np.zeros((0, dim), dtype=np.float32)
+            order = np.zeros(0, dtype=np.int64)
+            counts = np.zeros(0, dtype=np.int64)
+
+        offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        id_bytes = np.frombuffer(b''.join(v.bytes for v in visitor_ids), dtype=np.uint8).reshape(-1, 16)
+
+        os.makedirs(index_dir, exist_ok=True)
+        previous = current_segment(index_dir)
+        name = f"v{_generation(previous) + 1:06d}"
+        segment_dir = os.path.join(index_dir, name)
+        shutil.rmtree(segment_dir, ignore_errors=True)  # left over from a crashed build
+        os.makedirs(segment_dir)
+        np.save(os.path.join(segment_dir, 'centroids.npy'), centroids)
+        np.save(os.path.join(segment_dir, 'offsets.npy'), offsets)
+        np.save(os.path.join(segment_dir, 'vectors.npy'), embeddings[order])
+        np.save(os.path.join(segment_dir, 'ids.npy'), id_bytes[order])
+        np.save(os.path.join(segment_dir, 'ids_sorted.npy'),
+                np.sort(np.ascontiguousarray(id_bytes).view('V16').reshape(-1)).view(np.uint8).reshape(-1, 16))
+        with open(os.path.join(segment_dir, 'meta.json'), 'w') as f:
+            json.dump({
+                'dim': dim,
+                'nlist': len(centroids),
+                'count': count,
+                'watermark': watermark.isoformat() if watermark else None,
+                'built_at': datetime.datetime.now().isoformat(),
+            }, f, indent=2)
+
+        _point_to(index_dir, name)
+        # Processes that haven't reopened yet may still map (and append to) the previous segment
+        _remove_old_segments(index_dir, keep={name, os.path.basename(previous or '')})
+        return cls(index_dir)
+
+    @classmethod
+    def build_from_db(cls, conn, index_dir, nlist=None):
+        ids, embeddings, newest = database.load_embedding_matrix(conn)
+        return cls.build(index_dir, ids, embeddings, watermark=newest, nlist=nlist)
+
+    @classmethod
+    def open_or_build(cls, conn, index_dir, nprobe=16):
+        """Opens the index, building it from the DB first if it doesn't exist yet."""
+        started = time.time()
+        if current_segment(index_dir) is None:
+            print(f"ANN index not found in {index_dir}, building from the Visitors table...")
+            cls.build_from_db(conn, index_dir)
+        index = cls(index_dir, nprobe=nprobe)
+        added = index.sync(conn)
+        print(f"ANN index opened: {len(index)} visitors ({added} since last build) in {time.time() - started:.2f}s")
+        return index
+
+    # --- Delta segment ----------------------------------------------------
+
+    def _load_delta(self):
+        if not os.path.exists(self._delta_path):
+            return
+        with open(self._delta_path, 'rb') as f:
+            data = f.read()
+        # Ignore a torn last record (crash mid-append)
+        usable = len(data) - len(data) % self._record.itemsize
+        for rec in np.frombuffer(data[:usable], dtype=self._record):
+            self._append_delta(uuid.UUID(bytes=rec['id'].tobytes()), rec['vec'],
+                               datetime.datetime.fromtimestamp(float(rec['ts']), datetime.timezone.utc))
+
+    def _indexed(self, visitor_id):
+        """True if the visitor is in the IVF lists of this segment."""
+        if not len(self._sorted_ids):
+            return False
+        key = np.frombuffer(visitor_id.bytes, dtype='V16')
+        i = int(np.searchsorted(self._sorted_ids, key)[0])
+        return i < len(self._sorted_ids) and self._sorted_ids[i] == key[0]
+
+    def _append_delta(self, visitor_id, embedding, first_seen=None):
+        if visitor_id in self._delta_known or self._indexed(visitor_id):
+            return False
+        n = len(self._delta_ids)
+        if n == self._delta.shape[0]:
+            grown = np.zeros((n * 2, self.dim), dtype=np.float32)
+            grown[:n] = self._delta
+            self._delta = grown
+        vec = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(vec)
+        self._delta[n] = vec / norm if norm > 0 else vec
+        self._delta_ids.append(visitor_id)
+        self._delta_first_seen.append(first_seen)
+        self._delta_known.add(visitor_id)
+        return True
+
+    def add(self, visitor_id, embedding, first_seen=None):
+        """Adds a newly registered visitor and appends it to delta.bin."""
+        first_seen = first_seen or datetime.datetime.now(datetime.timezone.utc)
+        if not self._append_delta(visitor_id, embedding, first_seen):
+            return
+        record = np.zeros(1, dtype=self._record)
+        record['id'] = visitor_id.bytes
+        record['ts'] = first_seen.timestamp()
+        record['vec'] = self._delta[len(self._delta_ids) - 1]
+        # One write() per record on an O_APPEND file, so workers sharing
+        # the index directory don't interleave partial records.
+        fd = os.open(self._delta_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+        try:
+            os.write(fd, record.tobytes())
+        finally:
+            os.close(fd)
+
+    def sync(self, conn):
+        """
+        Pulls visitors registered since the build (or the last sync) into the
+        in-memory delta. They are persisted by whoever registered them, or
+        folded in by the next compact. Returns the number added.
+        """
+        return self.merge_rows(database.fetch_visitor_embeddings(conn, since=self.sync_cutoff()))
+
+    def sync_cutoff(self):
+        """inserted_at from which the next sync should read (None = everything)."""
+        if self.last_seen_watermark is None:
+            return None
+        return self.last_seen_watermark - datetime.timedelta(seconds=60)
+
+    def merge_rows(self, rows):
+        """
+        Adds [(visitor_id, embedding, inserted_at), ...] rows to the delta.
+        Reopens the index first if another process rebuilt it, so that both
+        sync() and rows fetched on the async pool land in the current
+        segment. Returns the number added.
+        """
+        self.reopen_if_rebuilt()
+        # Whether a row is already indexed is decided by visitor_id, not by
+        # its stamp. Only rows read from the DB move the sync watermark: a
+        # local add() is stamped before write-behind commits it.
+        added = 0
+        for visitor_id, embedding, inserted_at in rows:
+            added += self._append_delta(visitor_id, embedding, inserted_at)
+            if inserted_at is not None and (self.last_seen_watermark is None
+                                            or inserted_at > self.last_seen_watermark):
+                self.last_seen_watermark = inserted_at
+        return added
+
+    def reopen_if_rebuilt(self):
+        """
+        Switches to the segment CURRENT points at if it changed, keeping the
+        delta visitors the new segment doesn't have. Returns True if reopened.
+        """
+        segment_dir = current_segment(self.index_dir)
+        if segment_dir is None or os.path.normpath(segment_dir) == os.path.normpath(self.segment_dir):
+            return False
+        self._load_delta()  # records other processes appended to the old segment
+        carried = [(visitor_id, self._delta[i].copy(), self._delta_first_seen[i])
+                   for i, visitor_id in enumerate(self._delta_ids)]
+        watermark = self.last_seen_watermark
+        self._open_segment(segment_dir)
+        if watermark is not None and (self.last_seen_watermark is None or watermark > self.last_seen_watermark):
+            self.last_seen_watermark = watermark
+        for visitor_id, embedding, first_seen in carried:
+            self.add(visitor_id, embedding, first_seen)
+        return True
+
+    # --- Search -----------------------------------------------------------
+
+    def __len__(self):
+        return self.meta['count'] + len(self._delta_ids)
+
+    def search(self, embedding, k=1, nprobe=None):
+        """Returns up to k (visitor_id, similarity) pairs, best first."""
+        q = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(q)
+        if norm > 0:
+            q = q / norm
+
+        sims_parts, pos_parts = [], []
+        nlist = len(self.centroids)
+        if nlist > 0:
+            nprobe = min(nprobe or self.nprobe, nlist)
+            centroid_sims = self.centroids @ q
+            probe = np.argpartition(-centroid_sims, nprobe - 1)[:nprobe] if nprobe < nlist else np.arange(nlist)
+            for l in probe:
+                a, b = self.offsets[l], self.offsets[l + 1]
+                if b > a:
+                    sims_parts.append(self.vectors[a:b] @ q)
+                    pos_parts.append(np.arange(a, b))
+
+        n_delta = len(self._delta_ids)
+        if n_delta:
+            sims_parts.append(self._delta[:n_delta] @ q)
+            # Negative positions address the delta segment: -1 - i
+            pos_parts.append(-1 - np.arange(n_delta))
+
+        if not sims_parts:
+            return []
+        sims = np.concatenate(sims_parts)
+        positions = np.concatenate(pos_parts)
+        k = min(k, len(sims))
+        top = np.argpartition(-sims, k - 1)[:k]
+        top = top[np.argsort(-sims[top])]
+        return [(self._visitor_id(positions[i]), float(sims[i])) for i in top]
+
+    def _visitor_id(self, position):
+        if position < 0:
+            return self._delta_ids[-1 - position]
+        return uuid.UUID(bytes=self.ids[position].tobytes())
+
+    def match(self, embedding, threshold):
+        """Same contract as database.find_visitor: (visitor_id, similarity) or (None, 0)."""
+        hits = self.search(embedding, k=1)
+        if hits and hits[0][1] >= threshold:
+            return hits[0]
+        return None, 0
+
+    def exact_search(self, embedding, k=1, chunk=262144):
+        """Brute force over every row (main + delta); used to measure recall."""
+        q = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        q = q / (np.linalg.norm(q) or 1.0)
+        best_sims, best_pos = np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+        for start in range(0, self.meta['count'], chunk):
+            sims = self.vectors[start:start + chunk] @ q
+            best_sims = np.concatenate((best_sims, sims))
+            best_pos = np.concatenate((best_pos, np.arange(start, start + len(sims))))
+            keep = np.argpartition(-best_sims, min(k, len(best_sims)) - 1)[:k]
+            best_sims, best_pos = best_sims[keep], best_pos[keep]
+        n_delta = len(self._delta_ids)
+        if n_delta:
+            best_sims = np.concatenate((best_sims, self._delta[:n_delta] @ q))
+            best_pos = np.concatenate((best_pos, -1 - np.arange(n_delta)))
+        order = np.argsort(-best_sims)[:k]
+        return [(self._visitor_id(best_pos[i]), float(best_sims[i])) for i in order]
+
+    # --- Maintenance ------------------------------------------------------
+
+    def compact(self, conn=None, nlist=None):
+        """
+        Rebuilds the IVF lists from the main segment plus the delta (and any
+        rows registered in the DB since) into a new segment and switches to
+        it. Returns this index, now on the new segment.
+        """
+        if conn is not None:
+            self.sync(conn)
+        n_delta = len(self._delta_ids)
+        ids = [uuid.UUID(bytes=row.tobytes()) for row in self.ids] + self._delta_ids
+        embeddings = np.concatenate((np.asarray(self.vectors), self._delta[:n_delta]))
+        IVFIndex.build(self.index_dir, ids, embeddings, watermark=self.last_seen_watermark,
+                       nlist=nlist or self.default_nlist(len(ids)))
+        # Visitors other processes appended to the old delta during the build
+        # are carried into the new segment's delta.bin
+        self.reopen_if_rebuilt()
+        return self
+
+
+def evaluate(index, queries=1000, k=10, noise=0.05, seed=0):
+    """
+    Measures recall@1 / recall@k and per-query latency of the IVF search
+    against exact search. Queries are stored embeddings with Gaussian noise
+    added, i.e. re-sightings of known visitors.
+    """
+    total = index.meta['count']
+    if total == 0:
+        print("Index is empty, nothing to evaluate.")
+        return None
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(total, min(queries, total), replace=False)
+    qs = np.asarray(index.vectors[np.sort(picks)]) + rng.normal(0, noise, (len(picks), index.dim)).astype(np.float32)
+
+    hits_at_1 = 0
+    overlap = 0
+    ann_times, exact_times = [], []
+    for q in qs:
+        t0 = time.perf_counter()
+        approx = index.search(q, k=k)
+        t1 = time.perf_counter()
+        exact = index.exact_search(q, k=k)
+        t2 = time.perf_counter()
+        ann_times.append(t1 - t0)
+        exact_times.append(t2 - t1)
+        hits_at_1 += approx[0][0] == exact[0][0]
+        overlap += len({v for v, _ in approx} & {v for v, _ in exact})
+
+    ann_ms = np.array(ann_times) * 1000
+    exact_ms = np.array(exact_times) * 1000
+    report = {
+        'visitors': len(index),
+        'nlist': len(index.centroids),
+        'nprobe': index.nprobe,
+        'queries': len(qs),
+        'recall@1': hits_at_1 / len(qs),
+        f'recall@{k}': overlap / (len(qs) * k),
+        'ann_ms_p50': float(np.percentile(ann_ms, 50)),
+        'ann_ms_p95': float(np.percentile(ann_ms, 95)),
+        'exact_ms_p50': float(np.percentile(exact_ms, 50)),
+        'exact_ms_p95': float(np.percentile(exact_ms, 95)),
+    }
+    for key, value in report.items():
+        print(f"  {key:<14} {value:.4f}" if isinstance(value, float) else f"  {key:<14} {value}")
+    return report
+
+
+def main():
+    from main import load_config
+
+    parser = argparse.ArgumentParser(description='Maintain the visitor ANN index')
+    parser.add_argument('command', choices=['build', 'compact', 'eval', 'info'])
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--nlist', type=int, default=None, help='Number of IVF lists (default: 4*sqrt(N))')
+    parser.add_argument('--nprobe', type=int, default=None, help='Lists searched per query')
+    parser.add_argument('--queries', type=int, default=1000, help='Queries for eval')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    index_dir = config.get('ann_index_dir', 'index/visitors')
+    nprobe = args.nprobe or config.get('ann_nprobe', 16)
+
+    if args.command in ('build', 'compact'):
+        conn = database.get_db_connection(config)
+        if conn is None:
+            print("FATAL: Could not connect to database.")
+            return
+        database.ensure_sync_column(conn)
+        started = time.time()
+        if args.command == 'build' or current_segment(index_dir) is None:
+            index = IVFIndex.build_from_db(conn, index_dir, nlist=args.nlist)
+        else:
+            index = IVFIndex(index_dir, nprobe=nprobe).compact(conn, nlist=args.nlist)
+        conn.close()
+        print(f"{args.command}: {len(index)} visitors, {len(index.centroids)} lists in {time.time() - started:.1f}s")
+    elif args.command == 'eval':
+        evaluate(IVFIndex(index_dir, nprobe=nprobe), queries=args.queries)
+    else:
+        index = IVFIndex(index_dir, nprobe=nprobe)
+        print(json.dumps(dict(index.meta, segment=index.segment_dir, delta=len(index._delta_ids)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Offline batch ingest for archived footage.
+
+Reads every video in a folder, runs YOLO on batches of frames instead of one
+frame at a time, and feeds the results through a per-video ByteTrack
+instance into VisitorTracker, which writes the usual Visitors/Events rows.
+There is no real-time pacing: frames are processed as fast as the hardware
+allows. Totals (frames/s and faces/s) are printed at the end.
+
+Usage:
+    python batch_ingest.py                          # input_videos/, batch from config
+    python batch_ingest.py --folder archive/ --batch-size 32 --skip 1
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import torch
+from ultralytics import YOLO
+from ultralytics.trackers.byte_tracker import BYTETracker
+from ultralytics.utils import IterableSimpleNamespace, yaml_load
+from ultralytics.utils.checks import check_yaml
+
+import database
+import event_writer
+import face_embedder
+import gallery
+import image_writer
+import media_clock
+import metrics
+import state_tracker
+import video_capture
+from main import load_config, unpack_results
+
+VIDEO_EXTS = {'.mp4', '.avi', '.mov', '.mkv', '.wmv'}
+
+
+def get_all_videos_in_folder(folder):
+    """Return a sorted list of video paths found in folder."""
+    if not os.path.exists(folder):
+        return []
+    return [os.path.join(folder, f) for f in sorted(os.listdir(folder))
+            if os.path.splitext(f)[1].lower() in VIDEO_EXTS]
+
+
+def new_bytetrack(frame_rate):
+    """A fresh ByteTrack instance, configured exactly like detector.track(tracker='bytetrack.yaml')."""
+    cfg = IterableSimpleNamespace(**yaml_load(check_yaml('bytetrack.yaml')))
+    return BYTETracker(args=cfg, frame_rate=max(1, int(round(frame_rate))))
+
+
+def apply_tracks(result, byte_tracker):
+    """
+    Runs ByteTrack on one detection result and rewrites its boxes with
+    track IDs, the same way ultralytics' own track() callback does.
+    """
+    det = result.boxes.cpu().numpy()
+    tracks = byte_tracker.update(det, result.orig_img)
+    if len(tracks) == 0:
+        return result[[]]
+    idx = tracks[:, -1].astype(int)
+    result = result[idx]
+    result.update(boxes=torch.as_tensor(tracks[:, :-1]))
+    return result
+
+
+class BatchIngest:
+    def __init__(self, config, batch_size=16, frame_skip=1):
+        self.config = config
+        self.batch_size = max(1, int(batch_size))
+        self.frame_skip = max(1, int(frame_skip))
+
+        self.db_conn = database.get_db_pool(config)
+        if self.db_conn is None:
+            print("FATAL: Could not connect to database. Check config and run init_db.py.")
+            sys.exit(1)
+
+        print(f"Loading YOLO detector: {config.get('yolo_model_path')}")
+        self.detector = YOLO(config.get('yolo_model_path'))
+        self.embedder = face_embedder.FaceEmbedder(use_gpu=config.get('use_gpu', False),
+                                                   mode=config.get('embedding_mode', 'aligned'),
+                                                   max_batch_size=config.get('embedding_batch_size', 32))
+
+        # One gallery shared by every video of the run
+        self.gallery = gallery.open_identity_store(config, self.db_conn)
+        self.writer = event_writer.EventWriter(config, pool=self.db_conn) if config.get('write_behind', True) else None
+        self.image_writer = image_writer.ImageWriter.from_config(config) if config.get('image_writer_threads', 2) > 0 else None
+
+        self.total_frames = 0
+        self.total_faces = 0
+        metrics.from_config(config, labels={'camera': 'batch'})
+
+    def _run_batch(self, batch, byte_tracker, tracker):
+        # One forward pass for the whole batch
+        with metrics.timer('detect_batch'):
+            results = self.detector.predict([frame for _, frame, _ in batch], classes=0, verbose=False)
+
+        # ByteTrack must see the frames of one video in order
+        for (frame_index, frame, pos_msec), result in zip(batch, results):
+            result = apply_tracks(result, byte_tracker)
+            self.total_frames += 1
+            boxes, keypoints = unpack_results(result)
+            self.total_faces += len(boxes)
+            tracker.clock.advance(frame_index, pos_msec)
+            metrics.inc('frames')
+            metrics.inc('faces', len(boxes))
+            try:
+                with metrics.timer('track_update'):
+                    tracker.update_frame(frame, boxes, self.embedder, self.db_conn, keypoints=keypoints)
+            except Exception as e:
+                print(f"Tracker update error: {e}")
+
+    def process_video(self, path):
+        cap = video_capture.ThreadedCapture(path, frame_skip=self.frame_skip,
+                                            queue_size=self.batch_size * 2, policy='block')
+        if not cap.isOpened():
+            print(f"Could not open {path}")
+            return
+
+        fps = cap.cap.get(cv2.CAP_PROP_FPS) or 30.0
+        byte_tracker = new_bytetrack(fps / self.frame_skip)
+        # Frames are timed by their position in the file, not by how fast we ingest them
+        clock = media_clock.for_source(self.config, path, fps=cap.fps, frame_count=cap.frame_count)
+        tracker = state_tracker.VisitorTracker(self.config, gallery=self.gallery, writer=self.writer,
+                                               image_writer=self.image_writer, clock=clock)
+
+        cap.start()
+        batch = []
+        for frame_index, _, frame, pos_msec in cap:
+            batch.append((frame_index, frame, pos_msec))
+            if len(batch) == self.batch_size:
+                self._run_batch(batch, byte_tracker, tracker)
+                batch = []
+        if batch:
+            self._run_batch(batch, byte_tracker, tracker)
+
+        cap.release()
+        # The video is over: close every open visit instead of waiting for exit_timeout
+        tracker.end_of_stream(self.db_conn)
+
+    def run(self, videos):
+        started = time.time()
+        for i, path in enumerate(videos, 1):
+            print(f"--- [{i}/{len(videos)}] Ingesting {path} ---")
+            self.process_video(path)
+        if self.image_writer is not None:
+            self.image_writer.close()
+        if self.writer is not None:
+            self.writer.close()
+        elapsed = max(time.time() - started, 1e-6)
+
+        print(f"Ingest finished: {len(videos)} videos, {self.total_frames} frames, "
+              f"{self.total_faces} faces in {elapsed:.1f}s")
+        print(f"  {self.total_frames / elapsed:.1f} frames/s, {self.total_faces / elapsed:.1f} faces/s")
+        if metrics.enabled():
+            for line in metrics.summary_lines():
+                print(f"  {line}")
+            metrics.stop()
+        self.db_conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline batch ingest of archived videos')
+    parser.add_argument('--folder', default='input_videos')
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='Frames per YOLO forward pass (default: ingest_batch_size in config, or 16)')
+    parser.add_argument('--skip', type=int, default=None,
+                        help='Process every Nth frame (default: frame_skip in config)')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    videos = get_all_videos_in_folder(args.folder)
+    if not videos:
+        print(f"No videos found in {args.folder}")
+        return
+
+    batch_size = args.batch_size or config.get('ingest_batch_size', 16)
+    frame_skip = args.skip or config.get('frame_skip', 1)
+    BatchIngest(config, batch_size=batch_size, frame_skip=frame_skip).run(videos)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+import datetime
+import os
+import struct
+import threading
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+PACK_SCHEME = 'pack://'
+
+# One index record per crop: offset into the day's .pack file and length.
+# Record n lives at n * RECORD.size, so lookups are a single seek.
+# A zero length marks a slot that was reserved but never written.
+RECORD = struct.Struct('<QI')
+
+
+def is_pack_ref(path):
+    return isinstance(path, str) and path.startswith(PACK_SCHEME)
+
+
+def make_ref(day, seq):
+    return f"{PACK_SCHEME}{day}/{seq}"
+
+
+def parse_ref(ref):
+    """'pack://2024-05-01/42' -> ('2024-05-01', 42)"""
+    if not is_pack_ref(ref):
+        raise ValueError(f"Not a pack reference: {ref}")
+    day, _, seq = ref[len(PACK_SCHEME):].partition('/')
+    return day, int(seq)
+
+
+def _lock_file(f):
+    if os.name == 'nt':
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                continue  # LK_LOCK gives up after ~10 s; keep waiting
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+
+def _unlock_file(f):
+    if os.name == 'nt':
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class _DayPack:
+    """
+    Open .pack/.idx pair for one day, plus the <day>.lock file that
+    serializes slot reservation and appends across processes (every
+    camera process and batch_ingest may write the same day).
+    """
+    def __init__(self, root_dir, day):
+        base = os.path.join(root_dir, day)
+        self.data = open(base + '.pack', 'ab')
+        self.index = open(base + '.idx', 'r+b' if os.path.exists(base + '.idx') else 'w+b')
+        self.lock = open(base + '.lock', 'a+b')
+
+    def __enter__(self):
+        _lock_file(self.lock)
+        return self
+
+    def __exit__(self, *exc):
+        _unlock_file(self.lock)
+        return False
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+        self.lock.close()
+
+
+class CropPackWriter:
+    """
+    Appends encoded crops to one pack file per day instead of writing one
+    JPEG per event:
+
+      <root>/<YYYY-MM-DD>.pack   concatenated JPEG bytes
+      <root>/<YYYY-MM-DD>.idx    fixed-size (offset, length) record per crop
+
+    reserve() hands out the reference ('pack://<day>/<seq>') before the
+    crop is encoded, so ImageWriter can return it immediately; write()
+    fills the slot later, from any thread.
+
+    Several processes may write the same directory: reserve() and write()
+    take the day's file lock and use the current end of the .idx/.pack
+    files, never a position cached in this process.
+    """
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        os.makedirs(root_dir, exist_ok=True)
+        self._days = {}
+        self._lock = threading.Lock()
+
+    def _open(self, day):
+        pack = self._days.get(day)
+        if pack is None:
+            # Only the current and the previous day stay open; late writes reopen
+            for old in [d for d in self._days if d < day][:-1]:
+                self._days.pop(old).close()
+            pack = self._days[day] = _DayPack(self.root_dir, day)
+        return pack
+
+    def reserve(self, now=None):
+        """Reserves the next slot of the day. Returns its pack reference."""
+        day = (now or datetime.datetime.now()).strftime('%Y-%m-%d')
+        with self._lock:
+            pack = self._open(day)
+            with pack:
+                # An empty record claims the slot for this process until write()
+                seq = pack.index.seek(0, os.SEEK_END) // RECORD.size
+                pack.index.seek(seq * RECORD.size)
+                pack.index.write(RECORD.pack(0, 0))
+                pack.index.flush()
+        return make_ref(day, seq)
+
+    def write(self, ref, data):
+        """Stores encoded bytes in a reserved slot."""
+        day, seq = parse_ref(ref)
+        with self._lock:
+            pack = self._open(day)
+            with pack:
+                offset = pack.data.seek(0, os.SEEK_END)
+                pack.data.write(data)
+                pack.data.flush()
+                # Data first, index second: a crash never leaves a record pointing past the data
+                pack.index.seek(seq * RECORD.size)
+                pack.index.write(RECORD.pack(offset, len(data)))
+                pack.index.flush()
+
+    def append(self, data, now=None):
+        """Reserves a slot and writes encoded bytes to it. Returns the reference."""
+        ref = self.reserve(now)
+        self.write(ref, data)
+        return ref
+
+    def append_image(self, crop_img, params=None, now=None):
+        """JPEG-encodes and appends a crop. Returns the reference, or None if encoding failed."""
+        import cv2
+        ok, buf = cv2.imencode('.jpg', crop_img, params or [])
+        if not ok:
+            return None
+        return self.append(buf.tobytes(), now)
+
+    def close(self):
+        with self._lock:
+            for pack in self._days.values():
+                pack.close()
+            self._days.clear()
+
+
+class CropPackReader:
+    """
+    Random access to packed crops: one index seek and one data read per
+    reference. File handles are kept open per day (at most max_open).
+    """
+    def __init__(self, root_dir, max_open=8):
+        self.root_dir = root_dir
+        self.max_open = max_open
+        self._files = {}  # day -> (index file, data file), oldest opened first
+        self._lock = threading.Lock()
+
+    def _day(self, day):
+        files = self._files.get(day)
+        if files is None:
+            base = os.path.join(self.root_dir, day)
+            if not os.path.exists(base + '.idx'):
+                return None
+            if len(self._files) >= self.max_open:
+                for f in self._files.pop(next(iter(self._files))):
+                    f.close()
+            files = self._files[day] = (open(base + '.idx', 'rb'), open(base + '.pack', 'rb'))
+        return files
+
+    def __len__(self):
+        return sum(os.path.getsize(os.path.join(self.root_dir, name)) // RECORD.size
+                   for name in os.listdir(self.root_dir) if name.endswith('.idx'))
+
+    def days(self):
+        return sorted(name[:-4] for name in os.listdir(self.root_dir) if name.endswith('.idx'))
+
+    def refs(self, day):
+        """Every written reference of a day, in slot order."""
+        with self._lock:
+            files = self._day(day)
+            if files is None:
+                return []
+            files[0].seek(0)
+            raw = files[0].read()
+        n = len(raw) // RECORD.size
+        return [make_ref(day, seq) for seq, (_, length) in enumerate(RECORD.iter_unpack(raw[:n * RECORD.size]))
+                if length]
+
+    def read(self, ref):
+        """Encoded bytes for a reference, or None if the slot is missing or was never written."""
+        day, seq = parse_ref(ref)
+        with self._lock:
+            files = self._day(day)
+            if files is None:
+                return None
+            index, data = files
+            index.seek(seq * RECORD.size)
+            record = index.read(RECORD.size)
+            if len(record) < RECORD.size:
+                return None
+            offset, length = RECORD.unpack(record)
+            if not length:
+                return None
+            data.seek(offset)
+            return data.read(length)
+
+    def load(self, ref):
+        """Decoded BGR image for a reference, or None."""
+        import cv2
+        import numpy as np
+        data = self.read(ref)
+        if data is None:
+            return None
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    def close(self):
+        with self._lock:
+            for files in self._files.values():
+                for f in files:
+                    f.close()
+            self._files.clear()
+
+
+def load_crop(path, reader):
+    """Loads an Events.cropped_image_path value, either a pack reference or a plain JPEG path."""
+    import cv2
+    if is_pack_ref(path):
+        return reader.load(path)
+    return cv2.imread(path) if path and os.path.exists(path) else None
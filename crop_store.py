@@ -0,0 +1,96 @@
+import cv2
+import numpy as np
+
+
+class CropStore:
+    """
+    Bounded storage for the face crops VisitorTracker needs later (entry and
+    exit images).
+
+    A crop taken from a frame is a NumPy view that keeps the whole frame
+    alive, so nothing here holds views: offer() copies the crop (downscaled
+    so its longer side is at most max_side) and only when it scores better
+    than the one already held for that key. When the copies exceed
+    budget_bytes, the lowest-scoring crops are evicted.
+    """
+    def __init__(self, budget_bytes=64 * 1024 * 1024, max_side=160):
+        self.budget_bytes = budget_bytes
+        self.max_side = max_side
+        self._crops = {}  # key -> (crop, score)
+        self.resident_bytes = 0
+
+        # Stats
+        self.copies = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self._crops
+
+    def __len__(self):
+        return len(self._crops)
+
+    def _compact(self, crop):
+        h, w = crop.shape[:2]
+        longest = max(h, w)
+        if self.max_side and longest > self.max_side:
+            scale = self.max_side / float(longest)
+            size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+            return cv2.resize(crop, size, interpolation=cv2.INTER_AREA)
+        return np.array(crop, copy=True)
+
+    def offer(self, key, crop, score):
+        """Keeps a compact copy of `crop` if it beats the crop held for `key`. Returns True if stored."""
+        if crop is None or crop.size == 0:
+            return False
+        held = self._crops.get(key)
+        if held is not None and held[1] >= score:
+            return False
+        compact = self._compact(crop)
+        if held is not None:
+            self.resident_bytes -= held[0].nbytes
+        self._crops[key] = (compact, score)
+        self.resident_bytes += compact.nbytes
+        self.copies += 1
+        if self.budget_bytes and self.resident_bytes > self.budget_bytes:
+            self._evict()
+        return key in self._crops
+
+    def _evict(self):
+        # Over budget is the exception, so a linear pass is fine here
+        for key in sorted(self._crops, key=lambda k: self._crops[k][1]):
+            if self.resident_bytes <= self.budget_bytes:
+                break
+            self.pop(key)
+            self.evictions += 1
+
+    def get(self, key):
+        held = self._crops.get(key)
+        return held[0] if held is not None else None
+
+    def pop(self, key):
+        held = self._crops.pop(key, None)
+        if held is None:
+            return None
+        self.resident_bytes -= held[0].nbytes
+        return held[0]
+
+    def rename(self, key, new_key):
+        """Moves the crop held for `key` to `new_key`, replacing whatever `new_key` held."""
+        held = self._crops.pop(key, None)
+        self.pop(new_key)
+        if held is not None:
+            self._crops[new_key] = held
+
+    def prune(self, keep):
+        """Drops every crop whose key fails the `keep(key)` predicate."""
+        for key in [k for k in self._crops if not keep(k)]:
+            self.pop(key)
+
+    def stats(self):
+        return {
+            'crops': len(self._crops),
+            'resident_bytes': self.resident_bytes,
+            'budget_bytes': self.budget_bytes,
+            'copies': self.copies,
+            'evictions': self.evictions,
+        }
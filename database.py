@@ -1,6 +1,34 @@
+import asyncio
+import contextlib
+import functools
+import threading
 import psycopg
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
 import numpy as np
-from innit_db import config_to_conninfo  # Reuse the helper (file is named `innit_db.py` in the repo)
+import embedding_codec
+try:
+    from innit_db import config_to_conninfo  # Reuse the helper (file is named `innit_db.py` in the repo)
+except ImportError:
+    def config_to_conninfo(config):
+        """Builds a libpq conninfo string from the db_* keys of config.json."""
+        return psycopg.conninfo.make_conninfo(
+            host=config.get('db_host', 'localhost'), port=config.get('db_port', 5432),
+            user=config.get('db_user'), password=config.get('db_pass'),
+            dbname=config.get('db_name', 'visitor_db'))
+
+def _connection_kwargs(config):
+    """Per-connection settings shared by plain connections and both pools."""
+    return {
+        # psycopg prepares a statement server-side after it has run this many
+        # times on a connection; null in config.json disables preparation
+        # (needed behind PgBouncer in transaction mode).
+        'prepare_threshold': config.get('db_prepare_threshold', 5),
+        'connect_timeout': config.get('db_connect_timeout_seconds', 5),
+    }
+
+def _embedding_storage(config):
+    """'vector' (pgvector, db_schema.sql) or 'bytea' (db_schema_simple.sql)."""
+    return config.get('embedding_storage', 'vector')
 
 def get_db_connection(config):
     """
@@ -8,37 +36,219 @@ def get_db_connection(config):
     """
     conninfo = config_to_conninfo(config)
     try:
-        conn = psycopg.connect(conninfo)
-        return conn
+        conn = psycopg.connect(conninfo, **_connection_kwargs(config))
     except psycopg.OperationalError as e:
         print(f"Database connection failed: {e}")
         return None
+    try:
+        embedding_codec.register_codec(conn, _embedding_storage(config))
+    except Exception as e:
+        print(f"Failed to set up the embedding codec: {e}")
+        conn.close()
+        return None
+    return conn
+
+def get_db_pool(config):
+    """
+    Creates a connection pool sized by db_pool_min_size / db_pool_max_size.
+    Every helper in this module accepts the pool wherever it takes `conn`,
+    borrowing a connection for the duration of the call.
+    Returns None if no connection can be made within db_pool_timeout_seconds.
+    """
+    timeout = config.get('db_pool_timeout_seconds', 5.0)
+    pool = ConnectionPool(config_to_conninfo(config),
+                          min_size=config.get('db_pool_min_size', 2),
+                          max_size=config.get('db_pool_max_size', 8),
+                          timeout=timeout,
+                          kwargs=_connection_kwargs(config),
+                          configure=functools.partial(embedding_codec.register_codec,
+                                                      storage=_embedding_storage(config)),
+                          open=True)
+    try:
+        pool.wait(timeout=timeout)
+        return pool
+    except psycopg.OperationalError as e:
+        print(f"Database connection failed: {e}")
+        pool.close()
+        return None
+
+@contextlib.contextmanager
+def _borrow(conn):
+    """
+    Lets every helper take either a plain connection or a ConnectionPool.
+    Pooled connections go back to the pool when the block ends.
+    """
+    if isinstance(conn, ConnectionPool):
+        with conn.connection() as pooled:
+            yield pooled
+    else:
+        yield conn
+
+REGISTER_VISITOR_SQL = """
+INSERT INTO Visitors (embedding) 
+VALUES (%s) 
+RETURNING visitor_id;
+"""
+
+# pgvector's <=> operator calculates cosine distance (0=identical, 2=opposite)
+# We convert it to cosine similarity (1=identical, -1=opposite)
+# Cosine Similarity = 1 - Cosine Distance
+# Ordering by the raw distance (no WHERE on it) lets the HNSW index serve the
+# nearest neighbour; the threshold is checked on the single returned row.
+FIND_VISITOR_SQL = """
+SELECT visitor_id, (1 - (embedding <=> %(embedding)s)) AS similarity
+FROM Visitors
+ORDER BY embedding <=> %(embedding)s
+LIMIT 1;
+"""
+
+LOG_EVENT_SQL = """
+INSERT INTO Events (visitor_id, event_type, cropped_image_path, timestamp)
+VALUES (%s, %s, %s, COALESCE(%s::timestamptz, NOW()));
+"""
+
+RELINK_EVENT_IMAGE_SQL = "UPDATE Events SET cropped_image_path = %s WHERE cropped_image_path = %s;"
+
+COUNT_VISITORS_SQL = "SELECT COUNT(*) FROM Visitors;"
+
+EMBEDDING_TYPE_SQL = """
+SELECT format_type(atttypid, NULL) FROM pg_attribute
+WHERE attrelid = 'visitors'::regclass AND attname = 'embedding';
+"""
+
+# Gallery syncs read Visitors by inserted_at, which the server stamps when
+# the row is written. first_seen is set by the client at registration, so a
+# row replayed late from the EventWriter journal carries a first_seen that is
+# already behind every other process's sync watermark.
+SYNC_COLUMN_EXISTS_SQL = """
+SELECT 1 FROM information_schema.columns
+WHERE table_name = 'visitors' AND column_name = 'inserted_at';
+"""
+
+ADD_SYNC_COLUMN_SQL = """
+ALTER TABLE Visitors ADD COLUMN IF NOT EXISTS inserted_at TIMESTAMPTZ NOT NULL DEFAULT NOW();
+CREATE INDEX IF NOT EXISTS idx_visitors_inserted_at ON Visitors(inserted_at);
+"""
+
+def ensure_sync_column(conn):
+    """
+    Adds Visitors.inserted_at to databases created before it existed
+    (existing rows get the time of the upgrade). Called once at startup.
+    """
+    with _borrow(conn) as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute(SYNC_COLUMN_EXISTS_SQL)
+                if cur.fetchone() is None:
+                    print("Adding Visitors.inserted_at (gallery sync column)...")
+                    cur.execute(ADD_SYNC_COLUMN_SQL)
+            conn.commit()
+        except Exception as e:
+            print(f"Error adding Visitors.inserted_at: {e}")
+            conn.rollback()
+
+def _fetch_embeddings_query(since=None):
+    sql = "SELECT visitor_id, embedding, inserted_at FROM Visitors"
+    params = ()
+    if since is not None:
+        sql += " WHERE inserted_at >= %s"
+        params = (since,)
+    return sql + " ORDER BY inserted_at", params
 
 def register_new_visitor(conn, embedding):
     """
     Adds a new visitor to the Visitors table with their embedding.
     Returns the new visitor_id (UUID).
     """
-    # Convert numpy array to list for psycopg
-    embedding_list = embedding.tolist()
-    
-    sql = """
-    INSERT INTO Visitors (embedding) 
-    VALUES (%s) 
-    RETURNING visitor_id;
+    # The embedding goes over the wire as binary float32 (see embedding_codec)
+    embedding = np.asarray(embedding, dtype=np.float32)
+
+    with _borrow(conn) as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute(REGISTER_VISITOR_SQL, (embedding,))
+                row = cur.fetchone()
+                conn.commit()
+                # fetchone() returns a tuple like (visitor_id,), so return the id or None
+                return row[0] if row else None
+        except Exception as e:
+            print(f"Error registering new visitor: {e}")
+            conn.rollback()
+            return None
+
+def count_visitors(conn):
     """
-    
-    try:
-        with conn.cursor() as cur:
-            cur.execute(sql, (embedding_list,))
-            row = cur.fetchone()
+    Returns the number of registered visitors. Only meant to be called once
+    at startup; the running count is kept in memory by VisitorTracker.
+    """
+    with _borrow(conn) as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute(COUNT_VISITORS_SQL)
+                row = cur.fetchone()
+                return row[0] if row else 0
+        except Exception as e:
+            print(f"Error counting visitors: {e}")
+            conn.rollback()
+            return 0
+
+def _decode_embedding(value):
+    """
+    Turns an embedding column value into a float32 numpy array.
+    pgvector columns already arrive as arrays through the embedding_codec
+    loaders (or as '[0.1,0.2,...]' text on a connection without them); the
+    BYTEA schema in db_schema_simple.sql arrives as raw float32 bytes.
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return embedding_codec.decode_bytea(value)
+    if isinstance(value, str):
+        return embedding_codec.decode_vector_text(value)
+    return np.asarray(value, dtype=np.float32)
+
+def fetch_visitor_embeddings(conn, since=None):
+    """
+    Returns [(visitor_id, embedding, inserted_at), ...] for every visitor,
+    or only those with inserted_at >= since.
+    """
+    sql, params = _fetch_embeddings_query(since)
+
+    with _borrow(conn) as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql, params)
+                return [(vid, _decode_embedding(emb), inserted_at) for vid, emb, inserted_at in cur.fetchall()]
+        except Exception as e:
+            print(f"Error loading visitor embeddings: {e}")
+            conn.rollback()
+            return []
+
+def load_embedding_matrix(conn, since=None, dim=512):
+    """
+    Bulk-loads visitor embeddings with one binary COPY.
+    Returns (visitor_ids, (N, dim) float32 matrix, newest inserted_at).
+    Works with both the pgvector and the BYTEA schema.
+    """
+    sql, params = _fetch_embeddings_query(since)
+
+    with _borrow(conn) as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute(EMBEDDING_TYPE_SQL)
+                storage = 'bytea' if cur.fetchone()[0] == 'bytea' else 'vector'
+                # Exact row count, so the matrix is allocated once
+                cur.execute(f"SELECT COUNT(*) FROM ({sql}) AS rows", params)
+                count = cur.fetchone()[0]
+
+                reader = embedding_codec.EmbeddingMatrixReader(storage, dim=dim, capacity=count)
+                with cur.copy(f"COPY ({sql}) TO STDOUT (FORMAT BINARY)", params) as copy:
+                    for chunk in copy:
+                        reader.feed(chunk)
             conn.commit()
-            # fetchone() returns a tuple like (visitor_id,), so return the id or None
-            return row[0] if row else None
-    except Exception as e:
-        print(f"Error registering new visitor: {e}")
-        conn.rollback()
-        return None
+            return reader.result()
+        except Exception as e:
+            print(f"Error loading visitor embeddings: {e}")
+            conn.rollback()
+            return [], np.zeros((0, dim), dtype=np.float32), None
 
 def find_visitor(conn, embedding, threshold):
     """
@@ -46,48 +256,146 @@ def find_visitor(conn, embedding, threshold):
     Uses the HNSW index for fast search.
     Returns (visitor_id, similarity_score) or (None, 0).
     """
-    # pgvector's <=> operator calculates cosine distance (0=identical, 2=opposite)
-    # We convert it to cosine similarity (1=identical, -1=opposite)
-    # Cosine Similarity = 1 - Cosine Distance
-    
-    embedding_list = embedding.tolist()
-    
-    sql = """
-    SELECT visitor_id, (1 - (embedding <=> %s)) AS similarity
-    FROM Visitors
-    WHERE (1 - (embedding <=> %s)) >= %s
-    ORDER BY similarity DESC
-    LIMIT 1;
-    """
-    
-    try:
-        with conn.cursor() as cur:
-            cur.execute(sql, (embedding_list, embedding_list, threshold))
-            result = cur.fetchone()
-
-            if result:
-                # result is (visitor_id, similarity)
-                visitor_id, similarity = result
-                return visitor_id, similarity
-            else:
-                return None, 0
-    except Exception as e:
-        print(f"Error finding visitor: {e}")
-        return None, 0
+    embedding = np.asarray(embedding, dtype=np.float32)
+
+    with _borrow(conn) as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute(FIND_VISITOR_SQL, {'embedding': embedding})
+                result = cur.fetchone()
+
+                # result is (visitor_id, similarity) of the nearest visitor
+                if result and result[1] >= threshold:
+                    visitor_id, similarity = result
+                    return visitor_id, similarity
+                else:
+                    return None, 0
+        except Exception as e:
+            print(f"Error finding visitor: {e}")
+            return None, 0
 
-def log_event(conn, visitor_id, event_type, image_path):
+def log_event(conn, visitor_id, event_type, image_path, timestamp=None):
     """
     Logs an 'entry' or 'exit' event to the Events table.
+    `timestamp` defaults to NOW() on the server.
     """
-    sql = """
-    INSERT INTO Events (visitor_id, event_type, cropped_image_path)
-    VALUES (%s, %s, %s);
+    with _borrow(conn) as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute(LOG_EVENT_SQL, (visitor_id, event_type, image_path, timestamp))
+                conn.commit()
+        except Exception as e:
+            print(f"Error logging event: {e}")
+            conn.rollback()
+
+def relink_event_images(conn, pairs):
     """
-    
-    try:
-        with conn.cursor() as cur:
-            cur.execute(sql, (visitor_id, event_type, image_path))
+    Points Events at moved crops: [(new_path, old_path), ...].
+    Commits once for the whole batch. Returns the number of updated rows, or -1 on error.
+    """
+    with _borrow(conn) as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.executemany(RELINK_EVENT_IMAGE_SQL, pairs)
+                updated = cur.rowcount
             conn.commit()
-    except Exception as e:
-        print(f"Error logging event: {e}")
-        conn.rollback()
\ No newline at end of file
+            return updated
+        except Exception as e:
+            print(f"Error relinking event images: {e}")
+            conn.rollback()
+            return -1
+
+def copy_visitors(conn, rows, storage='vector'):
+    """
+    Bulk-inserts [(visitor_id, embedding, first_seen), ...] with a binary COPY.
+    Does not commit; the caller groups several COPYs into one transaction.
+    `storage` is 'vector' (pgvector schema) or 'bytea' (db_schema_simple.sql).
+    """
+    with conn.cursor() as cur:
+        with cur.copy("COPY Visitors (visitor_id, embedding, first_seen, last_seen) FROM STDIN (FORMAT BINARY)") as copy:
+            copy.write(embedding_codec.pack_visitor_rows(rows, storage))
+
+def copy_events(conn, rows):
+    """
+    Bulk-inserts [(visitor_id, event_type, image_path, timestamp), ...] with COPY.
+    Does not commit.
+    """
+    with conn.cursor() as cur:
+        with cur.copy("COPY Events (visitor_id, event_type, cropped_image_path, timestamp) FROM STDIN") as copy:
+            for row in rows:
+                copy.write_row(row)
+
+
+class AsyncDatabase:
+    """
+    Async (psycopg AsyncConnection) access to the same queries, backed by an
+    AsyncConnectionPool that runs on its own event loop thread.
+
+    The frame loop never awaits anything: it calls submit(coro) and gets a
+    concurrent.futures.Future back, which it can poll with done() on a later
+    frame. Several reads/writes can be in flight at once, up to
+    db_pool_max_size connections.
+    """
+    def __init__(self, config):
+        # psycopg's async driver needs a selector loop (Proactor is the Windows default)
+        self._loop = asyncio.SelectorEventLoop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="db-async", daemon=True)
+        self._thread.start()
+
+        timeout = config.get('db_pool_timeout_seconds', 5.0)
+        self.pool = AsyncConnectionPool(config_to_conninfo(config),
+                                        min_size=config.get('db_pool_min_size', 2),
+                                        max_size=config.get('db_pool_max_size', 8),
+                                        timeout=timeout,
+                                        kwargs=_connection_kwargs(config),
+                                        configure=functools.partial(embedding_codec.register_codec_async,
+                                                                    storage=_embedding_storage(config)),
+                                        open=False)
+        self.run(self.pool.open(wait=True, timeout=timeout))
+
+    def submit(self, coro):
+        """Schedules a coroutine on the DB loop. Returns a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def run(self, coro, timeout=None):
+        """Runs a coroutine on the DB loop and waits for its result."""
+        return self.submit(coro).result(timeout)
+
+    async def fetch_visitor_embeddings(self, since=None):
+        sql, params = _fetch_embeddings_query(since)
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(sql, params)
+                rows = await cur.fetchall()
+        return [(vid, _decode_embedding(emb), inserted_at) for vid, emb, inserted_at in rows]
+
+    async def find_visitor(self, embedding, threshold):
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(FIND_VISITOR_SQL, {'embedding': np.asarray(embedding, dtype=np.float32)})
+                result = await cur.fetchone()
+        return (result[0], result[1]) if result and result[1] >= threshold else (None, 0)
+
+    async def register_new_visitor(self, embedding):
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(REGISTER_VISITOR_SQL, (np.asarray(embedding, dtype=np.float32),))
+                row = await cur.fetchone()
+        return row[0] if row else None
+
+    async def log_event(self, visitor_id, event_type, image_path, timestamp=None):
+        async with self.pool.connection() as conn:
+            await conn.execute(LOG_EVENT_SQL, (visitor_id, event_type, image_path, timestamp))
+
+    async def count_visitors(self):
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(COUNT_VISITORS_SQL)
+            row = await cur.fetchone()
+        return row[0] if row else 0
+
+    def close(self):
+        try:
+            self.run(self.pool.close(), timeout=10)
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
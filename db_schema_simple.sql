@@ -6,6 +6,9 @@ CREATE TABLE IF NOT EXISTS Visitors (
     visitor_id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
     first_seen TIMESTAMPTZ DEFAULT NOW(),
     last_seen TIMESTAMPTZ DEFAULT NOW(),
+    -- Set by the server when the row is written; gallery syncs read by it
+    -- (first_seen comes from the client and can be older, e.g. journal replays)
+    inserted_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
     -- InsightFace embeddings stored as BYTEA (binary data)
     embedding BYTEA NOT NULL,
     -- Store embedding dimension and metadata
@@ -36,6 +39,12 @@ CREATE INDEX IF NOT EXISTS idx_events_timestamp ON Events(timestamp);
 -- Create index on visitor first_seen for analytics
 CREATE INDEX IF NOT EXISTS idx_visitors_first_seen ON Visitors(first_seen);
 
+-- Databases created before inserted_at existed
+ALTER TABLE Visitors ADD COLUMN IF NOT EXISTS inserted_at TIMESTAMPTZ NOT NULL DEFAULT NOW();
+
+-- Create index on inserted_at for gallery syncs
+CREATE INDEX IF NOT EXISTS idx_visitors_inserted_at ON Visitors(inserted_at);
+
 -- Create view for visitor statistics
 CREATE OR REPLACE VIEW visitor_stats AS
 SELECT 
@@ -0,0 +1,242 @@
+import json
+import time
+import cv2
+import numpy as np
+
+import media_clock
+
+FORMAT_VERSION = 1
+
+
+class _Column:
+    """Just enough of a torch tensor for update_frame: .int().cpu().tolist()."""
+    def __init__(self, values):
+        self.values = values
+
+    def int(self):
+        return _Column(self.values.astype(np.int64))
+
+    def cpu(self):
+        return self
+
+    def tolist(self):
+        return self.values.tolist()
+
+
+class RecordedBoxes:
+    """Stands in for ultralytics Boxes: .id, .xyxy and .conf (id is None when nothing is tracked)."""
+    def __init__(self, ids, xyxy, conf):
+        self.id = _Column(ids) if len(ids) else None
+        self.xyxy = _Column(xyxy)
+        self.conf = _Column(conf)
+
+    def __len__(self):
+        return len(self.xyxy.values)
+
+
+class DetectionRecorder:
+    """
+    Records what the detector/tracker produced for every frame, so
+    VisitorTracker can be re-run later without YOLO (see DetectionLog).
+
+    Columns are kept in lists and written once by close() as one
+    compressed .npz: per frame the tracker time and an offset into the
+    per-detection columns (track id, box, confidence, and optionally
+    keypoints, square crops and float16 embeddings). Crops cost
+    crop_side^2 * 3 bytes per detection in memory until close(), so keep
+    recordings to clips.
+    """
+    def __init__(self, path, crops=False, crop_side=112, embedder=None):
+        self.path = path
+        self.crops = crops
+        self.crop_side = crop_side
+        self.embedder = embedder
+        self._frame_index, self._time, self._offsets, self._has_boxes = [], [], [0], []
+        self._ids, self._xyxy, self._conf = [], [], []
+        self._kps, self._crops, self._embeddings = [], [], []
+        self._count = 0
+        self._has_kps = None
+
+    def record(self, frame_index, timestamp, frame, boxes, keypoints=None):
+        """Appends one frame. `timestamp` is the tracker clock time (epoch seconds)."""
+        self._frame_index.append(frame_index)
+        self._time.append(timestamp)
+        # main.py skips update_frame when the detector returned nothing at all
+        self._has_boxes.append(boxes is not None)
+        if boxes is not None and boxes.id is not None and len(boxes.xyxy):
+            ids = np.asarray(boxes.id.int().cpu().tolist(), dtype=np.int64)
+            xyxy = np.asarray(boxes.xyxy.int().cpu().tolist(), dtype=np.int32).reshape(-1, 4)
+            conf = (np.asarray(boxes.conf.cpu().tolist(), dtype=np.float32)
+                    if getattr(boxes, 'conf', None) is not None else np.ones(len(ids), dtype=np.float32))
+            self._ids.append(ids)
+            self._xyxy.append(xyxy)
+            self._conf.append(conf)
+            self._count += len(ids)
+
+            if self._has_kps is None:
+                self._has_kps = keypoints is not None
+            if self._has_kps:
+                kps = np.zeros((len(ids), 5, 2), dtype=np.float32)
+                if keypoints is not None:
+                    kps[:min(len(ids), len(keypoints))] = keypoints[:len(ids)]
+                self._kps.append(kps)
+
+            if self.crops or self.embedder is not None:
+                crops = [frame[y1:y2, x1:x2] for x1, y1, x2, y2 in xyxy]
+                if self.crops:
+                    self._crops.append(np.stack([self._square(c) for c in crops]))
+                if self.embedder is not None:
+                    local_kps = None
+                    if self._has_kps:
+                        local_kps = [k - xyxy[i, :2].astype(np.float32) for i, k in enumerate(self._kps[-1])]
+                    emb, ok = self.embedder.get_embeddings(crops, local_kps)
+                    emb = np.asarray(emb, dtype=np.float16).reshape(len(crops), -1)
+                    emb[~np.asarray(ok, dtype=bool)] = 0  # zero rows mark crops the embedder rejected
+                    self._embeddings.append(emb)
+        self._offsets.append(self._count)
+
+    def _square(self, crop):
+        if crop.size == 0:
+            return np.zeros((self.crop_side, self.crop_side, 3), dtype=np.uint8)
+        return cv2.resize(crop, (self.crop_side, self.crop_side), interpolation=cv2.INTER_AREA)
+
+    def __len__(self):
+        return len(self._frame_index)
+
+    def close(self):
+        """Writes the .npz. Returns the number of frames recorded."""
+        def stack(parts, shape, dtype):
+            return np.concatenate(parts) if parts else np.zeros((0,) + shape, dtype=dtype)
+
+        columns = {
+            'frame_index': np.asarray(self._frame_index, dtype=np.int64),
+            'time': np.asarray(self._time, dtype=np.float64),
+            'offsets': np.asarray(self._offsets, dtype=np.int64),
+            'has_boxes': np.asarray(self._has_boxes, dtype=bool),
+            'track_id': stack(self._ids, (), np.int64),
+            'xyxy': stack(self._xyxy, (4,), np.int32),
+            'conf': stack(self._conf, (), np.float32),
+        }
+        if self._kps:
+            columns['keypoints'] = stack(self._kps, (5, 2), np.float32)
+        if self._crops:
+            columns['crops'] = stack(self._crops, (self.crop_side, self.crop_side, 3), np.uint8)
+        if self._embeddings:
+            columns['embeddings'] = stack(self._embeddings, (512,), np.float16)
+        meta = {'version': FORMAT_VERSION, 'recorded_at': time.time(),
+                'frames': len(self._frame_index), 'detections': self._count}
+        np.savez_compressed(self.path, meta=np.array(json.dumps(meta)), **columns)
+        return len(self._frame_index)
+
+
+class ReplayFrame:
+    """
+    Stands in for the video frame during replay. update_frame only slices
+    it with each box (frame[y1:y2, x1:x2]); this returns the recorded crop
+    for that box, resized back to the box size. Without recorded crops it
+    returns a slice of a fixed sharp texture, so crop quality depends on
+    box size and confidence only.
+    """
+    _texture = None
+
+    def __init__(self, boxes, crops=None):
+        self.boxes = boxes
+        self.embedding_of = {}  # id(returned crop) -> recorded embedding, for RecordedEmbedder
+        self._crops = {}  # box -> crop handed out, so the same box gives the same object
+        self._crops_by_box = {tuple(b): crops[i] for i, b in enumerate(boxes)} if crops is not None else None
+
+    @classmethod
+    def texture(cls):
+        if cls._texture is None:
+            cls._texture = np.random.default_rng(0).integers(0, 255, (2160, 3840, 3), dtype=np.uint8)
+        return cls._texture
+
+    def __getitem__(self, key):
+        rows, cols = key
+        x1, y1, x2, y2 = cols.start, rows.start, cols.stop, rows.stop
+        box = (x1, y1, x2, y2)
+        crop = self._crops.get(box)
+        if crop is None:
+            w, h = max(0, x2 - x1), max(0, y2 - y1)
+            if self._crops_by_box is not None and w and h:
+                crop = cv2.resize(self._crops_by_box[box], (w, h), interpolation=cv2.INTER_LINEAR)
+            else:
+                crop = self.texture()[:h, :w]
+            self._crops[box] = crop
+        return crop
+
+
+class RecordedEmbedder:
+    """Returns the embeddings stored in the log for the crops ReplayFrame handed out."""
+    def __init__(self):
+        self.frame = None
+
+    def get_embeddings(self, crops, kps_list=None):
+        emb = np.stack([self.frame.embedding_of[id(c)] for c in crops]).astype(np.float32)
+        return emb, np.linalg.norm(emb, axis=1) > 0
+
+
+class DetectionLog:
+    """Loads a DetectionRecorder file and yields frames for replay."""
+    def __init__(self, path):
+        with np.load(path) as data:
+            self.meta = json.loads(str(data['meta']))
+            self.columns = {k: data[k] for k in data.files if k != 'meta'}
+        self.frame_index = self.columns['frame_index']
+        self.time = self.columns['time']
+        self.offsets = self.columns['offsets']
+
+    def __len__(self):
+        return len(self.frame_index)
+
+    @property
+    def has_crops(self):
+        return 'crops' in self.columns
+
+    @property
+    def has_embeddings(self):
+        return 'embeddings' in self.columns
+
+    def frames(self):
+        """
+        Yields (frame_index, timestamp, ReplayFrame, RecordedBoxes, keypoints or None);
+        boxes is None for frames where the detector returned nothing.
+        """
+        c = self.columns
+        for i in range(len(self.frame_index)):
+            if not c['has_boxes'][i]:
+                yield int(self.frame_index[i]), float(self.time[i]), None, None, None
+                continue
+            lo, hi = self.offsets[i], self.offsets[i + 1]
+            xyxy = c['xyxy'][lo:hi]
+            frame = ReplayFrame([tuple(b) for b in xyxy.tolist()], c['crops'][lo:hi] if self.has_crops else None)
+            boxes = RecordedBoxes(c['track_id'][lo:hi], xyxy, c['conf'][lo:hi])
+            keypoints = c['keypoints'][lo:hi] if 'keypoints' in c else None
+            if self.has_embeddings:
+                for j, box in enumerate(frame.boxes):
+                    x1, y1, x2, y2 = box
+                    frame.embedding_of[id(frame[y1:y2, x1:x2])] = c['embeddings'][lo + j]
+            yield int(self.frame_index[i]), float(self.time[i]), frame, boxes, keypoints
+
+
+def replay(log, tracker, embedder, db_conn=None):
+    """
+    Feeds every recorded frame to tracker.update_frame as fast as possible,
+    then closes open visits. The tracker's clock is replaced by a MediaClock
+    set to each frame's recorded time, so timeouts and event timestamps
+    match the recording. Returns per-frame seconds.
+    """
+    start = float(log.time[0]) if len(log) else time.time()
+    clock = tracker.clock = media_clock.MediaClock(start=start)
+    timings = []
+    for frame_index, timestamp, frame, boxes, keypoints in log.frames():
+        clock.seek(timestamp - start)
+        if boxes is None:
+            continue
+        if isinstance(embedder, RecordedEmbedder):
+            embedder.frame = frame
+        started = time.perf_counter()
+        tracker.update_frame(frame, boxes, embedder, db_conn, keypoints=keypoints)
+        timings.append(time.perf_counter() - started)
+    tracker.end_of_stream(db_conn)
+    return timings
@@ -0,0 +1,74 @@
+import threading
+import cv2
+
+import metrics
+
+
+class DisplayWindow:
+    """
+    Optional rendering stage: results.plot(), the counter overlay,
+    cv2.imshow and cv2.waitKey.
+
+    HighGUI windows belong to the thread that created them (Qt and Cocoa
+    refuse to draw from any other), so all drawing happens in poll(), which
+    the main thread calls while it feeds frames. The track stage hands over
+    the latest results with submit(), which never blocks: if the previous
+    frame has not been drawn yet it is simply replaced. Rendering therefore
+    can't slow detection down; at worst the window shows fewer frames.
+    """
+    def __init__(self, window_name="Intelligent Face Tracker"):
+        self.window_name = window_name
+        self.quit_requested = False
+        self.frames_shown = 0
+        self.frames_skipped = 0
+
+        self._pending = None
+        self._lock = threading.Lock()
+
+    def submit(self, frame, results, counters):
+        """
+        Queues a frame for display (any thread). `counters` is a dict such as
+        {'unique_visitors': 12, 'occupancy': 3}.
+        """
+        with self._lock:
+            if self._pending is not None:
+                self.frames_skipped += 1
+            self._pending = (frame, results, dict(counters))
+
+    @staticmethod
+    def _annotate(frame, results):
+        try:
+            if hasattr(results, 'plot'):
+                return results.plot()
+            elif isinstance(results, (list, tuple)) and len(results) > 0:
+                return results[0].plot()
+        except Exception:
+            pass
+        return frame
+
+    def poll(self):
+        """
+        Draws the latest submitted frame, if any, and handles window events.
+        Main thread only. Returns True once 'q' has been pressed.
+        """
+        with self._lock:
+            item, self._pending = self._pending, None
+
+        if item is not None:
+            frame, results, counters = item
+            with metrics.timer('render'):
+                annotated_frame = self._annotate(frame, results)
+                cv2.putText(annotated_frame, f"Unique Visitors Registered: {counters.get('unique_visitors', 0)}",
+                            (20, 40), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+                cv2.putText(annotated_frame, f"Currently Inside: {counters.get('occupancy', 0)}",
+                            (20, 80), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+                cv2.imshow(self.window_name, annotated_frame)
+            self.frames_shown += 1
+
+        if cv2.waitKey(1) & 0xFF == ord('q'):
+            self.quit_requested = True
+        return self.quit_requested
+
+    def close(self):
+        """Closes the window (main thread)."""
+        cv2.destroyAllWindows()
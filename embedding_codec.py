@@ -0,0 +1,238 @@
+"""
+Binary codec for face embeddings, for both schemas:
+
+  'vector' - pgvector column. Binary wire format: uint16 dim, uint16 unused,
+             then dim big-endian float32.
+  'bytea'  - db_schema_simple.sql. The column holds raw little-endian
+             float32 bytes (dim * 4 bytes).
+
+Writes never go through Python lists: embeddings are sent as binary
+parameters and binary COPY rows. Reads use np.frombuffer over the bytes
+psycopg returns. The bulk loader parses a `COPY ... TO STDOUT (FORMAT BINARY)`
+stream straight into one preallocated float32 matrix.
+"""
+
+import datetime
+import struct
+import uuid
+import numpy as np
+from psycopg.adapt import Dumper, Loader
+from psycopg.pq import Format
+from psycopg.types import TypeInfo
+
+
+PGCOPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+PGCOPY_HEADER = PGCOPY_SIGNATURE + struct.pack('>ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('>h', -1)
+_PG_EPOCH = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+
+_int16 = struct.Struct('>h')
+_int32 = struct.Struct('>i')
+_int64 = struct.Struct('>q')
+
+
+# --- Single values ------------------------------------------------------------
+
+def encode_bytea(embedding):
+    return np.asarray(embedding, dtype='<f4').tobytes()
+
+
+def decode_bytea(value):
+    """Zero-copy float32 view over the column bytes."""
+    return np.frombuffer(value, dtype='<f4')
+
+
+def encode_vector(embedding):
+    embedding = np.asarray(embedding, dtype='>f4').reshape(-1)
+    return struct.pack('>HH', len(embedding), 0) + embedding.tobytes()
+
+
+def decode_vector(value):
+    dim = struct.unpack_from('>H', value, 0)[0]
+    return np.frombuffer(value, dtype='>f4', count=dim, offset=4).astype(np.float32)
+
+
+def decode_vector_text(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        value = bytes(value).decode('ascii')
+    return np.array(value.strip('[]').split(','), dtype=np.float32)
+
+
+def encode(embedding, storage):
+    return encode_bytea(embedding) if storage == 'bytea' else encode_vector(embedding)
+
+
+# --- psycopg adapters ---------------------------------------------------------
+
+class _ByteaEmbeddingDumper(Dumper):
+    format = Format.BINARY
+    oid = 17  # bytea
+
+    def dump(self, obj):
+        return encode_bytea(obj)
+
+
+class _VectorEmbeddingDumper(Dumper):
+    format = Format.BINARY
+
+    def dump(self, obj):
+        return encode_vector(obj)
+
+
+class _VectorBinaryLoader(Loader):
+    format = Format.BINARY
+
+    def load(self, data):
+        return decode_vector(data)
+
+
+class _VectorTextLoader(Loader):
+    format = Format.TEXT
+
+    def load(self, data):
+        return decode_vector_text(data)
+
+
+def _register(conn, storage, info):
+    if storage == 'bytea':
+        conn.adapters.register_dumper(np.ndarray, _ByteaEmbeddingDumper)
+        return
+    if info is None:
+        raise RuntimeError("embedding_storage is 'vector' but the pgvector extension is not installed")
+    dumper = type('VectorEmbeddingDumper', (_VectorEmbeddingDumper,), {'oid': info.oid})
+    conn.adapters.register_dumper(np.ndarray, dumper)
+    conn.adapters.register_loader(info.oid, _VectorBinaryLoader)
+    conn.adapters.register_loader(info.oid, _VectorTextLoader)
+
+
+def register_codec(conn, storage='vector'):
+    """
+    Makes numpy embeddings usable as query parameters on `conn` (binary
+    dumper), and loads pgvector columns as float32 arrays. Also used as a
+    ConnectionPool `configure` callback.
+    """
+    info = TypeInfo.fetch(conn, 'vector') if storage == 'vector' else None
+    _register(conn, storage, info)
+    if not conn.autocommit:
+        conn.commit()  # pools require configure() to leave the connection idle
+
+
+async def register_codec_async(conn, storage='vector'):
+    """register_codec for psycopg AsyncConnection (AsyncConnectionPool configure)."""
+    info = await TypeInfo.fetch(conn, 'vector') if storage == 'vector' else None
+    _register(conn, storage, info)
+    if not conn.autocommit:
+        await conn.commit()
+
+
+# --- Binary COPY --------------------------------------------------------------
+
+def _pg_timestamp(ts):
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=datetime.timezone.utc)
+    delta = ts - _PG_EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _from_pg_timestamp(micros):
+    return _PG_EPOCH + datetime.timedelta(microseconds=micros)
+
+
+def pack_visitor_rows(rows, storage='vector'):
+    """
+    Binary COPY payload for
+    `COPY Visitors (visitor_id, embedding, first_seen, last_seen) FROM STDIN (FORMAT BINARY)`.
+    `rows` are (visitor_id, embedding, first_seen).
+    """
+    parts = [PGCOPY_HEADER]
+    for visitor_id, embedding, first_seen in rows:
+        value = encode(embedding, storage)
+        ts = _pg_timestamp(first_seen)
+        parts.append(struct.pack('>hi16si', 4, 16, visitor_id.bytes, len(value)))
+        parts.append(value)
+        parts.append(struct.pack('>iqiq', 8, ts, 8, ts))
+    parts.append(PGCOPY_TRAILER)
+    return b''.join(parts)
+
+
+class EmbeddingMatrixReader:
+    """
+    Incremental parser for
+    `COPY (SELECT visitor_id, embedding, inserted_at FROM Visitors) TO STDOUT (FORMAT BINARY)`.
+
+    feed() it the raw chunks psycopg yields; every embedding is written
+    directly into a preallocated (capacity, dim) float32 matrix.
+    """
+    def __init__(self, storage='vector', dim=512, capacity=1024):
+        self.storage = storage
+        self.dim = dim
+        self.matrix = np.empty((max(1, capacity), dim), dtype=np.float32)
+        self.ids = []
+        self.newest = None
+        self._buf = bytearray()
+        self._header_done = False
+        self._finished = False
+
+    def _row(self, buf, fields):
+        (id_off, _), (emb_off, emb_len), ts_field = fields
+        n = len(self.ids)
+        if n == self.matrix.shape[0]:
+            grown = np.empty((n * 2, self.dim), dtype=np.float32)
+            grown[:n] = self.matrix
+            self.matrix = grown
+
+        if self.storage == 'bytea':
+            self.matrix[n] = np.frombuffer(buf, dtype='<f4', count=emb_len // 4, offset=emb_off)
+        else:
+            dim = struct.unpack_from('>H', buf, emb_off)[0]
+            self.matrix[n] = np.frombuffer(buf, dtype='>f4', count=dim, offset=emb_off + 4)
+        self.ids.append(uuid.UUID(bytes=bytes(buf[id_off:id_off + 16])))
+
+        if ts_field is not None:
+            ts = _from_pg_timestamp(_int64.unpack_from(buf, ts_field[0])[0])
+            if self.newest is None or ts > self.newest:
+                self.newest = ts
+
+    def feed(self, chunk):
+        buf = self._buf
+        buf += chunk
+        pos = 0
+        if not self._header_done:
+            if len(buf) < 19:
+                return
+            if bytes(buf[:11]) != PGCOPY_SIGNATURE:
+                raise ValueError("Not a binary COPY stream")
+            pos = 19 + _int32.unpack_from(buf, 15)[0]
+            self._header_done = True
+
+        end = len(buf)
+        while not self._finished and end - pos >= 2:
+            nfields = _int16.unpack_from(buf, pos)[0]
+            if nfields == -1:
+                self._finished = True
+                pos += 2
+                break
+            p = pos + 2
+            fields = []
+            for _ in range(nfields):
+                if end - p < 4:
+                    break
+                flen = _int32.unpack_from(buf, p)[0]
+                p += 4
+                if flen == -1:
+                    fields.append(None)
+                    continue
+                if end - p < flen:
+                    break
+                fields.append((p, flen))
+                p += flen
+            if len(fields) < nfields:
+                break  # incomplete tuple, wait for the next chunk
+            if fields[0] is not None and fields[1] is not None:
+                self._row(buf, fields)
+            pos = p
+        del buf[:pos]
+
+    def result(self):
+        """Returns (visitor_ids, (N, dim) float32 matrix, newest inserted_at)."""
+        return self.ids, self.matrix[:len(self.ids)], self.newest
@@ -0,0 +1,147 @@
+import cv2
+import numpy as np
+
+
+# Laplacian variance is measured on a fixed-size grayscale thumbnail, so the
+# blur score costs the same for every face and doesn't depend on its size.
+BLUR_THUMBNAIL_SIZE = 64
+
+
+def crop_quality(crop, confidence=None, min_face_size=40, good_face_size=96, blur_reference=100.0):
+    """
+    Cheap quality score in [0, 1] for a face crop, used to decide whether it
+    is worth an embedding. Product of four factors:
+      size       - shorter side relative to good_face_size (0 below min_face_size)
+      sharpness  - Laplacian variance relative to blur_reference
+      aspect     - 1 for roughly face-shaped boxes (w/h in 0.6-1.1), lower otherwise
+      confidence - the detector's box confidence
+    """
+    if crop is None or crop.size == 0:
+        return 0.0
+    h, w = crop.shape[:2]
+    short_side = min(h, w)
+    if short_side < min_face_size:
+        return 0.0
+    size_score = min(1.0, short_side / float(good_face_size))
+
+    aspect = w / float(h)
+    if 0.6 <= aspect <= 1.1:
+        aspect_score = 1.0
+    else:
+        # Profile faces and partial boxes are tall and thin (or wide and flat)
+        off = 0.6 / aspect if aspect < 0.6 else aspect / 1.1
+        aspect_score = 1.0 / off
+
+    gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY) if crop.ndim == 3 else crop
+    thumb = cv2.resize(gray, (BLUR_THUMBNAIL_SIZE, BLUR_THUMBNAIL_SIZE), interpolation=cv2.INTER_AREA)
+    sharpness = cv2.Laplacian(thumb, cv2.CV_32F).var()
+    blur_score = min(1.0, float(sharpness) / blur_reference)
+
+    conf_score = 1.0 if confidence is None else float(np.clip(confidence, 0.0, 1.0))
+    return size_score * aspect_score * blur_score * conf_score
+
+
+class EmbeddingScheduler:
+    """
+    Decides which unidentified tracks get an embedding attempt this frame.
+
+    Every candidate crop is scored with crop_quality(). Crops under
+    embed_min_quality are skipped without embedding. A track whose
+    embedding failed waits embed_retry_base_seconds before its next attempt,
+    doubling after each failure up to embed_retry_max_seconds. At most
+    embed_max_per_frame tracks (best quality first) are embedded per frame.
+    After a successful embedding the track waits embed_sample_interval_seconds
+    before its next sample (see VisitorTracker's multi-frame aggregation).
+    """
+    def __init__(self, config):
+        self.min_quality = config.get('embed_min_quality', 0.35)
+        self.max_per_frame = config.get('embed_max_per_frame', 8)
+        self.retry_base = config.get('embed_retry_base_seconds', 0.25)
+        self.retry_max = config.get('embed_retry_max_seconds', 4.0)
+        self.sample_interval = config.get('embed_sample_interval_seconds', 0.1)
+        self.min_face_size = config.get('embed_min_face_size', 40)
+        self.good_face_size = config.get('embed_good_face_size', 96)
+        self.blur_reference = config.get('embed_blur_reference', 100.0)
+
+        # {track_id: {'first_seen': datetime, 'failures': int, 'next_attempt': float}}
+        self._tracks = {}
+
+        # Counters
+        self.skipped_quality = 0
+        self.skipped_backoff = 0
+        self.skipped_cap = 0
+        self.attempted = 0
+        self.succeeded = 0
+        self.failed = 0
+
+    def first_seen(self, track_id, now_dt):
+        """When the track was first offered to the scheduler (used to stamp its entry)."""
+        return self._tracks.setdefault(track_id, {'first_seen': now_dt, 'failures': 0,
+                                                  'next_attempt': 0.0})['first_seen']
+
+    def select(self, candidates, now, now_dt, limit=None):
+        """
+        `candidates` are (track_id, crop, kps, confidence) tuples for tracks
+        without an identity. Returns the ones to embed now, best first,
+        as (track_id, crop, kps, quality). `limit` tightens max_per_frame
+        for this call (0 embeds nothing; the tracks stay candidates).
+        """
+        ready = []
+        for track_id, crop, kps, confidence in candidates:
+            state = self._tracks.setdefault(track_id, {'first_seen': now_dt, 'failures': 0,
+                                                       'next_attempt': 0.0})
+            if now < state['next_attempt']:
+                self.skipped_backoff += 1
+                continue
+            quality = crop_quality(crop, confidence, self.min_face_size, self.good_face_size,
+                                   self.blur_reference)
+            if quality < self.min_quality:
+                self.skipped_quality += 1
+                continue
+            ready.append((track_id, crop, kps, quality))
+
+        ready.sort(key=lambda c: c[3], reverse=True)
+        cap = self.max_per_frame or None
+        if limit is not None:
+            cap = limit if cap is None else min(cap, limit)
+        if cap is not None and len(ready) > cap:
+            self.skipped_cap += len(ready) - cap
+            ready = ready[:cap]
+        self.attempted += len(ready)
+        return ready
+
+    def record_success(self, track_id, now):
+        self.succeeded += 1
+        state = self._tracks.get(track_id)
+        if state is not None:
+            state['failures'] = 0
+            state['next_attempt'] = now + self.sample_interval
+
+    def finish(self, track_id):
+        """The track's identity is committed; it is no longer scheduled."""
+        self._tracks.pop(track_id, None)
+
+    def record_failure(self, track_id, now):
+        self.failed += 1
+        state = self._tracks.get(track_id)
+        if state is None:
+            return
+        delay = min(self.retry_max, self.retry_base * (2 ** state['failures']))
+        state['failures'] += 1
+        state['next_attempt'] = now + delay
+
+    def retain(self, track_ids):
+        """Drops scheduling state for every track not in `track_ids` (tracks that are gone)."""
+        for track_id in [t for t in self._tracks if t not in track_ids]:
+            del self._tracks[track_id]
+
+    def stats(self):
+        return {
+            'waiting_tracks': len(self._tracks),
+            'skipped_quality': self.skipped_quality,
+            'skipped_backoff': self.skipped_backoff,
+            'skipped_cap': self.skipped_cap,
+            'attempted': self.attempted,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+        }
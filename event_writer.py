@@ -0,0 +1,306 @@
+import base64
+import contextlib
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+import numpy as np
+import psycopg
+import database
+
+
+class _JournaledOutage(Exception):
+    """The connection dropped mid-batch; the unwritten rows are already in the journal."""
+
+
+class EventWriter:
+    """
+    Write-behind writer for Visitors and Events rows.
+
+    The frame loop only enqueues rows. A background thread, on its own DB
+    connection, writes them with COPY and commits once per group: when
+    `event_batch_size` rows are queued or `event_flush_seconds` have passed
+    since the first unflushed row.
+
+    visitor_id is generated client-side (uuid4), so register_visitor() can
+    return it straight away. Visitors are always written before Events in
+    the same transaction, so the foreign key holds.
+
+    If the database is unreachable, the batch is appended to a local
+    append-only journal (JSON lines). The journal is replayed ahead of new
+    rows once the connection is back, and also on the next start.
+
+    Producers never block for good: if the writer thread has died, rows are
+    counted as dropped instead of waiting on a full queue.
+    """
+    def __init__(self, config, pool=None):
+        self.config = config
+        # Borrow connections from a database.get_db_pool() pool when given,
+        # otherwise keep a dedicated connection.
+        self.pool = pool
+        self.batch_size = config.get('event_batch_size', 200)
+        self.flush_interval = config.get('event_flush_seconds', 1.0)
+        self.storage = config.get('embedding_storage', 'vector')
+        self.journal_path = config.get('event_journal_path', 'logs/event_journal.jsonl')
+        self.reconnect_interval = config.get('event_reconnect_seconds', 5.0)
+
+        self._queue = queue.Queue(maxsize=config.get('event_queue_size', 10000))
+        self._conn = None
+        self._last_connect_attempt = 0.0
+        self._stop = threading.Event()
+        self._flush_requested = threading.Event()
+        self._flushed = threading.Event()
+
+        # Stats
+        self.rows_written = 0
+        self.commits = 0
+        self.rows_journaled = 0
+        self.rows_dropped = 0
+        self._dead_reported = False
+
+        journal_dir = os.path.dirname(self.journal_path)
+        if journal_dir:
+            os.makedirs(journal_dir, exist_ok=True)
+        # Rows left over from a previous outage are replayed first
+        self._journal_pending = os.path.exists(self.journal_path)
+
+        self._thread = threading.Thread(target=self._run, name="event-writer", daemon=True)
+        self._thread.start()
+
+    # --- Producer API (called from the frame loop) ------------------------
+
+    def register_visitor(self, embedding, timestamp=None):
+        """Queues a new visitor and returns its visitor_id immediately."""
+        visitor_id = uuid.uuid4()
+        self._put(('visitor', (visitor_id, np.asarray(embedding, dtype=np.float32),
+                               timestamp or datetime.datetime.now(datetime.timezone.utc))))
+        return visitor_id
+
+    def log_event(self, visitor_id, event_type, image_path, timestamp=None):
+        """Queues an 'entry' or 'exit' event."""
+        self._put(('event', (visitor_id, event_type, image_path,
+                             timestamp or datetime.datetime.now(datetime.timezone.utc))))
+
+    def _put(self, item):
+        # Waits for room while the writer is alive; a dead writer would
+        # otherwise block the frame loop forever once the queue is full.
+        while self._thread.is_alive():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+        self.rows_dropped += 1
+        if not self._dead_reported:
+            self._dead_reported = True
+            print("Event writer: writer thread is not running; rows are being dropped")
+
+    def flush(self, timeout=None):
+        """Blocks until everything queued so far has been written or journaled."""
+        self._flushed.clear()
+        self._flush_requested.set()
+        return self._flushed.wait(timeout)
+
+    def close(self, timeout=30.0):
+        """Flushes remaining rows and stops the writer thread."""
+        self._stop.set()
+        self._thread.join(timeout)
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'rows_written': self.rows_written,
+            'commits': self.commits,
+            'rows_journaled': self.rows_journaled,
+            'rows_dropped': self.rows_dropped,
+        }
+
+    # --- Writer thread ----------------------------------------------------
+
+    def _run(self):
+        batch = []
+        first_at = None
+        while True:
+            stopping = self._stop.is_set()
+            try:
+                item = self._queue.get(timeout=0.05)
+                batch.append(item)
+                first_at = first_at or time.time()
+                # Drain whatever else is already waiting
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            journal_retry = (self._journal_pending
+                             and time.time() - self._last_connect_attempt >= self.reconnect_interval)
+            due = (len(batch) >= self.batch_size
+                   or (first_at is not None and time.time() - first_at >= self.flush_interval)
+                   or self._flush_requested.is_set()
+                   or journal_retry
+                   or stopping)
+            if due:
+                if batch or self._journal_pending:
+                    self._write_or_journal(batch)
+                batch, first_at = [], None
+                if self._flush_requested.is_set() and self._queue.empty():
+                    self._flush_requested.clear()
+                    self._flushed.set()
+                if stopping and self._queue.empty():
+                    return
+
+    def _write_or_journal(self, batch):
+        """_write() that never raises, so one bad batch can't stop the writer thread."""
+        try:
+            self._write(batch)
+        except Exception as e:
+            print(f"Event writer: write failed ({e}); journaling {len(batch)} rows")
+            try:
+                self._append_journal(batch)
+            except Exception as e:
+                # e.g. disk full: these rows are lost, but the queue keeps draining
+                print(f"Event writer: cannot journal ({e}); dropping {len(batch)} rows")
+                self.rows_dropped += len(batch)
+
+    def _connection(self):
+        if self._conn is not None and not self._conn.closed:
+            return self._conn
+        if time.time() - self._last_connect_attempt < self.reconnect_interval:
+            return None
+        self._last_connect_attempt = time.time()
+        self._conn = database.get_db_connection(self.config)
+        return self._conn
+
+    @contextlib.contextmanager
+    def _borrow(self):
+        if self.pool is not None:
+            with self.pool.connection() as conn:
+                yield conn
+        else:
+            yield self._connection()
+
+    def _write(self, batch):
+        try:
+            with self._borrow() as conn:
+                if conn is None:
+                    self._append_journal(batch)
+                    return
+                self._write_items(conn, batch)
+        except _JournaledOutage as e:
+            print(f"Event writer: database unavailable ({e}); remaining rows journaled")
+            self._conn = None
+            self._last_connect_attempt = time.time()
+        except psycopg.OperationalError as e:
+            # Outage (including pool timeouts): keep the rows on disk and retry later
+            print(f"Event writer: database unavailable ({e}); journaling {len(batch)} rows")
+            self._conn = None
+            self._last_connect_attempt = time.time()
+            self._append_journal(batch)
+
+    def _write_items(self, conn, batch):
+        journaled = self._read_journal() if self._journal_pending else []
+        items = journaled + batch
+        if not items:
+            return
+
+        visitors = [row for kind, row in items if kind == 'visitor']
+        events = [row for kind, row in items if kind == 'event']
+        try:
+            database.copy_visitors(conn, visitors, storage=self.storage)
+            database.copy_events(conn, events)
+            conn.commit()
+        except psycopg.OperationalError:
+            self._safe_rollback(conn)
+            raise
+        except Exception as e:
+            # A bad row (or a replayed row that already made it) fails the
+            # whole COPY. Fall back to row-by-row so only that row is lost.
+            print(f"Event writer: batch write failed ({e}); retrying row by row")
+            self._safe_rollback(conn)
+            self._write_rows_individually(conn, visitors, events)
+
+        self.rows_written += len(items)
+        self.commits += 1
+        if journaled:
+            os.remove(self.journal_path)
+            self._journal_pending = False
+
+    def _write_rows_individually(self, conn, visitors, events):
+        items = [('visitor', row) for row in visitors] + [('event', row) for row in events]
+        for i, (kind, row) in enumerate(items):
+            try:
+                if kind == 'visitor':
+                    database.copy_visitors(conn, [row], storage=self.storage)
+                else:
+                    database.copy_events(conn, [row])
+                conn.commit()
+            except psycopg.OperationalError as e:
+                # Outage mid-fallback: the journal is replaced by the rows not
+                # written yet (replayed journal rows included), nothing is dropped.
+                self._safe_rollback(conn)
+                self._replace_journal(items[i:])
+                raise _JournaledOutage(e) from e
+            except Exception as e:
+                print(f"Event writer: dropping row for {row[0]}: {e}")
+                self._safe_rollback(conn)
+
+    @staticmethod
+    def _safe_rollback(conn):
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+
+    # --- Journal ----------------------------------------------------------
+
+    def _append_journal(self, batch, path=None):
+        if not batch:
+            return
+        with open(path or self.journal_path, 'a', encoding='utf-8') as f:
+            for kind, row in batch:
+                if kind == 'visitor':
+                    visitor_id, embedding, ts = row
+                    record = {'kind': kind, 'visitor_id': str(visitor_id), 'ts': ts.isoformat(),
+                              'embedding': base64.b64encode(embedding.astype('<f4').tobytes()).decode('ascii')}
+                else:
+                    visitor_id, event_type, image_path, ts = row
+                    record = {'kind': kind, 'visitor_id': str(visitor_id), 'ts': ts.isoformat(),
+                              'event_type': event_type, 'image_path': image_path}
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.rows_journaled += len(batch)
+        self._journal_pending = True
+
+    def _replace_journal(self, items):
+        """Atomically replaces the journal with `items`."""
+        tmp_path = self.journal_path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        self._append_journal(items, path=tmp_path)
+        os.replace(tmp_path, self.journal_path)
+
+    def _read_journal(self):
+        if not os.path.exists(self.journal_path):
+            return []
+        items = []
+        with open(self.journal_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # torn last line
+                visitor_id = uuid.UUID(record['visitor_id'])
+                ts = datetime.datetime.fromisoformat(record['ts'])
+                if record['kind'] == 'visitor':
+                    embedding = np.frombuffer(base64.b64decode(record['embedding']), dtype='<f4')
+                    items.append(('visitor', (visitor_id, embedding, ts)))
+                else:
+                    items.append(('event', (visitor_id, record['event_type'], record['image_path'], ts)))
+        return items
@@ -1,40 +1,144 @@
+import glob
+import os
 import insightface
+from insightface.utils import ensure_available, face_align
 import numpy as np
 import cv2
 
 
+ARCFACE_INPUT_SIZE = 112
+EMBEDDING_DIM = 512
+
+
 class FaceEmbedder:
     """
-    Wrapper class for the InsightFace FaceAnalysis model.
+    Wrapper class for the InsightFace recognition (ArcFace) model.
+
+    mode='aligned' (default): the YOLO face crop is aligned to the ArcFace
+        template (with the detector's 5 keypoints when available, otherwise
+        by padding to a square) and fed straight into the recognition ONNX
+        model. No second face detection is run.
+    mode='detect': legacy behaviour. The crop goes through
+        FaceAnalysis.get, which re-runs RetinaFace at det_size=(640, 640).
     """
-    def __init__(self, model_root='models', use_gpu=False, model_name='buffalo_l'):
+    def __init__(self, model_root='models', use_gpu=False, model_name='buffalo_l', mode='aligned',
+                 max_batch_size=32):
         print("Loading InsightFace model... This may take a moment.")
-        # Build FaceAnalysis app
+        self.mode = mode
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.app = None
+        self.rec_model = None
+        # ctx_id = 0 for GPU; -1 for CPU. Default to CPU unless use_gpu=True
+        ctx_id = 0 if use_gpu else -1
         try:
-            self.app = insightface.app.FaceAnalysis(name=model_name, root=model_root)
-            # ctx_id = 0 for GPU; -1 for CPU. Default to CPU unless use_gpu=True
-            ctx_id = 0 if use_gpu else -1
-            self.app.prepare(ctx_id=ctx_id, det_size=(640, 640))
-            print("InsightFace model loaded.")
+            if mode == 'detect':
+                # Build FaceAnalysis app
+                self.app = insightface.app.FaceAnalysis(name=model_name, root=model_root)
+                self.app.prepare(ctx_id=ctx_id, det_size=(640, 640))
+            elif mode == 'aligned':
+                self.rec_model = self._load_recognition_model(model_root, model_name)
+                self.rec_model.prepare(ctx_id=ctx_id)
+            else:
+                raise ValueError(f"Unknown embedding mode: {mode}")
+            print(f"InsightFace model loaded ({mode}).")
         except Exception as e:
             print(f"Failed to initialize InsightFace: {e}")
             raise
 
-    def get_embedding(self, cropped_face_img):
+    @staticmethod
+    def _load_recognition_model(model_root, model_name):
+        """Loads only the recognition model of a model pack (e.g. buffalo_l/w600k_r50.onnx)."""
+        model_dir = ensure_available('models', model_name, root=model_root)
+        for onnx_file in sorted(glob.glob(os.path.join(model_dir, '*.onnx'))):
+            model = insightface.model_zoo.get_model(onnx_file)
+            if model is not None and getattr(model, 'taskname', None) == 'recognition':
+                return model
+        raise FileNotFoundError(f"No recognition model found in {model_dir}")
+
+    @staticmethod
+    def align_crop(cropped_face_img, kps=None):
         """
-        Generates a 512-dimension embedding for a single cropped face image.
+        Returns a 112x112 BGR face aligned for ArcFace.
+        `kps` are the 5 facial keypoints (eyes, nose, mouth corners) in crop
+        coordinates, as produced by YOLO-face models.
+        """
+        if kps is not None:
+            kps = np.asarray(kps, dtype=np.float32).reshape(-1, 2)
+            # Keypoints that were not detected come back as (0, 0)
+            if kps.shape[0] == 5 and np.all(kps > 0):
+                return face_align.norm_crop(cropped_face_img, landmark=kps, image_size=ARCFACE_INPUT_SIZE)
+
+        # Fallback: pad the box to a square around its centre and resize
+        h, w = cropped_face_img.shape[:2]
+        side = max(h, w)
+        top = (side - h) // 2
+        left = (side - w) // 2
+        square = cv2.copyMakeBorder(cropped_face_img, top, side - h - top, left, side - w - left,
+                                    cv2.BORDER_REPLICATE)
+        return cv2.resize(square, (ARCFACE_INPUT_SIZE, ARCFACE_INPUT_SIZE), interpolation=cv2.INTER_LINEAR)
 
+    def get_embedding(self, cropped_face_img, kps=None):
         """
-        try:
-            # FaceAnalysis.get returns a list of Face objects
-            faces = self.app.get(cropped_face_img)
+        Generates a 512-dimension, L2-normalized embedding for a single
+        cropped face image, or None on failure.
+        `kps` (optional) are the detector's 5 keypoints in crop coordinates.
+        """
+        embeddings, ok = self.get_embeddings([cropped_face_img], [kps])
+        return embeddings[0] if ok[0] else None
 
-            if faces and len(faces) > 0:
-                # Return the embedding of the first face
-                first_face = faces[0]
-                return first_face.embedding
-            else:
-                return None
-        except Exception as e:
-            print(f"Error during embedding generation: {e}")
-            return None
\ No newline at end of file
+    def get_embeddings(self, crops, kps_list=None):
+        """
+        Embeds several face crops with a single inference per batch.
+
+        Returns (embeddings, ok): an (N, 512) float32 array of L2-normalized
+        embeddings and an (N,) bool mask. Rows where ok is False (empty crop,
+        alignment error, no face in 'detect' mode) are all zeros.
+        """
+        n = len(crops)
+        embeddings = np.zeros((n, EMBEDDING_DIM), dtype=np.float32)
+        ok = np.zeros(n, dtype=bool)
+        if n == 0:
+            return embeddings, ok
+        if kps_list is None:
+            kps_list = [None] * n
+
+        if self.mode == 'aligned':
+            aligned, rows = [], []
+            for i, (crop, kps) in enumerate(zip(crops, kps_list)):
+                if crop is None or crop.size == 0:
+                    continue
+                try:
+                    aligned.append(self.align_crop(crop, kps))
+                    rows.append(i)
+                except Exception as e:
+                    print(f"Error aligning face crop: {e}")
+
+            # get_feat stacks the aligned faces into one contiguous NCHW blob
+            for start in range(0, len(aligned), self.max_batch_size):
+                chunk_rows = rows[start:start + self.max_batch_size]
+                try:
+                    feats = self.rec_model.get_feat(aligned[start:start + self.max_batch_size])
+                except Exception as e:
+                    print(f"Error during embedding generation: {e}")
+                    continue
+                embeddings[chunk_rows] = feats
+                ok[chunk_rows] = True
+        else:
+            for i, crop in enumerate(crops):
+                if crop is None or crop.size == 0:
+                    continue
+                try:
+                    # FaceAnalysis.get returns a list of Face objects
+                    faces = self.app.get(crop)
+                except Exception as e:
+                    print(f"Error during embedding generation: {e}")
+                    continue
+                if faces:
+                    # Use the embedding of the first face
+                    embeddings[i] = faces[0].embedding
+                    ok[i] = True
+
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        ok &= norms[:, 0] > 0
+        np.divide(embeddings, norms, out=embeddings, where=norms > 0)
+        return embeddings, ok
@@ -0,0 +1,179 @@
+import datetime
+import time
+import numpy as np
+import database
+
+
+class VisitorGallery:
+    """
+    In-process visitor gallery: every registered visitor's L2-normalized
+    embedding in one contiguous float32 matrix, searched with a single
+    matrix-vector product. Replaces the per-track SQL similarity query.
+
+    Rows are appended in place when a visitor is registered, and sync()
+    pulls visitors registered by other processes (e.g. other cameras) so
+    that all workers keep sharing one identity store.
+    """
+    # Syncs read by Visitors.inserted_at, stamped by the server when the row
+    # is written (a journal replay can't backdate it, unlike first_seen). It
+    # is the inserting transaction's start time, so a transaction that began
+    # before our last sync can still add older stamps: every sync re-reads a
+    # small window.
+    SYNC_OVERLAP = datetime.timedelta(seconds=60)
+
+    def __init__(self, dim=512, initial_capacity=1024):
+        self.dim = dim
+        self._matrix = np.zeros((max(1, initial_capacity), dim), dtype=np.float32)
+        self._ids = []
+        self._known = set()
+        self._size = 0
+        self.last_seen_watermark = None  # max inserted_at loaded from the DB
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def matrix(self):
+        """(N, dim) view of the stored embeddings."""
+        return self._matrix[:self._size]
+
+    def _reserve(self, extra):
+        needed = self._size + extra
+        if needed <= self._matrix.shape[0]:
+            return
+        capacity = self._matrix.shape[0]
+        while capacity < needed:
+            capacity *= 2
+        grown = np.zeros((capacity, self.dim), dtype=np.float32)
+        grown[:self._size] = self._matrix[:self._size]
+        self._matrix = grown
+
+    @staticmethod
+    def _normalize(embedding):
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm > 0 else embedding
+
+    def add(self, visitor_id, embedding):
+        """Appends one visitor. Ignored if the visitor is already in the gallery."""
+        if visitor_id in self._known:
+            return
+        self._reserve(1)
+        self._matrix[self._size] = self._normalize(embedding)
+        self._ids.append(visitor_id)
+        self._known.add(visitor_id)
+        self._size += 1
+
+    def add_many(self, visitor_ids, embeddings):
+        """Appends a block of visitors; `embeddings` is an (N, dim) array."""
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        keep = [i for i, vid in enumerate(visitor_ids) if vid not in self._known]
+        if not keep:
+            return
+        block = embeddings[keep]
+        norms = np.linalg.norm(block, axis=1, keepdims=True)
+        np.divide(block, norms, out=block, where=norms > 0)
+
+        self._reserve(len(keep))
+        self._matrix[self._size:self._size + len(keep)] = block
+        for i in keep:
+            self._ids.append(visitor_ids[i])
+            self._known.add(visitor_ids[i])
+        self._size += len(keep)
+
+    def search(self, embedding, k=1):
+        """
+        Returns up to k (visitor_id, similarity) pairs, best first.
+        Similarity is cosine similarity (1=identical, -1=opposite).
+        """
+        if self._size == 0:
+            return []
+        sims = self.matrix @ self._normalize(embedding)
+        k = min(k, self._size)
+        if k == 1:
+            best = int(np.argmax(sims))
+            return [(self._ids[best], float(sims[best]))]
+        top = np.argpartition(-sims, k - 1)[:k]
+        top = top[np.argsort(-sims[top])]
+        return [(self._ids[i], float(sims[i])) for i in top]
+
+    def match(self, embedding, threshold):
+        """
+        Same contract as database.find_visitor:
+        returns (visitor_id, similarity_score) or (None, 0).
+        """
+        hits = self.search(embedding, k=1)
+        if hits and hits[0][1] >= threshold:
+            return hits[0]
+        return None, 0
+
+    def merge_rows(self, rows):
+        """Adds [(visitor_id, embedding, inserted_at), ...] rows. Returns the number added."""
+        if not rows:
+            return 0
+        before = self._size
+        self.add_many([r[0] for r in rows], np.stack([r[1] for r in rows]))
+        stamps = [r[2] for r in rows if r[2] is not None]
+        if stamps and (self.last_seen_watermark is None or max(stamps) > self.last_seen_watermark):
+            self.last_seen_watermark = max(stamps)
+        return self._size - before
+
+    def merge_matrix(self, visitor_ids, embeddings, newest=None):
+        """Adds the output of database.load_embedding_matrix. Returns the number added."""
+        before = self._size
+        if self._size == 0 and len(set(visitor_ids)) == len(visitor_ids) > 0:
+            # Initial load: adopt the loader's matrix instead of copying it
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            np.divide(embeddings, norms, out=embeddings, where=norms > 0)
+            self._matrix = embeddings
+            self._ids = list(visitor_ids)
+            self._known = set(visitor_ids)
+            self._size = len(visitor_ids)
+        elif visitor_ids:
+            self.add_many(visitor_ids, embeddings)
+        if newest is not None and (self.last_seen_watermark is None or newest > self.last_seen_watermark):
+            self.last_seen_watermark = newest
+        return self._size - before
+
+    def load_from_db(self, conn):
+        """Loads every visitor in the Visitors table. Returns the number added."""
+        return self.merge_matrix(*database.load_embedding_matrix(conn, dim=self.dim))
+
+    def sync_cutoff(self):
+        """inserted_at from which the next sync should read (None = everything)."""
+        if self.last_seen_watermark is None:
+            return None
+        return self.last_seen_watermark - self.SYNC_OVERLAP
+
+    def sync(self, conn):
+        """Pulls visitors registered since the last load. Returns the number added."""
+        return self.merge_matrix(*database.load_embedding_matrix(conn, since=self.sync_cutoff(), dim=self.dim))
+
+    @classmethod
+    def from_db(cls, conn, dim=512):
+        started = time.time()
+        gallery = cls(dim=dim)
+        count = gallery.load_from_db(conn)
+        print(f"Visitor gallery loaded: {count} visitors in {time.time() - started:.2f}s")
+        return gallery
+
+
+def open_identity_store(config, conn):
+    """
+    Builds the identity search backend selected by `identity_backend`:
+      'memory' - VisitorGallery, exact search over all embeddings in RAM
+      'ann'    - ann_index.IVFIndex, memory-mapped approximate index on disk
+      'sql'    - None; VisitorTracker falls back to database.find_visitor
+    """
+    backend = config.get('identity_backend', 'memory')
+    if backend in ('memory', 'ann'):
+        database.ensure_sync_column(conn)
+    if backend == 'memory':
+        return VisitorGallery.from_db(conn)
+    if backend == 'ann':
+        import ann_index
+        return ann_index.IVFIndex.open_or_build(conn, config.get('ann_index_dir', 'index/visitors'),
+                                                nprobe=config.get('ann_nprobe', 16))
+    if backend == 'sql':
+        return None
+    raise ValueError(f"Unknown identity_backend: {backend}")
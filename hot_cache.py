@@ -0,0 +1,107 @@
+import collections
+import time
+import numpy as np
+
+
+class TierStats:
+    """Lookup counters and latency for one identity search tier."""
+    def __init__(self):
+        self.lookups = 0
+        self.hits = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, hit, seconds):
+        self.lookups += 1
+        self.hits += bool(hit)
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def summary(self):
+        return {
+            'lookups': self.lookups,
+            'hits': self.hits,
+            'hit_rate': self.hits / self.lookups if self.lookups else 0.0,
+            'mean_ms': 1000.0 * self.total_seconds / self.lookups if self.lookups else 0.0,
+            'max_ms': 1000.0 * self.max_seconds,
+        }
+
+
+class HotVisitorCache:
+    """
+    Small re-identification tier for visitors seen in the last few minutes
+    (in frame, in pending_exit, or recently gone), checked before the
+    global gallery/index.
+
+    Embeddings sit in a fixed (capacity, dim) float32 matrix and are
+    compared with one matrix-vector product. Entries expire ttl seconds
+    after the visitor was last seen; when the cache is full the least
+    recently seen visitor is evicted.
+    """
+    def __init__(self, dim=512, capacity=256, ttl=300.0):
+        self.dim = dim
+        self.capacity = max(1, int(capacity))
+        self.ttl = ttl
+        self._matrix = np.zeros((self.capacity, dim), dtype=np.float32)
+        self._last_seen = np.full(self.capacity, -np.inf)
+        self._ids = [None] * self.capacity
+        self._slots = collections.OrderedDict()  # visitor_id -> slot, least recently seen first
+        self._free = list(range(self.capacity - 1, -1, -1))
+
+    def __len__(self):
+        return len(self._slots)
+
+    def put(self, visitor_id, embedding, now=None):
+        """Inserts or refreshes a visitor with its latest embedding."""
+        now = time.time() if now is None else now
+        slot = self._slots.get(visitor_id)
+        if slot is None:
+            if not self._free:
+                _, evicted = self._slots.popitem(last=False)
+                self._ids[evicted] = None
+                self._free.append(evicted)
+            slot = self._free.pop()
+            self._slots[visitor_id] = slot
+            self._ids[slot] = visitor_id
+        else:
+            self._slots.move_to_end(visitor_id)
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(embedding)
+        self._matrix[slot] = embedding / norm if norm > 0 else embedding
+        self._last_seen[slot] = now
+
+    def touch(self, visitor_id, now=None):
+        """Marks a cached visitor as seen now (e.g. still in frame)."""
+        slot = self._slots.get(visitor_id)
+        if slot is not None:
+            self._slots.move_to_end(visitor_id)
+            self._last_seen[slot] = time.time() if now is None else now
+
+    def expire(self, now=None):
+        """Drops visitors not seen within ttl seconds."""
+        cutoff = (time.time() if now is None else now) - self.ttl
+        while self._slots:
+            visitor_id, slot = next(iter(self._slots.items()))
+            if self._last_seen[slot] >= cutoff:
+                break
+            del self._slots[visitor_id]
+            self._ids[slot] = None
+            self._last_seen[slot] = -np.inf
+            self._free.append(slot)
+
+    def match(self, embedding, threshold, now=None):
+        """
+        Same contract as database.find_visitor:
+        returns (visitor_id, similarity_score) or (None, 0).
+        """
+        self.expire(now)
+        if not self._slots:
+            return None, 0
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(embedding)
+        sims = self._matrix @ (embedding / norm if norm > 0 else embedding)
+        sims[np.isinf(self._last_seen)] = -np.inf  # free slots
+        best = int(np.argmax(sims))
+        if sims[best] >= threshold:
+            return self._ids[best], float(sims[best])
+        return None, 0
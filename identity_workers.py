@@ -0,0 +1,165 @@
+import concurrent.futures
+import concurrent.futures.process
+import multiprocessing
+import weakref
+import numpy as np
+import database
+import face_embedder
+
+
+# Per-process state, set up once by _init_worker
+_embedder = None
+_conn = None
+_threshold = 0.6
+
+
+def _init_worker(config):
+    """Loads one FaceEmbedder (and, for the SQL backend, one DB connection) per process."""
+    global _embedder, _conn, _threshold
+    _embedder = face_embedder.FaceEmbedder(use_gpu=config.get('use_gpu', False),
+                                           mode=config.get('embedding_mode', 'aligned'),
+                                           max_batch_size=config.get('embedding_batch_size', 32))
+    _threshold = config.get('similarity_threshold', 0.6)
+    if config.get('identity_backend', 'memory') == 'sql':
+        _conn = database.get_db_connection(config)
+
+
+def _resolve_batch(crops, kps_list):
+    """
+    Runs in a worker process. Embeds the crops in one batch and, when the
+    worker has its own DB connection, also runs the SQL identity lookup.
+    Returns (embeddings, ok, matches); matches is None without a connection.
+    """
+    embeddings, ok = _embedder.get_embeddings(crops, kps_list)
+    matches = None
+    if _conn is not None:
+        matches = [database.find_visitor(_conn, emb, _threshold) if valid else (None, 0)
+                   for emb, valid in zip(embeddings, ok)]
+    return embeddings, ok, matches
+
+
+class IdentityWorkerPool:
+    """
+    Process pool that embeds new tracks off the frame loop, so ONNX
+    inference runs in parallel on several cores while the main loop keeps
+    detecting.
+
+    submit() splits a frame's new crops across the workers and returns one
+    concurrent.futures.Future per chunk; VisitorTracker polls them with
+    done() on later frames. With identity_backend 'sql' the workers also run
+    database.find_visitor on their own connections. Registration stays in
+    the main process so the gallery has a single writer.
+
+    If a worker process dies (OOM, a crash in the ONNX runtime) the whole
+    executor is broken. It is recreated up to embedding_worker_restarts
+    times; after that the crops are embedded in-process (slower, but
+    identification keeps going).
+    """
+    def __init__(self, config):
+        self.config = config
+        self.workers = max(1, int(config.get('embedding_workers', 2)))
+        # Crowd surges queue at most this many chunks; the rest wait for a later frame
+        self.max_in_flight = config.get('embedding_max_in_flight', self.workers * 2)
+        self.max_restarts = config.get('embedding_worker_restarts', 3)
+        self._executor = self._new_executor()
+        self._generation = 0  # bumped on every restart
+        self._generation_of = weakref.WeakKeyDictionary()  # future -> generation it was submitted to
+        self._in_flight = set()
+
+        # Stats
+        self.batches_submitted = 0
+        self.crops_submitted = 0
+        self.restarts = 0
+        self.in_process = False
+
+    def _new_executor(self):
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(self.config,))
+
+    def _restart(self, error):
+        """Replaces a broken executor, or switches to in-process embedding once out of restarts."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._in_flight = set()
+        self._generation += 1
+        if self.restarts < self.max_restarts:
+            self.restarts += 1
+            print(f"Identity workers: pool broken ({error}); restarting ({self.restarts}/{self.max_restarts})")
+            self._executor = self._new_executor()
+            return
+        print(f"Identity workers: pool broken ({error}); embedding in-process from now on")
+        _init_worker(self.config)
+        self.in_process = True
+
+    def failed(self, future, error):
+        """
+        Called by the consumer when a future raised. A BrokenProcessPool from
+        the current executor restarts it; futures of an executor already
+        replaced are ignored.
+        """
+        if not isinstance(error, concurrent.futures.process.BrokenProcessPool):
+            return
+        if not self.in_process and self._generation_of.get(future) == self._generation:
+            self._restart(error)
+
+    def capacity(self):
+        """Number of chunks that can be submitted right now."""
+        self._in_flight = {f for f in self._in_flight if not f.done()}
+        return max(0, self.max_in_flight - len(self._in_flight))
+
+    def submit(self, crops, kps_list):
+        """
+        Queues crops for embedding. Returns [(future, start, stop), ...]:
+        each future resolves to _resolve_batch's result for crops[start:stop].
+        Crops are copied (pickled) to the workers, so frame buffers can be reused.
+        """
+        if not crops:
+            return []
+        if self.in_process:
+            return [(self._resolve_here(crops, kps_list), 0, len(crops))]
+        chunks = min(len(crops), self.workers, max(1, self.capacity()))
+        size = -(-len(crops) // chunks)
+        submitted = []
+        for start in range(0, len(crops), size):
+            stop = min(start + size, len(crops))
+            future = self._submit_chunk([np.ascontiguousarray(c) for c in crops[start:stop]],
+                                        kps_list[start:stop])
+            self._generation_of[future] = self._generation
+            self._in_flight.add(future)
+            submitted.append((future, start, stop))
+            self.batches_submitted += 1
+            self.crops_submitted += stop - start
+        return submitted
+
+    def _submit_chunk(self, crops, kps_list):
+        while not self.in_process:
+            try:
+                return self._executor.submit(_resolve_batch, crops, kps_list)
+            except concurrent.futures.process.BrokenProcessPool as e:
+                self._restart(e)
+        return self._resolve_here(crops, kps_list)
+
+    @staticmethod
+    def _resolve_here(crops, kps_list):
+        """Runs _resolve_batch in this process; returns an already finished future."""
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(_resolve_batch(crops, kps_list))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'in_flight': len(self._in_flight),
+            'batches_submitted': self.batches_submitted,
+            'crops_submitted': self.crops_submitted,
+            'restarts': self.restarts,
+            'in_process': self.in_process,
+        }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)
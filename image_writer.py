@@ -0,0 +1,150 @@
+import datetime
+import os
+import queue
+import threading
+import cv2
+
+import crop_pack
+import metrics
+
+
+class ImageWriter:
+    """
+    Background JPEG writer for entry/exit crops.
+
+    save() picks the file path, queues the crop and returns the path right
+    away; a small pool of threads does the makedirs + imwrite (cv2 releases
+    the GIL while encoding). The queue is bounded by image_queue_size and,
+    when it is full, image_drop_policy decides what happens:
+      'drop_newest' - the new crop is not written and save() returns None,
+                      so the event is logged without an image
+      'block'       - save() waits for room (the frame loop stalls)
+    A queued crop is never discarded: its path is already in Events.
+
+    With storage='pack' the crops are appended to per-day pack files
+    (crop_pack.CropPackWriter) and save() returns a 'pack://' reference
+    instead of a file path.
+    """
+    POLICIES = ('drop_newest', 'block')
+
+    def __init__(self, root_dir, threads=2, queue_size=256, policy='drop_newest', jpeg_quality=90,
+                 storage='files'):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown image_drop_policy: {policy}")
+        if storage not in ('files', 'pack'):
+            raise ValueError(f"Unknown image_storage: {storage}")
+        self.root_dir = root_dir
+        self.pack = crop_pack.CropPackWriter(root_dir) if storage == 'pack' else None
+        self.policy = policy
+        self._params = [cv2.IMWRITE_JPEG_QUALITY, int(jpeg_quality)]
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._made_dirs = set()
+        self._dirs_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+        # Stats
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.max_depth = 0
+
+        self._threads = [threading.Thread(target=self._run, name=f"image-writer-{i}", daemon=True)
+                         for i in range(max(1, threads))]
+        for t in self._threads:
+            t.start()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get('entry_log_dir', 'logs/entries'),
+                   threads=config.get('image_writer_threads', 2),
+                   queue_size=config.get('image_queue_size', 256),
+                   policy=config.get('image_drop_policy', 'drop_newest'),
+                   jpeg_quality=config.get('image_jpeg_quality', 90),
+                   storage=config.get('image_storage', 'files'))
+
+    def path_for(self, visitor_id, event_type, now=None):
+        """Dated path for a crop: <root>/<YYYY-MM-DD>/<visitor>_<event>_<timestamp>.jpg"""
+        now = now or datetime.datetime.now()
+        filename = f"{visitor_id}_{event_type}_{now.strftime('%Y%m%d_%H%M%S_%f')}.jpg"
+        return os.path.join(self.root_dir, now.strftime('%Y-%m-%d'), filename)
+
+    def save(self, crop_img, visitor_id, event_type, now=None):
+        """
+        Queues a crop for writing. Returns its path (or pack reference), or
+        None if it was dropped. `now` (local datetime) names the file/day.
+        """
+        path = self.pack.reserve(now) if self.pack is not None else self.path_for(visitor_id, event_type, now)
+        item = (path, crop_img)
+        if self.policy == 'block':
+            self._queue.put(item)
+        else:
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self._count('dropped')
+                return None
+        self._count('queued')
+        depth = self._queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        return path
+
+    def _count(self, name):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+        metrics.inc('images_' + name)
+
+    def _ensure_dir(self, directory):
+        if directory in self._made_dirs:
+            return
+        with self._dirs_lock:
+            os.makedirs(directory, exist_ok=True)
+            self._made_dirs.add(directory)
+
+    def _write(self, path, crop_img):
+        if self.pack is not None:
+            ok, buf = cv2.imencode('.jpg', crop_img, self._params)
+            if ok:
+                self.pack.write(path, buf.tobytes())
+            return ok
+        self._ensure_dir(os.path.dirname(path))
+        return cv2.imwrite(path, crop_img, self._params)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            path, crop_img = item
+            try:
+                with metrics.timer('imwrite'):
+                    ok = self._write(path, crop_img)
+                self._count('written' if ok else 'failed')
+            except Exception as e:
+                print(f"Image writer: failed to write {path}: {e}")
+                self._count('failed')
+            finally:
+                self._queue.task_done()
+
+    def stats(self):
+        return {
+            'policy': self.policy,
+            'queue_depth': self._queue.qsize(),
+            'max_depth': self.max_depth,
+            'queued': self.queued,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+    def close(self):
+        """Writes everything still queued, then stops the threads."""
+        self._queue.join()
+        for _ in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        if self.pack is not None:
+            self.pack.close()
@@ -1,23 +1,76 @@
-import cv2
+import argparse
 import json
+import queue
 import sys
+import time
 import logging
 from ultralytics import YOLO
 import database
+import detection_log
+import display
+import event_writer
 import face_embedder
+import gallery
+import identity_workers
+import image_writer
+import media_clock
+import metrics
+import pipeline
 import state_tracker
+import video_capture
 
-def main():
-    # 1. Load Configuration
+def parse_args():
+    parser = argparse.ArgumentParser(description='Intelligent face tracker')
+    parser.add_argument('--headless', action='store_true',
+                        help='Run without any visualization (no plot/imshow/waitKey)')
+    return parser.parse_args()
+
+def unpack_results(results):
+    """
+    Normalize results handling (ultralytics may return a Results object or a list).
+    Returns (boxes, keypoints); keypoints is an (N, 5, 2) numpy array when the
+    face model predicts landmarks, otherwise None.
+    """
+    result = None
+    if hasattr(results, 'boxes'):
+        result = results
+    elif isinstance(results, (list, tuple)) and len(results) > 0 and hasattr(results[0], 'boxes'):
+        result = results[0]
+    if result is None:
+        return None, None
+
+    keypoints = None
+    if getattr(result, 'keypoints', None) is not None:
+        keypoints = result.keypoints.xy.cpu().numpy()
+    return result.boxes, keypoints
+
+def load_config(path='config.json'):
     try:
-        with open('config.json') as f:
-            config = json.load(f)
+        with open(path) as f:
+            return json.load(f)
     except FileNotFoundError:
-        print("FATAL: config.json not found.")
+        print(f"FATAL: {path} not found.")
         sys.exit(1)
 
+def run_pipeline(config, video_source, headless=False, camera_name=None,
+                 stop_event=None, report=None, report_interval=5.0):
+    """
+    Runs the full YOLO + ByteTrack + VisitorTracker pipeline on one video source.
+
+    Used directly by main() and once per camera by multi_camera.py.
+    `stop_event` (threading/multiprocessing Event) ends the loop early, and
+    `report(stats)` is called every `report_interval` seconds with the
+    processing fps and frame lag for this camera.
+    """
+    camera_name = camera_name or str(video_source)
+    # Per-stage latency histograms and counters (no-ops unless metrics_enabled)
+    metrics.from_config(config, labels={'camera': camera_name})
+
     # 2. Connect to Database
-    db_conn = database.get_db_connection(config)
+    # A connection pool: every database.* helper borrows a connection per call,
+    # so tracker reads/writes, the event writer and the async path don't
+    # contend for a single connection.
+    db_conn = database.get_db_pool(config)
     if db_conn is None:
         print("FATAL: Could not connect to database. Check config and run init_db.py.")
         sys.exit(1)
@@ -27,101 +80,275 @@ def main():
     detector = YOLO(config.get('yolo_model_path'))
 
     # Configure embedder (allow CPU by default; set use_gpu=True in config to use GPU)
-    embedder = face_embedder.FaceEmbedder(use_gpu=config.get('use_gpu', False))
+    # With embedding_workers > 0 each worker process loads its own model and
+    # new tracks are embedded there, so the frame loop never waits for ONNX.
+    identity_pool = None
+    embedder = None
+    if config.get('embedding_workers', 0) > 0:
+        identity_pool = identity_workers.IdentityWorkerPool(config)
+    else:
+        embedder = face_embedder.FaceEmbedder(use_gpu=config.get('use_gpu', False),
+                                              mode=config.get('embedding_mode', 'aligned'),
+                                              max_batch_size=config.get('embedding_batch_size', 32))
 
     # 4. Initialize State Tracker
-    tracker = state_tracker.VisitorTracker(config)
+    # identity_backend "memory" (default) loads all embeddings once and searches
+    # in-process, "ann" opens the on-disk IVF index, "sql" queries Postgres per track.
+    visitor_gallery = gallery.open_identity_store(config, db_conn)
+    # Registrations and events are written behind the frame loop (batched COPY)
+    writer = event_writer.EventWriter(config, pool=db_conn) if config.get('write_behind', True) else None
+    # Gallery sync queries (and, with identity_backend "sql", the per-track
+    # lookups) run on the async pool, concurrently with the frame loop
+    async_db = database.AsyncDatabase(config) if config.get('db_async', True) else None
+    # Entry/exit JPEGs are encoded and written on background threads
+    crop_writer = image_writer.ImageWriter.from_config(config) if config.get('image_writer_threads', 2) > 0 else None
+    tracker = state_tracker.VisitorTracker(config, gallery=visitor_gallery, writer=writer, async_db=async_db,
+                                           identity_pool=identity_pool, image_writer=crop_writer)
+    # Counted once at startup; from here on the tracker keeps the count in memory.
+    if visitor_gallery is not None:
+        tracker.unique_visitor_count = len(visitor_gallery)
+    else:
+        tracker.unique_visitor_count = database.count_visitors(db_conn)
 
     # 5. Open Video Source
-    video_source = config.get('video_source')
-    if not video_source:
-        print("FATAL: 'video_source' not set in config.json")
-        sys.exit(1)
-        
-    cap = cv2.VideoCapture(video_source)
+    # Decoding runs on its own thread; skipped frames are grab()'d, not decoded.
+    cap = video_capture.ThreadedCapture(video_source,
+                                        frame_skip=config.get('frame_skip', 1),
+                                        queue_size=config.get('capture_queue_size', 4),
+                                        policy=config.get('capture_policy', 'auto'))
     if not cap.isOpened():
         print(f"FATAL: Could not open video source: {video_source}")
         sys.exit(1)
 
-    print(f"--- Processing video stream: {video_source} ---")
-    
-    frame_count = 0
-    frame_skip = config.get('frame_skip', 1)
-
-    # 6. Main Processing Loop
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break # End of video
-            
-        # 6.1. Frame Skipping Logic
-        if frame_count % frame_skip!= 0:
-            frame_count += 1
-            continue
-        
-        frame_count += 1
-
-        # 6.2. Run Detection & Tracking (YOLO + ByteTrack)
+    # Tracker time follows the media position for files, so recorded footage
+    # can be processed faster than real time; live sources use wall time.
+    tracker.clock = media_clock.for_source(config, video_source, fps=cap.fps, frame_count=cap.frame_count)
+
+
+    # Optional detection recording for offline replay (scripts/replay_detections.py)
+    recorder = None
+    if config.get('record_detections'):
+        if config.get('record_embeddings', False) and embedder is None:
+            print("record_embeddings needs the in-process embedder (embedding_workers 0); recording without them")
+        recorder = detection_log.DetectionRecorder(
+            config['record_detections'], crops=config.get('record_crops', False),
+            embedder=embedder if config.get('record_embeddings', False) else None)
+
+    # Rendering is optional; the window is drawn from this (the main) thread
+    # between frames, the track stage only hands results over.
+    viewer = None if headless else display.DisplayWindow(f"Intelligent Face Tracker - {camera_name}")
+
+    # With detect_workers > 1 every detect thread runs its own YOLO copy
+    # (predict only) and ByteTrack runs in the track stage, in frame order.
+    # With one worker, detector.track() keeps ByteTrack inside YOLO as before.
+    # The copies are loaded here, before the stages start; a worker takes
+    # one for each frame and gives it back, so no two use the same model.
+    detect_workers = max(1, int(config.get('detect_workers', 1)))
+    byte_tracker = None
+    models = queue.Queue()
+    if detect_workers > 1:
+        from batch_ingest import apply_tracks, new_bytetrack
+        byte_tracker = new_bytetrack((cap.fps or 30.0) / max(1, int(config.get('frame_skip', 1))))
+        models.put(detector)
+        for _ in range(detect_workers - 1):
+            models.put(YOLO(config.get('yolo_model_path')))
+
+    # Overload policy of the queue in front of the track stage. "auto" blocks
+    # for files (every frame is processed) and degrades for live sources:
+    # new tracks are embedded less (degrade_embed_per_frame) while the queue
+    # is backed up, and once it is full the capture queue drops frames.
+    track_policy = config.get('pipeline_policy', 'auto')
+    if track_policy == 'auto':
+        track_policy = 'block' if cap.policy == 'block' else 'degrade'
+
+    state = {'processed': 0, 'last_report': time.time(), 'processed_at_last_report': 0}
+
+    # 6. Pipeline: decode (capture thread) -> detect -> track -> render (main thread).
+    # Registrations/events and entry/exit images are written behind the track
+    # stage (EventWriter, ImageWriter) and embeddings may run in worker
+    # processes (embedding_workers), so each stage overlaps with the others.
+    def detect(item):
+        # 6.1. Run Detection & Tracking (YOLO + ByteTrack)
         # We specify `classes=0` assuming 'face' is class 0 in this model.
         # `persist=True` tells the tracker to remember tracks between frames.
         # `tracker="bytetrack.yaml"` explicitly selects ByteTrack.
+        frame_index, captured_at, frame, pos_msec = item
+        frame_started = time.perf_counter()
         try:
-            results = detector.track(frame, 
-                                     persist=True, 
-                                     tracker="bytetrack.yaml", 
-                                     classes=0,
-                                     verbose=False) # Set to True for more debug info
+            if byte_tracker is None:
+                with metrics.timer('detect'):
+                    results = detector.track(frame,
+                                             persist=True,
+                                             tracker="bytetrack.yaml",
+                                             classes=0,
+                                             verbose=False) # Set to True for more debug info
+            else:
+                model = models.get()
+                try:
+                    with metrics.timer('detect'):
+                        results = model.predict(frame, classes=0, verbose=False)
+                finally:
+                    models.put(model)
         except Exception as e:
             print(f"Detector error: {e}")
-            continue
-        
-        # Normalize results handling (ultralytics may return a Results object or a list)
-        boxes = None
-        if hasattr(results, 'boxes'):
-            boxes = results.boxes
-        elif isinstance(results, (list, tuple)) and len(results) > 0 and hasattr(results[0], 'boxes'):
-            boxes = results[0].boxes
-
-        # 6.3. Update State Tracker (if any boxes/tracks were returned)
+            return None
+        return frame_index, captured_at, frame, pos_msec, results, frame_started
+
+    def track(item):
+        frame_index, captured_at, frame, pos_msec, results, frame_started = item
+        if byte_tracker is not None:
+            results = apply_tracks(results[0], byte_tracker)
+        boxes, keypoints = unpack_results(results)
+
+        # 6.2. Update State Tracker (if any boxes/tracks were returned).
+        # Under the degrade policy a backed-up queue limits new embeddings.
+        embed_limit = None
+        if track_stage.policy == 'degrade' and track_stage.overloaded():
+            embed_limit = config.get('degrade_embed_per_frame', 0)
+            track_stage.degraded += 1
+        tracker.clock.advance(frame_index, pos_msec)
+        if recorder is not None:
+            recorder.record(frame_index, tracker.clock.now(), frame, boxes, keypoints)
         if boxes is not None:
+            metrics.inc('faces', len(boxes))
             try:
-                tracker.update_frame(frame, boxes, embedder, db_conn)
+                with metrics.timer('track_update'):
+                    tracker.update_frame(frame, boxes, embedder, db_conn, keypoints=keypoints,
+                                         embed_limit=embed_limit)
             except Exception as e:
                 print(f"Tracker update error: {e}")
 
-        # 6.4. Visualization (for your demo)
-        try:
-            if hasattr(results, 'plot'):
-                annotated_frame = results.plot()
-            elif isinstance(results, (list, tuple)):
-                annotated_frame = results[0].plot()
-            else:
-                annotated_frame = frame
-        except Exception:
-            annotated_frame = frame
-        
-        # Add a title with the current unique visitor count (from the DB)
+        # 6.3. Visualization (for your demo). Never blocks: the main thread
+        #      draws the latest submitted frame. Skipped in headless mode.
+        if viewer is not None:
+            viewer.submit(frame, results, tracker.counters())
+
+        # 6.4. Periodic per-camera stats (fps and how stale the processed frame was).
+        # 'frame' is now the latency from detection start to the tracker update.
+        metrics.observe('frame', time.perf_counter() - frame_started)
+        metrics.inc('frames')
+        state['processed'] += 1
+        if report is not None:
+            now = time.time()
+            if now - state['last_report'] >= report_interval:
+                capture_stats = cap.stats()
+                report({
+                    'camera': camera_name,
+                    'fps': (state['processed'] - state['processed_at_last_report']) / (now - state['last_report']),
+                    'lag_seconds': now - captured_at,
+                    'frames_processed': state['processed'],
+                    'frames_dropped': capture_stats['frames_dropped'] + track_stage.dropped,
+                    'queue_depth': capture_stats['queue_depth'],
+                    'crop_bytes': tracker.crop_stats()['resident_bytes'],
+                    'image_queue_depth': crop_writer.stats()['queue_depth'] if crop_writer is not None else 0,
+                })
+                state['last_report'] = now
+                state['processed_at_last_report'] = state['processed']
+
+    # The tracker is stateful and needs frames in order: one track worker.
+    # Detect results are handed on in frame order whatever detect_workers is.
+    detect_stage = pipeline.Stage.from_config(config, 'detect', detect, workers=detect_workers,
+                                              policy=config.get('detect_policy', 'block'))
+    track_stage = pipeline.Stage.from_config(config, 'track', track, workers=1,
+                                             policy=config.get('track_policy', track_policy))
+    stages = pipeline.Pipeline([detect_stage, track_stage])
+
+    print(f"--- [{camera_name}] Processing video stream: {video_source} "
+          f"(capture policy: {cap.policy}, detect workers: {detect_workers}, track policy: {track_stage.policy}) ---")
+    cap.start()
+    stages.start()
+
+    try:
+        # The calling thread moves decoded frames into the pipeline, draws the
+        # window and watches for a stop request or 'q' in the window.
+        while True:
+            if stop_event is not None and stop_event.is_set():
+                stages.stop()
+                break
+            if viewer is not None and viewer.poll():
+                print("Quitting...")
+                stages.stop()
+                break
+            try:
+                item = cap.read(timeout=0.05)
+            except queue.Empty:
+                continue
+            if item is None:
+                break
+            stages.put(item)
+        stages.close()
+        # Keep the window responsive while the stages drain
+        while viewer is not None and stages.is_alive():
+            if viewer.poll():
+                stages.stop()
+            stages.join(timeout=0.05)
+        stages.join()
+    finally:
+        # Workers exit after their current item (a no-op after a clean drain)
+        stages.stop()
+        stages.join()
+
+        # 7. Cleanup
+        # Visits still open when the stream ends are closed: pending identities
+        # and tracks still collecting samples are committed, and every active
+        # visitor gets its entry (if not logged yet) and exit.
         try:
-            with db_conn.cursor() as cur:
-                cur.execute("SELECT COUNT(*) FROM Visitors;")
-                count_row = cur.fetchone()
-                count = count_row[0] if count_row else 0
-            cv2.putText(annotated_frame, f"Unique Visitors Registered: {count}", 
-                        (20, 40), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-        except Exception:
-            pass # DB connection might be busy
-
-        cv2.imshow("Intelligent Face Tracker", annotated_frame)
-        
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            print("Quitting...")
-            break
-
-    # 7. Cleanup
-    cap.release()
-    cv2.destroyAllWindows()
-    db_conn.close()
-    print("Processing finished.")
+            tracker.end_of_stream(db_conn)
+        except Exception as e:
+            print(f"Tracker end of stream error: {e}")
+        cap.release()
+        stats = cap.stats()
+        print(f"Capture: {stats['frames_decoded']} frames decoded at {stats['decode_fps']:.1f} fps, "
+              f"{stats['frames_dropped']} dropped ({stats['policy']})")
+        for stage_stats in stages.stats():
+            print(f"Stage {stage_stats['stage']}: {stage_stats['processed']} processed by {stage_stats['workers']} "
+                  f"worker(s), {stage_stats['utilization']:.0%} busy, {stage_stats['dropped']} dropped, "
+                  f"{stage_stats['degraded']} degraded (max queue depth {stage_stats['max_depth']}, {stage_stats['policy']})")
+        embed_stats = tracker.embedding_stats()
+        print(f"Embeddings: {embed_stats['attempted']} attempted, {embed_stats['succeeded']} succeeded, "
+              f"skipped {embed_stats['skipped_quality']} low quality / {embed_stats['skipped_backoff']} backoff / "
+              f"{embed_stats['skipped_cap']} over the per-frame cap")
+        crop_stats = tracker.crop_stats()
+        print(f"Crops: {crop_stats['crops']} retained, {crop_stats['resident_bytes'] / 1e6:.1f} MB resident "
+              f"(budget {crop_stats['budget_bytes'] / 1e6:.0f} MB, {crop_stats['evictions']} evicted)")
+        for tier, tier_stats in tracker.reid_stats().items():
+            print(f"Re-ID {tier} tier: {tier_stats['lookups']} lookups, {tier_stats['hit_rate']:.0%} hits, "
+                  f"{tier_stats['mean_ms']:.2f} ms mean, {tier_stats['max_ms']:.2f} ms max")
+        if recorder is not None:
+            print(f"Recorded {recorder.close()} frames of detections to {recorder.path}")
+        if viewer is not None:
+            viewer.close()
+        if identity_pool is not None:
+            identity_pool.shutdown(wait=False)
+        if crop_writer is not None:
+            crop_writer.close()
+            image_stats = crop_writer.stats()
+            print(f"Images: {image_stats['written']} written, {image_stats['dropped']} dropped, "
+                  f"{image_stats['failed']} failed (max queue depth {image_stats['max_depth']}, {image_stats['policy']})")
+        if writer is not None:
+            writer.close()
+        if async_db is not None:
+            async_db.close()
+        db_conn.close()
+        if metrics.enabled():
+            print(f"[{camera_name}] Stage latency:")
+            for line in metrics.summary_lines():
+                print(f"  {line}")
+            metrics.stop()
+    print(f"[{camera_name}] Processing finished.")
+
+def main():
+    args = parse_args()
+
+    # 1. Load Configuration
+    config = load_config()
+
+    video_source = config.get('video_source')
+    if video_source is None or video_source == '':
+        print("FATAL: 'video_source' not set in config.json")
+        sys.exit(1)
+
+    run_pipeline(config, video_source, headless=args.headless or config.get('headless', False))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
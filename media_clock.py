@@ -0,0 +1,93 @@
+import datetime
+import os
+import time
+
+CLOCKS = ('auto', 'wall', 'pos_msec', 'frame_index')
+
+
+class WallClock:
+    """Live sources: tracker time is the wall clock."""
+    def advance(self, frame_index=None, pos_msec=None):
+        pass
+
+    def now(self):
+        return time.time()
+
+    @staticmethod
+    def to_datetime(t):
+        """Epoch seconds -> timezone-aware UTC datetime (for event timestamps)."""
+        return datetime.datetime.fromtimestamp(t, datetime.timezone.utc)
+
+    @staticmethod
+    def to_local(t):
+        """Epoch seconds -> naive local datetime (for crop file/pack names)."""
+        return datetime.datetime.fromtimestamp(t)
+
+
+class MediaClock(WallClock):
+    """
+    Recorded footage: tracker time is `start` plus the position of the frame
+    being processed, so exit_timeout, retry backoff and event timestamps
+    follow the video rather than how fast it is decoded. Registrations
+    (Visitors.first_seen) always use wall time.
+
+    source 'pos_msec' uses the decoder's CAP_PROP_POS_MSEC and falls back to
+    frame_index / fps when a backend reports no position; 'frame_index'
+    always uses frame_index / fps. Time never moves backwards.
+    """
+    def __init__(self, start=None, fps=None, source='pos_msec'):
+        if source not in ('pos_msec', 'frame_index'):
+            raise ValueError(f"Unknown media clock source: {source}")
+        self.start = time.time() if start is None else start
+        self.fps = fps if fps and fps > 0 else 30.0
+        self.source = source
+        self.offset = 0.0
+
+    def advance(self, frame_index=None, pos_msec=None):
+        """Moves the clock to the frame about to be processed."""
+        if self.source == 'pos_msec' and pos_msec is not None and (pos_msec > 0 or frame_index == 0):
+            offset = pos_msec / 1000.0
+        elif frame_index is not None:
+            offset = frame_index / self.fps
+        else:
+            return
+        self.offset = max(self.offset, offset)
+
+    def seek(self, offset):
+        """Moves the clock to `offset` seconds after start (e.g. replaying recorded tracker time)."""
+        self.offset = max(self.offset, offset)
+
+    def now(self):
+        return self.start + self.offset
+
+
+def _media_start(config, source, fps, frame_count):
+    """
+    Epoch seconds of the first frame: media_start is an ISO timestamp,
+    "file_mtime" (file modification time minus the video's duration) or
+    null for the moment the clock is created.
+    """
+    start = config.get('media_start')
+    if not start:
+        return time.time()
+    if start == 'file_mtime':
+        if not (isinstance(source, str) and os.path.isfile(source)):
+            return time.time()
+        duration = frame_count / fps if fps and frame_count and frame_count > 0 else 0.0
+        return os.path.getmtime(source) - duration
+    return datetime.datetime.fromisoformat(start).timestamp()
+
+
+def for_source(config, source, fps=None, frame_count=None):
+    """
+    Clock for a video source. media_clock "auto" picks the media position
+    for files and the wall clock for cameras/streams.
+    """
+    kind = config.get('media_clock', 'auto')
+    if kind not in CLOCKS:
+        raise ValueError(f"Unknown media_clock: {kind}")
+    if kind == 'auto':
+        kind = 'pos_msec' if isinstance(source, str) and os.path.isfile(source) else 'wall'
+    if kind == 'wall':
+        return WallClock()
+    return MediaClock(_media_start(config, source, fps, frame_count), fps=fps, source=kind)
@@ -0,0 +1,247 @@
+"""
+Per-stage latency histograms and counters for the processing pipeline.
+
+Instrumented code calls the module-level helpers:
+
+    with metrics.timer('detect'):
+        results = detector.track(frame, ...)
+    metrics.inc('faces', len(boxes))
+
+Nothing is recorded until configure() enables it; while disabled, timer()
+returns one shared no-op context manager and inc()/observe() return at the
+first check, so the hooks can stay in the frame loop.
+
+serve() exposes everything in Prometheus text format on a local port, and
+summary_lines() gives the p50/p95/p99 table printed at shutdown.
+"""
+import bisect
+import contextlib
+import http.server
+import math
+import threading
+import time
+
+PREFIX = 'facetrack'
+
+# Log-spaced upper bounds from 50 us to ~40 s, four per doubling (~19% apart)
+BUCKETS = [5e-5 * 2 ** (i / 4.0) for i in range(80)]
+
+_NULL_TIMER = contextlib.nullcontext()
+
+_enabled = False
+_histograms = {}
+_counters = {}
+_lock = threading.Lock()
+_server = None
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram; quantiles are interpolated within a bucket."""
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(self.bounds, seconds)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def quantile(self, q):
+        """Approximate q-quantile in seconds (0 when empty)."""
+        with self._lock:
+            counts, count, top = list(self.counts), self.count, self.max
+        if not count:
+            return 0.0
+        rank = q * count
+        seen = 0
+        for i, n in enumerate(counts):
+            if n and seen + n >= rank:
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                upper = min(self.bounds[i], top) if i < len(self.bounds) else top
+                fraction = (rank - seen) / n
+                return lower + (max(upper, lower) - lower) * fraction
+            seen += n
+        return top
+
+    def buckets(self):
+        """Cumulative (upper_bound, count) pairs, ending with +Inf."""
+        with self._lock:
+            counts = list(self.counts)
+        total, out = 0, []
+        for bound, n in zip(self.bounds + [math.inf], counts):
+            total += n
+            out.append((bound, total))
+        return out
+
+
+class _StageTimer:
+    __slots__ = ('hist', 'started')
+
+    def __init__(self, hist):
+        self.hist = hist
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.started)
+        return False
+
+
+def configure(enabled=True):
+    """Turns recording on or off. Already recorded values are kept."""
+    global _enabled
+    _enabled = bool(enabled)
+
+
+def enabled():
+    return _enabled
+
+
+def _histogram(stage):
+    hist = _histograms.get(stage)
+    if hist is None:
+        with _lock:
+            hist = _histograms.setdefault(stage, LatencyHistogram())
+    return hist
+
+
+def timer(stage):
+    """Context manager timing one pass through `stage`."""
+    if not _enabled:
+        return _NULL_TIMER
+    return _StageTimer(_histogram(stage))
+
+
+def observe(stage, seconds):
+    """Records an already measured latency for `stage`."""
+    if _enabled:
+        _histogram(stage).observe(seconds)
+
+
+def inc(name, n=1):
+    """Adds `n` to counter `name`."""
+    if _enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + n
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+def snapshot():
+    """{'stages': {stage: {count, mean_ms, p50_ms, p95_ms, p99_ms, max_ms}}, 'counters': {...}}"""
+    with _lock:
+        histograms = dict(_histograms)
+        counters = dict(_counters)
+    stages = {}
+    for stage, hist in sorted(histograms.items()):
+        stages[stage] = {
+            'count': hist.count,
+            'mean_ms': 1000.0 * hist.sum / hist.count if hist.count else 0.0,
+            'p50_ms': 1000.0 * hist.quantile(0.50),
+            'p95_ms': 1000.0 * hist.quantile(0.95),
+            'p99_ms': 1000.0 * hist.quantile(0.99),
+            'max_ms': 1000.0 * hist.max,
+        }
+    return {'stages': stages, 'counters': counters}
+
+
+def _escape_label(value):
+    """Label value escaping required by the exposition format (Windows paths, quotes)."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus(labels=None):
+    """All histograms and counters in Prometheus text exposition format."""
+    extra = ''.join(f',{k}="{_escape_label(v)}"' for k, v in sorted((labels or {}).items()))
+    with _lock:
+        histograms = sorted(_histograms.items())
+        counters = sorted(_counters.items())
+
+    lines = [f"# HELP {PREFIX}_stage_seconds Latency of one pass through a pipeline stage.",
+             f"# TYPE {PREFIX}_stage_seconds histogram"]
+    for stage, hist in histograms:
+        for bound, cumulative in hist.buckets():
+            le = '+Inf' if bound == math.inf else f"{bound:.6g}"
+            lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{stage}"{extra},le="{le}"}} {cumulative}')
+        lines.append(f'{PREFIX}_stage_seconds_sum{{stage="{stage}"{extra}}} {hist.sum:.9f}')
+        lines.append(f'{PREFIX}_stage_seconds_count{{stage="{stage}"{extra}}} {hist.count}')
+    label_set = f"{{{extra[1:]}}}" if extra else ''
+    for name, value in counters:
+        lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+        lines.append(f"{PREFIX}_{name}_total{label_set} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def summary_lines():
+    """Human-readable shutdown summary, one line per stage and one for the counters."""
+    snap = snapshot()
+    lines = [f"{'stage':<14} {'count':>8} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}"]
+    for stage, s in snap['stages'].items():
+        lines.append(f"{stage:<14} {s['count']:>8} {s['mean_ms']:>9.2f} {s['p50_ms']:>9.2f} "
+                     f"{s['p95_ms']:>9.2f} {s['p99_ms']:>9.2f} {s['max_ms']:>9.2f}")
+    if snap['counters']:
+        lines.append('counters: ' + ', '.join(f"{k}={v}" for k, v in sorted(snap['counters'].items())))
+    return lines
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    labels = None
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = render_prometheus(self.labels).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes would flood the console
+
+
+def serve(port, host='127.0.0.1', labels=None):
+    """Serves /metrics on a daemon thread. Returns the server, or None if the port is taken."""
+    global _server
+    if _server is not None:
+        return _server
+    handler = type('MetricsHandler', (_MetricsHandler,), {'labels': labels})
+    try:
+        _server = http.server.ThreadingHTTPServer((host, port), handler)
+    except OSError as e:
+        print(f"Metrics endpoint disabled: cannot bind {host}:{port} ({e})")
+        return None
+    threading.Thread(target=_server.serve_forever, name='metrics-http', daemon=True).start()
+    print(f"Metrics: http://{host}:{port}/metrics")
+    return _server
+
+
+def stop():
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+
+
+def from_config(config, labels=None):
+    """Enables recording and the endpoint per config (metrics_enabled, metrics_port, metrics_host)."""
+    configure(config.get('metrics_enabled', False))
+    if _enabled and config.get('metrics_port'):
+        serve(config['metrics_port'], host=config.get('metrics_host', '127.0.0.1'), labels=labels)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Multi-camera runner.
+
+Starts one worker process per video source, each running the full
+YOLO + ByteTrack + VisitorTracker pipeline from main.py, so every camera
+gets its own core. All workers talk to the same PostgreSQL database, which
+is the shared visitor identity store: a visitor registered at door A is
+re-identified when they show up at door B.
+
+The supervisor prints per-camera fps and lag and restarts workers that die.
+
+Usage:
+    python multi_camera.py                                # cameras from config.json
+    python multi_camera.py --sources rtsp://a rtsp://b    # ad-hoc list of sources
+"""
+
+import argparse
+import multiprocessing as mp
+import queue
+import sys
+import time
+
+import main as pipeline
+
+
+def parse_source(value):
+    """Webcam indices come in as strings on the command line."""
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    return value
+
+
+def camera_worker(config, name, source, stats_queue, stop_event):
+    """Entry point of a worker process. Must stay at module level for spawn()."""
+    try:
+        pipeline.run_pipeline(config, source, headless=True, camera_name=name,
+                              stop_event=stop_event, report=stats_queue.put,
+                              report_interval=config.get('camera_report_seconds', 5.0))
+    except KeyboardInterrupt:
+        pass
+
+
+class CameraSupervisor:
+    """
+    Owns the worker processes. Restarts any worker that exits unexpectedly
+    (after `camera_restart_delay_seconds`), except file sources that simply
+    reached the end of the video.
+    """
+    def __init__(self, config, cameras):
+        self.config = config
+        self.cameras = cameras  # list of {'name': str, 'video_source': str|int}
+        self.restart_delay = config.get('camera_restart_delay_seconds', 5.0)
+        self.report_interval = config.get('camera_report_seconds', 5.0)
+
+        self.ctx = mp.get_context('spawn')
+        self.stats_queue = self.ctx.Queue()
+        self.stop_event = self.ctx.Event()
+
+        self.workers = {}       # name -> Process
+        self.restarts = {}      # name -> int
+        self.finished = set()   # names that ended cleanly
+        self.died_at = {}       # name -> time of death, pending restart
+        self.latest_stats = {}  # name -> last stats dict
+
+    def _start(self, camera):
+        name = camera['name']
+        config = self.config
+        if config.get('metrics_port'):
+            # One metrics endpoint per worker process: metrics_port, +1, +2, ...
+            config = dict(config, metrics_port=config['metrics_port'] + self.cameras.index(camera))
+        proc = self.ctx.Process(target=camera_worker,
+                                name=f"camera-{name}",
+                                args=(config, name, camera['video_source'],
+                                      self.stats_queue, self.stop_event),
+                                daemon=False)
+        proc.start()
+        self.workers[name] = proc
+        print(f"[supervisor] started {name} (pid {proc.pid}) -> {camera['video_source']}")
+
+    def _drain_stats(self):
+        while True:
+            try:
+                stats = self.stats_queue.get_nowait()
+            except queue.Empty:
+                return
+            stats['received_at'] = time.time()
+            self.latest_stats[stats['camera']] = stats
+
+    def _check_workers(self):
+        now = time.time()
+        for camera in self.cameras:
+            name = camera['name']
+            if name in self.finished:
+                continue
+            proc = self.workers.get(name)
+            if proc is not None and proc.is_alive():
+                continue
+
+            if name not in self.died_at:
+                exitcode = proc.exitcode if proc is not None else None
+                source = camera['video_source']
+                if exitcode == 0 and isinstance(source, str) and not source.startswith(('rtsp://', 'http://', 'https://')):
+                    print(f"[supervisor] {name} finished")
+                    self.finished.add(name)
+                    continue
+                print(f"[supervisor] {name} died (exit code {exitcode}); restarting in {self.restart_delay:.0f}s")
+                self.died_at[name] = now
+            elif now - self.died_at[name] >= self.restart_delay:
+                self.died_at.pop(name)
+                self.restarts[name] = self.restarts.get(name, 0) + 1
+                self._start(camera)
+
+    def _print_report(self):
+        print(f"[supervisor] {'camera':<16} {'fps':>7} {'lag(s)':>8} {'dropped':>8} {'crops MB':>8} {'restarts':>8}  status")
+        now = time.time()
+        for camera in self.cameras:
+            name = camera['name']
+            stats = self.latest_stats.get(name)
+            if name in self.finished:
+                status = 'finished'
+            elif name in self.died_at:
+                status = 'restarting'
+            elif stats is None or now - stats['received_at'] > 3 * self.report_interval:
+                status = 'stalled' if stats else 'starting'
+            else:
+                status = 'ok'
+            fps = f"{stats['fps']:.1f}" if stats else '-'
+            lag = f"{stats['lag_seconds']:.2f}" if stats else '-'
+            dropped = stats['frames_dropped'] if stats else '-'
+            crops = f"{stats['crop_bytes'] / 1e6:.1f}" if stats else '-'
+            print(f"[supervisor] {name:<16} {fps:>7} {lag:>8} {dropped:>8} {crops:>8} {self.restarts.get(name, 0):>8}  {status}")
+
+    def run(self):
+        for camera in self.cameras:
+            self._start(camera)
+
+        last_report = time.time()
+        try:
+            while len(self.finished) < len(self.cameras):
+                time.sleep(0.5)
+                self._drain_stats()
+                self._check_workers()
+                if time.time() - last_report >= self.report_interval:
+                    self._print_report()
+                    last_report = time.time()
+        except KeyboardInterrupt:
+            print("[supervisor] stopping cameras...")
+        finally:
+            self.shutdown()
+
+    def shutdown(self, timeout=10.0):
+        self.stop_event.set()
+        deadline = time.time() + timeout
+        for proc in self.workers.values():
+            proc.join(timeout=max(0.0, deadline - time.time()))
+            if proc.is_alive():
+                proc.terminate()
+        self._drain_stats()
+
+
+def cameras_from_config(config):
+    cameras = config.get('cameras')
+    if not cameras:
+        # Fall back to the single-camera setting
+        if config.get('video_source') is None:
+            return []
+        cameras = [{'name': 'camera0', 'video_source': config['video_source']}]
+    return [{'name': c.get('name') or f"camera{i}", 'video_source': parse_source(c['video_source'])}
+            for i, c in enumerate(cameras)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run one tracker process per camera')
+    parser.add_argument('--sources', nargs='+', default=None,
+                        help='Video sources (files, RTSP URLs or webcam indices). Overrides config "cameras".')
+    parser.add_argument('--config', default='config.json')
+    args = parser.parse_args()
+
+    config = pipeline.load_config(args.config)
+    if args.sources:
+        cameras = [{'name': f"camera{i}", 'video_source': parse_source(s)} for i, s in enumerate(args.sources)]
+    else:
+        cameras = cameras_from_config(config)
+
+    if not cameras:
+        print("FATAL: no video sources. Set 'cameras' in config.json or pass --sources.")
+        sys.exit(1)
+
+    CameraSupervisor(config, cameras).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+"""
+Staged pipeline runtime.
+
+Each Stage runs `workers` threads that take items from a bounded inbox,
+call the stage function and pass the result (unless None) to the next
+stage's inbox. Stages overlap, so a pipeline runs at the speed of its
+slowest stage instead of the sum of all of them.
+
+What a full inbox does is the stage's overload policy:
+  'block'       - the producer waits for room (every item is processed).
+  'drop_oldest' - the oldest queued item is discarded (latency stays flat).
+  'drop_newest' - the incoming item is discarded.
+  'degrade'     - like 'block', but overloaded() turns true once the inbox
+                  holds degrade_at items, so the stage can shed optional
+                  work (main.py then embeds fewer new tracks per frame).
+
+With more than one worker, results are handed on in input order, so
+order-sensitive stages downstream (the visitor tracker) still see frames
+in sequence. One thread at a time hands results on, without holding the
+stage's locks, so a stalled next stage holds up that thread only: the other
+workers park up to `workers` results and wait, and producers dropping items
+never wait on it.
+"""
+import queue
+import threading
+import time
+
+import metrics
+
+POLICIES = ('block', 'drop_oldest', 'drop_newest', 'degrade')
+
+_END = object()
+
+
+class Stage:
+    def __init__(self, name, fn, workers=1, queue_size=4, policy='block', degrade_at=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown {name} stage policy: {policy}")
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, int(workers))
+        self.policy = policy
+        self.inbox = queue.Queue(maxsize=max(1, int(queue_size)))
+        self.degrade_at = degrade_at if degrade_at else max(1, self.inbox.maxsize // 2)
+        self.next = None
+
+        self._stop = threading.Event()
+        self._threads = []
+        self._in_lock = threading.Lock()
+        self._out_lock = threading.Lock()
+        self._out_ready = threading.Condition(self._out_lock)
+        self._seq_in = 0
+        self._seq_out = 0
+        self._done = {}  # seq -> result waiting for an earlier item to finish
+        self._sending = False  # a thread is handing results to the next stage
+        self._live = 0
+
+        # Stats
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.degraded = 0
+        self.max_depth = 0
+        self.busy_seconds = 0.0
+        self._started_at = None
+        self._finished_at = None
+
+    @classmethod
+    def from_config(cls, config, name, fn, workers=None, policy=None):
+        """
+        Reads <name>_workers, <name>_queue_size and <name>_policy, falling
+        back to pipeline_queue_size / pipeline_policy. `workers` pins the
+        worker count for stages that must stay sequential.
+        """
+        return cls(name, fn,
+                   workers=workers or config.get(f'{name}_workers', 1),
+                   queue_size=config.get(f'{name}_queue_size', config.get('pipeline_queue_size', 4)),
+                   policy=policy or config.get(f'{name}_policy', config.get('pipeline_policy', 'block')),
+                   degrade_at=config.get('pipeline_degrade_at'))
+
+    def start(self):
+        self._started_at = time.time()
+        self._live = self.workers
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"{self.name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def put(self, item):
+        """Queues an item. Returns False if the overload policy dropped it."""
+        with self._in_lock:
+            seq = self._seq_in
+            self._seq_in += 1
+        entry = (seq, item)
+        if self.policy == 'drop_newest':
+            try:
+                self.inbox.put_nowait(entry)
+            except queue.Full:
+                self._drop(seq)
+                return False
+        elif self.policy == 'drop_oldest':
+            while True:
+                try:
+                    self.inbox.put_nowait(entry)
+                    break
+                except queue.Full:
+                    try:
+                        stale = self.inbox.get_nowait()
+                    except queue.Empty:
+                        continue
+                    if stale is _END:
+                        # Closing: the end marker is never dropped, the late item is
+                        self._put_blocking(_END)
+                        self._drop(seq)
+                        return False
+                    self._drop(stale[0])
+        elif not self._put_blocking(entry):
+            return False
+        self.max_depth = max(self.max_depth, self.inbox.qsize())
+        return True
+
+    def _put_blocking(self, entry):
+        while not self._stop.is_set():
+            try:
+                self.inbox.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _drop(self, seq):
+        self.dropped += 1
+        metrics.inc(f'{self.name}_dropped')
+        # A gap filler that keeps the ordered hand-off moving. Only parked:
+        # the next worker result hands it on, so the producer never waits
+        # on the next stage.
+        with self._out_lock:
+            self._done[seq] = None
+
+    def overloaded(self):
+        """True while the inbox holds at least degrade_at items."""
+        return self.inbox.qsize() >= self.degrade_at
+
+    def _work(self):
+        try:
+            while True:
+                try:
+                    entry = self.inbox.get(timeout=0.1)
+                except queue.Empty:
+                    if self._stop.is_set():
+                        break
+                    continue
+                if entry is _END or self._stop.is_set():
+                    break
+                seq, item = entry
+                started = time.perf_counter()
+                try:
+                    result = self.fn(item)
+                except Exception as e:
+                    print(f"[{self.name}] stage error: {e}")
+                    self.errors += 1
+                    result = None
+                elapsed = time.perf_counter() - started
+                with self._out_lock:
+                    self.processed += 1
+                    self.busy_seconds += elapsed
+                self._emit(seq, result)
+                with self._out_lock:
+                    # Back-pressure while the sender is stuck on the next stage
+                    while self._sending and len(self._done) >= self.workers and not self._stop.is_set():
+                        self._out_ready.wait(0.1)
+        finally:
+            with self._in_lock:
+                self._live -= 1
+                last = self._live == 0
+            if last:
+                self._send_ready()  # results parked behind dropped items
+                self._finished_at = time.time()
+                if self.next is not None:
+                    self.next.close()
+
+    def _emit(self, seq, result):
+        with self._out_lock:
+            self._done[seq] = result
+        self._send_ready()
+
+    def _send_ready(self):
+        """
+        Hands every result whose predecessors are done to the next stage, in
+        order. Only one thread sends at a time, and never while holding
+        _out_lock; a result parked meanwhile is picked up by the sender.
+        """
+        with self._out_lock:
+            if self._sending:
+                return
+            self._sending = True
+        while True:
+            with self._out_lock:
+                ready = []
+                while self._seq_out in self._done:
+                    ready.append(self._done.pop(self._seq_out))
+                    self._seq_out += 1
+                self._out_ready.notify_all()
+                if not ready:
+                    self._sending = False
+                    return
+            for out in ready:
+                if out is not None and self.next is not None:
+                    self.next.put(out)
+
+    def close(self):
+        """No more input: workers finish what is queued, then the next stage is closed."""
+        for _ in range(self.workers):
+            self._put_blocking(_END)
+
+    def stop(self):
+        """Workers exit after their current item; queued items are discarded."""
+        self._stop.set()
+
+    def join(self, timeout=None):
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def is_alive(self):
+        return any(thread.is_alive() for thread in self._threads)
+
+    def stats(self):
+        end = self._finished_at or time.time()
+        elapsed = max(end - (self._started_at or end), 1e-6)
+        return {
+            'stage': self.name,
+            'workers': self.workers,
+            'policy': self.policy,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'degraded': self.degraded,
+            'errors': self.errors,
+            'queue_depth': self.inbox.qsize(),
+            'max_depth': self.max_depth,
+            'utilization': self.busy_seconds / (elapsed * self.workers),
+        }
+
+
+class Pipeline:
+    """Chains stages in order; put() feeds the first one."""
+    def __init__(self, stages):
+        self.stages = list(stages)
+        for stage, following in zip(self.stages, self.stages[1:]):
+            stage.next = following
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+        return self
+
+    def put(self, item):
+        return self.stages[0].put(item)
+
+    def close(self):
+        """Ends the input; every stage drains and closes the next."""
+        self.stages[0].close()
+
+    def stop(self):
+        for stage in self.stages:
+            stage.stop()
+
+    def join(self, timeout=None):
+        for stage in self.stages:
+            stage.join(timeout)
+
+    def is_alive(self):
+        return any(stage.is_alive() for stage in self.stages)
+
+    def stats(self):
+        return [stage.stats() for stage in self.stages]
@@ -0,0 +1,233 @@
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import argparse
+import datetime
+import numpy as np
+
+# Add project root to path to import gallery, ann_index and database
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+BACKENDS = ('memory', 'ann', 'sql-hnsw', 'sql-flat', 'bytea')
+BENCH_SCHEMA = 'facetrack_bench'
+
+
+def synthetic_gallery(n, dim=512, seed=0, chunk=100000):
+    """N deterministic visitor ids and L2-normalized Gaussian embeddings (filled in chunks)."""
+    rng = np.random.default_rng(seed)
+    embeddings = np.empty((n, dim), dtype=np.float32)
+    for start in range(0, n, chunk):
+        block = rng.standard_normal((min(chunk, n - start), dim), dtype=np.float32)
+        block /= np.linalg.norm(block, axis=1, keepdims=True)
+        embeddings[start:start + len(block)] = block
+    ids = [uuid.UUID(bytes=rng.bytes(16), version=4) for _ in range(n)]
+    return ids, embeddings
+
+
+def synthetic_queries(embeddings, count, noise, seed=1):
+    """
+    Re-sightings of known visitors: stored embeddings plus Gaussian noise.
+    Returns (queries, index of the visitor each query came from).
+    """
+    rng = np.random.default_rng(seed)
+    truth = rng.choice(len(embeddings), min(count, len(embeddings)), replace=False)
+    queries = embeddings[truth] + rng.normal(0, noise, (len(truth), embeddings.shape[1])).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return queries, truth
+
+
+# --- Backends ------------------------------------------------------------
+# Each setup returns (search(query) -> visitor_id, memory_bytes, cleanup()).
+
+def setup_memory(ids, embeddings, args):
+    import gallery
+    store = gallery.VisitorGallery(dim=embeddings.shape[1], initial_capacity=len(ids))
+    store.add_many(ids, embeddings)
+    return lambda q: store.match(q, -1.0)[0], store.matrix.nbytes, lambda: None
+
+
+def setup_ann(ids, embeddings, args):
+    import ann_index
+    index_dir = os.path.join(args.workdir, f"ann_{len(ids)}")
+    index = ann_index.IVFIndex.build(index_dir, ids, embeddings, nlist=args.nlist)
+    index.nprobe = args.nprobe
+    size = sum(os.path.getsize(os.path.join(index.segment_dir, f)) for f in os.listdir(index.segment_dir))
+    return lambda q: index.match(q, -1.0)[0], size, lambda: shutil.rmtree(index_dir, ignore_errors=True)
+
+
+def _bench_connection(config, storage):
+    """Connection whose search_path puts a scratch Visitors table in front of the real one."""
+    import database
+    conn = database.get_db_connection(dict(config, embedding_storage=storage))
+    if conn is None:
+        raise RuntimeError("could not connect to the database")
+    with conn.cursor() as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+        cur.execute(f"CREATE SCHEMA {BENCH_SCHEMA}")
+        cur.execute(f"SET search_path TO {BENCH_SCHEMA}, public")
+    conn.commit()
+    return conn
+
+
+def _fill_table(conn, ids, embeddings, storage, column, chunk=20000):
+    import database
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            CREATE TABLE Visitors (
+                visitor_id UUID PRIMARY KEY,
+                first_seen TIMESTAMPTZ DEFAULT NOW(),
+                last_seen TIMESTAMPTZ DEFAULT NOW(),
+                inserted_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                embedding {column} NOT NULL
+            )""")
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for start in range(0, len(ids), chunk):
+        rows = [(ids[i], embeddings[i], now) for i in range(start, min(len(ids), start + chunk))]
+        database.copy_visitors(conn, rows, storage)
+        conn.commit()
+
+
+def _drop_schema(conn):
+    with conn.cursor() as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+    conn.commit()
+    conn.close()
+
+
+def _table_bytes(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_total_relation_size('visitors')")
+        return cur.fetchone()[0]
+
+
+def _setup_sql(ids, embeddings, args, hnsw):
+    import database
+    conn = _bench_connection(args.config, 'vector')
+    _fill_table(conn, ids, embeddings, 'vector', f"vector({embeddings.shape[1]})")
+    with conn.cursor() as cur:
+        if hnsw:
+            cur.execute("CREATE INDEX ON Visitors USING hnsw (embedding vector_cosine_ops)")
+            cur.execute(f"SET hnsw.ef_search = {int(args.ef_search)}")
+        cur.execute("ANALYZE Visitors")
+    conn.commit()
+    return lambda q: database.find_visitor(conn, q, -1.0)[0], _table_bytes(conn), lambda: _drop_schema(conn)
+
+
+def setup_sql_hnsw(ids, embeddings, args):
+    return _setup_sql(ids, embeddings, args, hnsw=True)
+
+
+def setup_sql_flat(ids, embeddings, args):
+    return _setup_sql(ids, embeddings, args, hnsw=False)
+
+
+def setup_bytea(ids, embeddings, args):
+    """
+    db_schema_simple.sql stores BYTEA, which Postgres cannot search, so this
+    measures what that schema costs instead: loading every embedding at
+    startup (load_embedding_matrix, counted in setup time) and searching in memory.
+    """
+    import database
+    import gallery
+    conn = _bench_connection(args.config, 'bytea')
+    _fill_table(conn, ids, embeddings, 'bytea', 'BYTEA')
+    table_bytes = _table_bytes(conn)
+    loaded_ids, matrix, _ = database.load_embedding_matrix(conn, dim=embeddings.shape[1])
+    store = gallery.VisitorGallery(dim=embeddings.shape[1], initial_capacity=1)
+    store.merge_matrix(loaded_ids, matrix)
+    _drop_schema(conn)
+    return lambda q: store.match(q, -1.0)[0], table_bytes + store.matrix.nbytes, lambda: None
+
+
+SETUP = {
+    'memory': setup_memory,
+    'ann': setup_ann,
+    'sql-hnsw': setup_sql_hnsw,
+    'sql-flat': setup_sql_flat,
+    'bytea': setup_bytea,
+}
+
+
+def bench(backend, ids, embeddings, queries, truth, args):
+    started = time.perf_counter()
+    search, memory_bytes, cleanup = SETUP[backend](ids, embeddings, args)
+    setup_s = time.perf_counter() - started
+    try:
+        for q in queries[:args.warmup]:
+            search(q)
+        timings, hits = [], 0
+        started = time.perf_counter()
+        for q, expected in zip(queries, truth):
+            t0 = time.perf_counter()
+            found = search(q)
+            timings.append(time.perf_counter() - t0)
+            hits += found == ids[expected]
+        elapsed = time.perf_counter() - started
+    finally:
+        cleanup()
+
+    ms = np.array(timings) * 1000.0
+    return {
+        'backend': backend,
+        'visitors': len(ids),
+        'setup_s': setup_s,
+        'memory_mb': memory_bytes / 1e6,
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p95_ms': float(np.percentile(ms, 95)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'qps': len(queries) / elapsed if elapsed > 0 else 0.0,
+        'recall@1': hits / len(queries),
+    }
+
+
+def print_table(results):
+    print(f"{'backend':<10} {'visitors':>9} {'setup s':>9} {'MB':>9} {'p50 ms':>9} {'p95 ms':>9} "
+          f"{'p99 ms':>9} {'qps':>9} {'recall@1':>9}")
+    for r in results:
+        print(f"{r['backend']:<10} {r['visitors']:>9} {r['setup_s']:>9.2f} {r['memory_mb']:>9.1f} "
+              f"{r['p50_ms']:>9.3f} {r['p95_ms']:>9.3f} {r['p99_ms']:>9.3f} {r['qps']:>9.0f} {r['recall@1']:>9.3f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Identity search latency, throughput, recall@1 and memory vs. gallery size and backend')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Gallery sizes (1000000 needs ~2 GB for the embeddings alone)')
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=['memory', 'ann'],
+                        help="The SQL backends (sql-hnsw, sql-flat, bytea) use a scratch schema in the configured DB")
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--noise', type=float, default=0.05, help='Gaussian noise added to each query')
+    parser.add_argument('--nlist', type=int, default=None, help='IVF lists for ann (default: 4*sqrt(N))')
+    parser.add_argument('--nprobe', type=int, default=16, help='IVF lists searched per query')
+    parser.add_argument('--ef-search', type=int, default=40, help='hnsw.ef_search for sql-hnsw')
+    parser.add_argument('--config', default=os.path.join(project_root, 'config.json'))
+    parser.add_argument('--workdir', default=os.path.join('logs', 'bench'))
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        args.config = json.load(f)
+    os.makedirs(args.workdir, exist_ok=True)
+
+    results = []
+    for n in args.sizes:
+        ids, embeddings = synthetic_gallery(n)
+        queries, truth = synthetic_queries(embeddings, args.queries, args.noise)
+        for backend in args.backends:
+            print(f"... {backend} with {n} visitors")
+            try:
+                results.append(bench(backend, ids, embeddings, queries, truth, args))
+            except Exception as e:
+                print(f"{backend} skipped: {e}")
+        del ids, embeddings
+
+    print()
+    print_table(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
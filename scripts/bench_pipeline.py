@@ -0,0 +1,380 @@
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+import platform
+import subprocess
+import cv2
+import numpy as np
+
+# Add project root to path to import the pipeline modules
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+import database
+import event_writer
+import face_embedder
+import gallery
+import metrics
+import state_tracker
+from bench_tracker_state import SyntheticBoxes, NullWriter, BenchTracker
+
+
+class SyntheticVideo:
+    """
+    Writes a video of face-like patches drifting over a noisy background.
+
+    Each identity is an ellipse over its own random 4x4 colour grid, with
+    eyes and a mouth, so crops of one identity look alike and crops of
+    different identities don't. Identities come and go on a seeded
+    schedule and some come back later, so there are re-identifications.
+    The ground-truth boxes of every frame are kept for StubYOLO.
+    """
+    def __init__(self, path, frames=600, fps=25.0, size=(720, 1280), people=12, concurrent=4,
+                 face=96, seed=0):
+        self.path = path
+        self.frames = frames
+        self.fps = fps
+        self.size = size
+        self.face = face
+        self.rng = np.random.default_rng(seed)
+        self.patterns = [self._pattern() for _ in range(people)]
+        self.visits = self._schedule(people, concurrent)
+        self.boxes = [[] for _ in range(frames)]  # frame -> [(track_id, x1, y1, x2, y2)]
+
+    def _pattern(self):
+        grid = self.rng.integers(40, 230, (4, 4, 3), dtype=np.uint8)
+        patch = cv2.resize(grid, (self.face, self.face), interpolation=cv2.INTER_NEAREST)
+        mask = np.zeros((self.face, self.face), dtype=np.uint8)
+        c = self.face // 2
+        cv2.ellipse(mask, (c, c), (int(c * 0.8), int(c * 0.95)), 0, 0, 360, 255, -1)
+        patch[mask == 0] = 0
+        for ex in (int(self.face * 0.35), int(self.face * 0.65)):
+            cv2.circle(patch, (ex, int(self.face * 0.4)), max(2, self.face // 14), (20, 20, 20), -1)
+        cv2.ellipse(patch, (c, int(self.face * 0.7)), (self.face // 6, self.face // 14), 0, 0, 180, (30, 30, 120), 2)
+        return patch, mask
+
+    def _schedule(self, people, concurrent):
+        """[(track_id, person, start, stop, x, y, vx, vy)]; about `concurrent` on screen at a time."""
+        visits, track_id = [], 1
+        mean_visit = max(10, self.frames * concurrent // max(1, people))
+        for slot in range(concurrent):
+            t = int(self.rng.integers(0, mean_visit // 2 + 1))
+            while t < self.frames:
+                length = int(self.rng.integers(mean_visit // 2, mean_visit * 3 // 2 + 1))
+                h, w = self.size
+                visits.append((track_id, int(self.rng.integers(0, people)), t, min(self.frames, t + length),
+                               float(self.rng.uniform(0, w - self.face)), float(self.rng.uniform(0, h - self.face)),
+                               float(self.rng.uniform(-3, 3)), float(self.rng.uniform(-2, 2))))
+                track_id += 1
+                t += length + int(self.rng.integers(int(self.fps // 2), int(self.fps * 3)))  # gap > exit timeout sometimes
+        return visits
+
+    def write(self):
+        h, w = self.size
+        out = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*'mp4v'), self.fps, (w, h))
+        if not out.isOpened():
+            raise RuntimeError(f"Cannot write {self.path}")
+        background = self.rng.integers(60, 120, (h, w, 3), dtype=np.uint8)
+        for i in range(self.frames):
+            frame = background.copy()
+            for track_id, person, start, stop, x, y, vx, vy in self.visits:
+                if not start <= i < stop:
+                    continue
+                # Drift and bounce off the borders
+                px = int(abs((x + vx * (i - start)) % (2 * (w - self.face)) - (w - self.face)))
+                py = int(abs((y + vy * (i - start)) % (2 * (h - self.face)) - (h - self.face)))
+                patch, mask = self.patterns[person]
+                region = frame[py:py + self.face, px:px + self.face]
+                region[mask > 0] = patch[mask > 0]
+                self.boxes[i].append((track_id, px, py, px + self.face, py + self.face))
+            out.write(frame)
+        out.release()
+
+    def metadata(self):
+        return {'frames': self.frames, 'fps': self.fps, 'size': list(self.size),
+                'people': len(self.patterns), 'visits': len(self.visits), 'face': self.face,
+                'boxes': self.boxes}
+
+
+class StubResult:
+    def __init__(self, boxes):
+        self.boxes = boxes
+        self.keypoints = None
+
+
+class StubYOLO:
+    """
+    Stands in for ultralytics.YOLO: track() replays the ground-truth boxes
+    (already tracked) of each frame. Frames are told apart by call order,
+    so the stub runs with one detect worker and no frame skipping.
+    """
+    def __init__(self, boxes):
+        self.boxes = boxes
+        self.calls = 0
+
+    def track(self, frame, **kwargs):
+        rows = self.boxes[self.calls] if self.calls < len(self.boxes) else []
+        self.calls += 1
+        if not rows:
+            return []
+        rows = np.array(rows)
+        return [StubResult(SyntheticBoxes(rows[:, 0], rows[:, 1:5], np.full(len(rows), 0.9, dtype=np.float32)))]
+
+
+class TimedDetector:
+    """Wraps a detector and notes when the first frame reaches it, so model loading is not timed."""
+    def __init__(self, model):
+        self.model = model
+        self.started = None
+
+    def track(self, frame, **kwargs):
+        self.started = self.started or time.perf_counter()
+        return self.model.track(frame, **kwargs)
+
+    def predict(self, frame, **kwargs):
+        self.started = self.started or time.perf_counter()
+        return self.model.predict(frame, **kwargs)
+
+
+class StubEmbedder:
+    """
+    Deterministic appearance embedding: the crop at 16x16, mean-centred and
+    projected to 512-d by a fixed random matrix. Same identity -> similar
+    vectors, no model files needed.
+    """
+    def __init__(self, dim=512, seed=0):
+        self.projection = np.random.default_rng(seed).standard_normal((16 * 16 * 3, dim)).astype(np.float32)
+
+    def get_embeddings(self, crops, kps_list=None):
+        x = np.stack([cv2.resize(c, (16, 16), interpolation=cv2.INTER_AREA).reshape(-1) for c in crops])
+        x = x.astype(np.float32)
+        x -= x.mean(axis=1, keepdims=True)
+        emb = x @ self.projection
+        norms = np.linalg.norm(emb, axis=1, keepdims=True)
+        ok = norms[:, 0] > 0
+        return emb / np.maximum(norms, 1e-6), ok
+
+
+class QuietTracker(state_tracker.VisitorTracker):
+    """The real tracker (images included) without per-event console logging."""
+    def _log_system_event(self, message):
+        pass
+
+
+class CountingWriter(NullWriter):
+    """In-memory store: counts registrations and events instead of writing them."""
+    def __init__(self):
+        self.registered = 0
+        self.events = {'entry': 0, 'exit': 0}
+
+    def register_visitor(self, embedding, timestamp=None):
+        self.registered += 1
+        return super().register_visitor(embedding, timestamp)
+
+    def log_event(self, visitor_id, event_type, image_path, timestamp=None):
+        self.events[event_type] = self.events.get(event_type, 0) + 1
+
+    def close(self):
+        pass
+
+
+def rss_mb():
+    """(current, peak) resident set size in MB; None where it cannot be read."""
+    current = peak = None
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        current = info.rss / 1e6
+        if getattr(info, 'peak_wset', None):  # Windows
+            peak = info.peak_wset / 1e6
+    except ImportError:
+        pass
+    try:
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = maxrss / 1e6 if sys.platform == 'darwin' else maxrss / 1e3  # bytes on macOS, KB on Linux
+    except ImportError:
+        pass
+    return current, peak
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=project_root,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def prepare_video(args):
+    """Generates the synthetic video once per parameter set; returns its path and ground truth."""
+    os.makedirs(args.workdir, exist_ok=True)
+    name = f"synthetic_{args.frames}f_{args.people}p_{args.concurrent}c_s{args.seed}"
+    path = os.path.join(args.workdir, name + '.mp4')
+    truth_path = os.path.join(args.workdir, name + '.json')
+    if os.path.exists(path) and os.path.exists(truth_path):
+        with open(truth_path) as f:
+            return path, json.load(f)
+    video = SyntheticVideo(path, frames=args.frames, people=args.people, concurrent=args.concurrent, seed=args.seed)
+    video.write()
+    truth = video.metadata()
+    with open(truth_path, 'w') as f:
+        json.dump(truth, f)
+    return path, truth
+
+
+def build_config(args):
+    with open(args.config) as f:
+        config = json.load(f)
+    config.update({
+        'entry_log_dir': os.path.join(args.workdir, 'entries'),
+        'embedding_workers': 0,  # the benchmark times the in-process pipeline
+        'frame_skip': 1,
+        'capture_policy': 'block',
+        'gallery_sync_seconds': 0,
+        'media_clock': 'frame_index',
+        'metrics_enabled': True,
+        'metrics_port': None,
+    })
+    if args.detector == 'stub':
+        config['detect_workers'] = 1
+    if args.store == 'memory':
+        config.update({'identity_backend': 'memory', 'write_behind': True, 'db_async': False})
+    if args.no_images:
+        config['image_writer_threads'] = 0
+    return config
+
+
+class NullPool:
+    def close(self):
+        pass
+
+
+@contextlib.contextmanager
+def stand_ins(replacements):
+    """Replaces [(module, name, value)] attributes for the duration of the block."""
+    saved = [(module, name, getattr(module, name)) for module, name, _ in replacements]
+    for module, name, value in replacements:
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for module, name, value in saved:
+            setattr(module, name, value)
+
+
+def run(args):
+    """
+    Runs main.run_pipeline (capture thread, detect and track stages, writers)
+    headless on the synthetic video. The stub detector/embedder and the
+    in-memory store are swapped in for YOLO, FaceEmbedder and Postgres.
+    """
+    import main
+    video_path, truth = prepare_video(args)
+    config = build_config(args)
+    metrics.reset()
+
+    detectors, trackers = [], []
+    real_yolo = main.YOLO
+
+    def load_detector(model_path):
+        model = StubYOLO(truth['boxes']) if args.detector == 'stub' else real_yolo(model_path)
+        detectors.append(TimedDetector(model))
+        return detectors[-1]
+
+    def new_tracker(*a, **kwargs):
+        trackers.append((BenchTracker if args.no_images else QuietTracker)(*a, **kwargs))
+        return trackers[-1]
+
+    replacements = [(main, 'YOLO', load_detector), (state_tracker, 'VisitorTracker', new_tracker)]
+    if args.embedder == 'stub':
+        replacements.append((face_embedder, 'FaceEmbedder', lambda **kwargs: StubEmbedder()))
+    writer = None
+    if args.store == 'memory':
+        writer = CountingWriter()
+        replacements += [(database, 'get_db_pool', lambda config: NullPool()),
+                         (gallery, 'open_identity_store', lambda config, conn: gallery.VisitorGallery()),
+                         (event_writer, 'EventWriter', lambda config, pool=None: writer)]
+
+    with stand_ins(replacements):
+        main.run_pipeline(config, video_path, headless=True, camera_name='bench')
+    finished = time.perf_counter()
+    started = min((d.started for d in detectors if d.started is not None), default=finished)
+    elapsed = finished - started
+    tracker = trackers[0]
+
+    snapshot = metrics.snapshot()
+    frames = snapshot['counters'].get('frames', 0)
+    frame_ms = snapshot['stages'].get('frame', {})
+    current_rss, peak_rss = rss_mb()
+    result = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {k: v for k, v in vars(args).items() if k not in ('compare', 'output')},
+        'video': {k: v for k, v in truth.items() if k != 'boxes'},
+        'frames': int(frames),
+        'seconds': elapsed,
+        'fps': frames / elapsed if elapsed > 0 else 0.0,
+        # Detection start to tracker update, queueing between the stages included
+        'frame_ms': {
+            'mean': frame_ms.get('mean_ms', 0.0),
+            'p50': frame_ms.get('p50_ms', 0.0),
+            'p95': frame_ms.get('p95_ms', 0.0),
+            'p99': frame_ms.get('p99_ms', 0.0),
+            'max': frame_ms.get('max_ms', 0.0),
+        },
+        'memory_mb': {'rss': current_rss, 'peak_rss': peak_rss,
+                      'crops': tracker.crop_stats()['resident_bytes'] / 1e6},
+        'visitors': tracker.unique_visitor_count,
+        'stages': snapshot['stages'],
+    }
+    if writer is not None:
+        result['events'] = dict(writer.events)
+    return result
+
+
+def compare(result, baseline_path):
+    with open(baseline_path) as f:
+        base = json.load(f)
+
+    def delta(new, old):
+        return f"{(new - old) / old:+.1%}" if old else '-'
+
+    print(f"vs {baseline_path} ({base.get('revision')}):")
+    print(f"  fps       {base['fps']:>9.1f} -> {result['fps']:>9.1f}  {delta(result['fps'], base['fps'])}")
+    for key in ('p50', 'p95', 'p99'):
+        old, new = base['frame_ms'][key], result['frame_ms'][key]
+        print(f"  {key} ms    {old:>9.2f} -> {new:>9.2f}  {delta(new, old)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='End-to-end pipeline benchmark on a synthetic video')
+    parser.add_argument('--config', default=os.path.join(project_root, 'config.json'))
+    parser.add_argument('--workdir', default=os.path.join('logs', 'bench'))
+    parser.add_argument('--frames', type=int, default=600)
+    parser.add_argument('--people', type=int, default=12, help='Distinct identities in the video')
+    parser.add_argument('--concurrent', type=int, default=4, help='Faces on screen at a time')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--detector', choices=['stub', 'yolo'], default='stub',
+                        help="'stub' replays ground-truth boxes; 'yolo' runs yolo_model_path with ByteTrack")
+    parser.add_argument('--embedder', choices=['stub', 'real'], default='stub',
+                        help="'stub' is a deterministic appearance projection; 'real' loads FaceEmbedder")
+    parser.add_argument('--store', choices=['memory', 'postgres'], default='memory',
+                        help="'memory' keeps visitors/events in process; 'postgres' uses the configured DB")
+    parser.add_argument('--no-images', action='store_true', help='Skip writing entry/exit crops')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--compare', help='Earlier --output file to compare against')
+    args = parser.parse_args()
+
+    result = run(args)
+    print(json.dumps({k: v for k, v in result.items() if k != 'stages'}, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"Results written to {args.output}")
+    if args.compare:
+        compare(result, args.compare)
@@ -0,0 +1,120 @@
+import os
+import sys
+import time
+import uuid
+import argparse
+import numpy as np
+
+# Add project root to path to import state_tracker
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+import gallery
+import state_tracker
+# Stands in for ultralytics Boxes: .id, .xyxy and .conf
+from detection_log import RecordedBoxes as SyntheticBoxes
+
+
+class RandomEmbedder:
+    """Returns a random unit embedding per crop, so every new track is a new visitor."""
+    def __init__(self, seed=0):
+        self.rng = np.random.default_rng(seed)
+
+    def get_embeddings(self, crops, kps_list=None):
+        emb = self.rng.standard_normal((len(crops), 512)).astype(np.float32)
+        emb /= np.linalg.norm(emb, axis=1, keepdims=True)
+        return emb, np.ones(len(crops), dtype=bool)
+
+
+class NullWriter:
+    """In-memory replacement for EventWriter: ids are generated, nothing is written."""
+    def register_visitor(self, embedding, timestamp=None):
+        return uuid.uuid4()
+
+    def log_event(self, visitor_id, event_type, image_path, timestamp=None):
+        pass
+
+
+class BenchTracker(state_tracker.VisitorTracker):
+    """VisitorTracker without JPEG writes and console logging, so only state handling is timed."""
+    def _save_cropped_face(self, crop_img, visitor_id, event_type):
+        return f"{visitor_id}_{event_type}.jpg"
+
+    def _log_system_event(self, message):
+        pass
+
+
+class TrackStream:
+    """
+    Synthetic ByteTrack output: `n` concurrent tracks on a grid, each frame
+    `churn` of them end and are replaced by new track IDs.
+    """
+    def __init__(self, n, churn=0.02, frame_size=(1080, 1920), box=64, seed=0):
+        self.rng = np.random.default_rng(seed)
+        self.n = n
+        self.churn = churn
+        self.ids = np.arange(1, n + 1)
+        self.next_id = n + 1
+        h, w = frame_size
+        cols = max(1, w // box)
+        cells = np.arange(n) % (cols * max(1, h // box))
+        x1 = (cells % cols) * box
+        y1 = (cells // cols) * box
+        self.xyxy = np.stack([x1, y1, x1 + box - 4, y1 + box - 4], axis=1)
+        self.conf = np.full(n, 0.9, dtype=np.float32)
+
+    def next_frame(self):
+        replaced = self.rng.random(self.n) < self.churn
+        count = int(replaced.sum())
+        self.ids[replaced] = np.arange(self.next_id, self.next_id + count)
+        self.next_id += count
+        return SyntheticBoxes(self.ids.copy(), self.xyxy, self.conf)
+
+
+def run(n, frames, warmup, churn):
+    config = {
+        'aggregate_samples': 1,
+        'embed_min_quality': 0.0,
+        'embed_max_per_frame': 0,
+        'gallery_sync_seconds': 0,
+        'entry_log_dir': os.path.join('logs', 'bench'),
+    }
+    tracker = BenchTracker(config, gallery=gallery.VisitorGallery(), writer=NullWriter())
+    stream = TrackStream(n, churn=churn)
+    embedder = RandomEmbedder()
+    frame = np.random.default_rng(1).integers(0, 255, (1080, 1920, 3), dtype=np.uint8)
+
+    for _ in range(warmup):
+        tracker.update_frame(frame, stream.next_frame(), embedder, None)
+
+    timings = []
+    for _ in range(frames):
+        boxes = stream.next_frame()
+        started = time.perf_counter()
+        tracker.update_frame(frame, boxes, embedder, None)
+        timings.append(time.perf_counter() - started)
+
+    timings = np.array(timings) * 1000.0
+    return {
+        'tracks': n,
+        'mean_ms': float(timings.mean()),
+        'p95_ms': float(np.percentile(timings, 95)),
+        'us_per_track': float(timings.mean() * 1000.0 / n),
+        'active_tracks': len(tracker.active_tracks),
+        'visitors': len(tracker.visitors),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-frame VisitorTracker cost vs. concurrent tracks')
+    parser.add_argument('--tracks', type=int, nargs='+', default=[10, 50, 100, 250, 500, 1000])
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--churn', type=float, default=0.02,
+                        help='Fraction of tracks replaced by new track IDs each frame')
+    args = parser.parse_args()
+
+    print(f"{'tracks':>7} {'mean ms':>9} {'p95 ms':>9} {'us/track':>9} {'visitors':>9}")
+    for n in args.tracks:
+        r = run(n, args.frames, args.warmup, args.churn)
+        print(f"{r['tracks']:>7} {r['mean_ms']:>9.3f} {r['p95_ms']:>9.3f} {r['us_per_track']:>9.2f} {r['visitors']:>9}")
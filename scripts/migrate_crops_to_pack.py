@@ -0,0 +1,110 @@
+import os
+import re
+import sys
+import json
+import argparse
+import datetime
+
+# Add project root to path to import crop_pack and database
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+import crop_pack
+
+DAY_DIR = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+def day_dirs(root):
+    return sorted(name for name in os.listdir(root)
+                  if DAY_DIR.match(name) and os.path.isdir(os.path.join(root, name)))
+
+
+def migrate_day(root, day, pack, relink, delete, dry_run, batch_size):
+    """
+    Appends every JPEG of <root>/<day>/ to the day's pack and passes
+    [(ref, old_path), ...] batches to `relink` (None skips the DB).
+    Returns (files, bytes).
+    """
+    day_dir = os.path.join(root, day)
+    names = sorted(n for n in os.listdir(day_dir) if n.lower().endswith(('.jpg', '.jpeg')))
+    # Slot timestamps only pick the pack file; noon avoids any timezone edge
+    noon = datetime.datetime.strptime(day, '%Y-%m-%d').replace(hour=12)
+    moved, total_bytes, pairs = [], 0, []
+
+    def flush():
+        if pairs and relink is not None:
+            if relink(pairs) < 0:
+                raise RuntimeError(f"relinking events for {day} failed")
+        if delete:
+            for path in moved:
+                os.remove(path)
+        pairs.clear()
+        moved.clear()
+
+    for name in names:
+        path = os.path.join(day_dir, name)
+        with open(path, 'rb') as f:
+            data = f.read()
+        total_bytes += len(data)
+        if dry_run:
+            continue
+        ref = pack.append(data, now=noon)
+        pairs.append((ref, path))
+        moved.append(path)
+        if len(pairs) >= batch_size:
+            flush()
+    if not dry_run:
+        flush()
+        if delete and not os.listdir(day_dir):
+            os.rmdir(day_dir)
+    return len(names), total_bytes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Move per-event JPEGs (<entry_log_dir>/<date>/*.jpg) into per-day pack files')
+    parser.add_argument('--config', default=os.path.join(project_root, 'config.json'))
+    parser.add_argument('--root', default=None, help='Crop directory (default: entry_log_dir from the config)')
+    parser.add_argument('--include-today', action='store_true',
+                        help="Also migrate today's folder (only when nothing is writing to it)")
+    parser.add_argument('--no-db', action='store_true', help='Do not update Events.cropped_image_path')
+    parser.add_argument('--delete', action='store_true',
+                        help='Remove the JPEGs once packed and relinked (without it, a re-run packs them again)')
+    parser.add_argument('--dry-run', action='store_true', help='Only count files and bytes')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+    # Events store the path exactly as the tracker built it, so keep the configured root verbatim
+    root = args.root or config.get('entry_log_dir', 'logs/entries')
+    if not os.path.isdir(root):
+        print(f"No crop directory: {root}")
+        sys.exit(1)
+
+    db_conn = relink = None
+    if not (args.no_db or args.dry_run):
+        import database
+        db_conn = database.get_db_connection(config)
+        if db_conn is None:
+            print("FATAL: could not connect to the database (use --no-db to only pack files).")
+            sys.exit(1)
+        relink = lambda pairs: database.relink_event_images(db_conn, pairs)
+
+    today = datetime.date.today().strftime('%Y-%m-%d')
+    pack = crop_pack.CropPackWriter(root)
+    files = total = 0
+    try:
+        for day in day_dirs(root):
+            if day == today and not args.include_today:
+                print(f"{day}: skipped (today)")
+                continue
+            n, size = migrate_day(root, day, pack, relink, args.delete, args.dry_run, args.batch_size)
+            files += n
+            total += size
+            print(f"{day}: {n} files, {size / 1e6:.1f} MB")
+    finally:
+        pack.close()
+        if db_conn is not None:
+            db_conn.close()
+    print(f"{'Would migrate' if args.dry_run else 'Migrated'} {files} files ({total / 1e6:.1f} MB)")
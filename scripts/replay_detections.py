@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+
+# Add project root to path to import the pipeline modules
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+import detection_log
+import gallery
+import metrics
+from bench_tracker_state import BenchTracker
+from bench_pipeline import CountingWriter, QuietTracker, StubEmbedder
+
+
+class SequenceWriter(CountingWriter):
+    """
+    Counts like CountingWriter and keeps the event sequence with visitors
+    numbered in order of registration, so two replays can be compared
+    even though visitor ids are random UUIDs.
+    """
+    def __init__(self):
+        super().__init__()
+        self.ordinal = {}
+        self.sequence = []
+
+    def register_visitor(self, embedding, timestamp=None):
+        visitor_id = super().register_visitor(embedding, timestamp)
+        self.ordinal[visitor_id] = len(self.ordinal)
+        return visitor_id
+
+    def log_event(self, visitor_id, event_type, image_path, timestamp=None):
+        super().log_event(visitor_id, event_type, image_path, timestamp)
+        when = timestamp.timestamp() if timestamp is not None else None
+        self.sequence.append((event_type, self.ordinal.get(visitor_id, -1), when))
+
+    def digest(self):
+        return hashlib.sha1(json.dumps(self.sequence).encode()).hexdigest()[:16]
+
+
+def build_embedder(kind, log, config):
+    if kind == 'recorded':
+        if not log.has_embeddings:
+            print("FATAL: the log has no embeddings (record with record_embeddings); use --embedder stub or real")
+            sys.exit(1)
+        return detection_log.RecordedEmbedder()
+    if kind == 'stub':
+        return StubEmbedder()
+    import face_embedder
+    if not log.has_crops:
+        print("WARNING: the log has no crops; the real embedder will see a placeholder texture")
+    return face_embedder.FaceEmbedder(use_gpu=config.get('use_gpu', False),
+                                      mode=config.get('embedding_mode', 'aligned'),
+                                      max_batch_size=config.get('embedding_batch_size', 32))
+
+
+def run_once(log, config, args):
+    db_conn = None
+    if args.store == 'memory':
+        store, writer = gallery.VisitorGallery(), SequenceWriter()
+    else:
+        import database
+        import event_writer
+        db_conn = database.get_db_pool(config)
+        if db_conn is None:
+            print("FATAL: Could not connect to database.")
+            sys.exit(1)
+        store = gallery.open_identity_store(config, db_conn)
+        writer = event_writer.EventWriter(config, pool=db_conn)
+
+    embedder = build_embedder(args.embedder, log, config)
+    tracker_class = QuietTracker if args.images else BenchTracker
+    tracker = tracker_class(config, gallery=store, writer=writer)
+
+    started = time.perf_counter()
+    timings = detection_log.replay(log, tracker, embedder, db_conn)
+    writer.close()
+    elapsed = time.perf_counter() - started
+    if db_conn is not None:
+        db_conn.close()
+
+    timings = np.array(timings) * 1000.0 if timings else np.zeros(1)
+    result = {
+        'frames': len(log),
+        'seconds': elapsed,
+        'fps': len(log) / elapsed if elapsed > 0 else 0.0,
+        'update_ms': {'mean': float(timings.mean()), 'p50': float(np.percentile(timings, 50)),
+                      'p95': float(np.percentile(timings, 95)), 'max': float(timings.max())},
+        'visitors': tracker.unique_visitor_count,
+    }
+    if isinstance(writer, SequenceWriter):
+        result['events'] = dict(writer.events)
+        result['events_digest'] = writer.digest()
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Re-run VisitorTracker on a recorded detection log (no YOLO, full speed)')
+    parser.add_argument('log', help='.npz written with "record_detections" in config.json')
+    parser.add_argument('--config', default=os.path.join(project_root, 'config.json'))
+    parser.add_argument('--embedder', choices=['recorded', 'stub', 'real'], default='recorded',
+                        help="'recorded' uses the log's embeddings; 'stub' and 'real' embed the recorded crops")
+    parser.add_argument('--store', choices=['memory', 'postgres'], default='memory')
+    parser.add_argument('--images', action='store_true', help='Also write entry/exit crops (inline)')
+    parser.add_argument('--repeat', type=int, default=1, help='Replays; the digest must match across them')
+    parser.add_argument('--output', help='Write the last result as JSON to this file')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+    config.update({'embedding_workers': 0, 'gallery_sync_seconds': 0, 'metrics_port': None,
+                   'entry_log_dir': os.path.join('logs', 'replay')})
+    metrics.from_config(config)
+
+    log = detection_log.DetectionLog(args.log)
+    print(f"{args.log}: {len(log)} frames, {log.meta['detections']} detections, "
+          f"crops={'yes' if log.has_crops else 'no'}, embeddings={'yes' if log.has_embeddings else 'no'}")
+
+    digests = set()
+    for i in range(args.repeat):
+        result = run_once(log, config, args)
+        digests.add(result.get('events_digest'))
+        print(json.dumps(result))
+    if len(digests) > 1:
+        print("WARNING: replays produced different event sequences")
+    if metrics.enabled():
+        for line in metrics.summary_lines():
+            print(f"  {line}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
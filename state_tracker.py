@@ -1,10 +1,17 @@
 import time
 import os
-import datetime
+import concurrent.futures
 import cv2
 import numpy as np
 import logging
 import database  # Our database module
+import embedding_scheduler
+import crop_pack
+import crop_store
+import hot_cache
+import media_clock
+import metrics
+import track_embeddings
 
 # Configure the system-wide event logger
 logging.basicConfig(
@@ -13,33 +20,163 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+class TrackRecord:
+    """An identified ByteTrack track. `first_seen` stamps the visitor's entry event."""
+    __slots__ = ('track_id', 'visitor', 'first_seen', 'last_frame')
+
+    def __init__(self, track_id, visitor, first_seen):
+        self.track_id = track_id
+        self.visitor = visitor
+        self.first_seen = first_seen
+        self.last_frame = -1
+
+
+class VisitorRecord:
+    """
+    A visitor with active tracks or an open visit. `tracks` is the
+    visitor -> tracks reverse index; exit_started is set while the visitor
+    sits in pending_exit.
+    """
+    __slots__ = ('visitor_id', 'tracks', 'entry_logged', 'exit_started', 'last_frame')
+
+    def __init__(self, visitor_id):
+        self.visitor_id = visitor_id
+        self.tracks = set()
+        self.entry_logged = False
+        self.exit_started = None
+        self.last_frame = -1
+
+
+class PendingTrack:
+    """
+    A track whose identity is being resolved by the worker pool. last_crop
+    is only held until the crop has been handed to the pool.
+    """
+    __slots__ = ('first_seen', 'last_crop', 'kps', 'quality', 'submitted')
+
+    def __init__(self, first_seen, last_crop, kps, quality):
+        self.first_seen = first_seen
+        self.last_crop = last_crop
+        self.kps = kps
+        self.quality = quality
+        self.submitted = False
+
+
 class VisitorTracker:
     """
     Manages the state of tracked visitors to ensure robust, "exactly one"
     entry/exit logging per visit.
     """
-    def __init__(self, config):
+    def __init__(self, config, gallery=None, writer=None, async_db=None, identity_pool=None,
+                 image_writer=None, clock=None):
         self.similarity_threshold = config.get('similarity_threshold', 0.6)
         self.exit_timeout = config.get('exit_timeout_seconds', 3.0)
         self.entry_log_dir = config.get('entry_log_dir', 'logs/entries')
+
+        # Tracker time (media_clock.py): exit timeouts, retry backoff, the hot
+        # tier's TTL and event timestamps all follow it. Wall time by default;
+        # a MediaClock advanced per frame lets recorded video run at full speed.
+        # Read once per frame into self._now.
+        self.clock = clock or media_clock.WallClock()
+        self._now = self.clock.now()
+
+        # Optional in-memory gallery (gallery.VisitorGallery). When set,
+        # identity search runs in-process instead of one SQL query per track.
+        # It is re-synced with the DB every gallery_sync_seconds so visitors
+        # registered by other cameras are picked up (on wall time: it polls
+        # the DB, whatever the tracker clock says).
+        self.gallery = gallery
+        self.gallery_sync_interval = config.get('gallery_sync_seconds', 2.0)
+        self._last_gallery_sync = time.time()
+        # Optional database.AsyncDatabase. When set, the gallery sync query
+        # runs on the DB loop and is merged on a later frame. Without a
+        # gallery (identity_backend "sql") the per-track SQL lookups run there
+        # too: the track waits in pending_identity until its result is back.
+        self.async_db = async_db
+        self._gallery_sync_future = None
+        self._async_lookups = async_db is not None and gallery is None
+        self._lookup_futures = []  # [(future, track_id, embedding, first_seen, tiers, started), ...]
+
+        # Optional event_writer.EventWriter. When set, registrations and
+        # entry/exit events are queued and group-committed in the background
+        # instead of one INSERT + COMMIT per row on the frame loop.
+        self.writer = writer
+
+        # Optional image_writer.ImageWriter. When set, entry/exit crops are
+        # JPEG-encoded and written on background threads; the path is
+        # returned straight away (None if the bounded queue dropped it).
+        self.image_writer = image_writer
+        # Inline writes into per-day pack files when there is no background writer
+        self.crop_pack = None
+        if image_writer is None and config.get('image_storage', 'files') == 'pack':
+            self.crop_pack = crop_pack.CropPackWriter(self.entry_log_dir)
+
+        # Hot re-ID tier: recently seen visitors are searched first, the
+        # global gallery/index (or SQL) only on a miss. hot_cache_size = 0
+        # disables it. Lookups and latency are counted per tier.
+        hot_size = config.get('hot_cache_size', 256)
+        self.hot = hot_cache.HotVisitorCache(capacity=hot_size, ttl=config.get('hot_cache_ttl_seconds', 300.0)) \
+            if hot_size > 0 else None
+        self.tier_stats = {'hot': hot_cache.TierStats(), 'global': hot_cache.TierStats()}
+
+        # Optional identity_workers.IdentityWorkerPool. When set, new tracks
+        # are embedded in worker processes and wait in pending_identity until
+        # the result comes back; the frame loop never waits for ONNX.
+        self.identity_pool = identity_pool
+        self._identity_futures = []  # [(future, [track_id, ...]), ...]
+
+        # Decides which unidentified tracks are worth an embedding this frame
+        # (crop quality gate, per-track retry backoff, per-frame cap).
+        self.scheduler = embedding_scheduler.EmbeddingScheduler(config)
+
+        # Multi-frame aggregation: a track's identity is committed from the
+        # quality-weighted mean of its best aggregate_samples embeddings,
+        # collected over at most aggregate_window_seconds. A fused embedding
+        # that matches by aggregate_early_margin above the threshold commits
+        # straight away. aggregate_samples = 1 commits on the first embedding.
+        self.aggregate_samples = config.get('aggregate_samples', 3)
+        self.aggregate_window = config.get('aggregate_window_seconds', 1.0)
+        self.aggregate_early_margin = config.get('aggregate_early_margin', 0.1)
+        self.samples = track_embeddings.TrackEmbeddingBuffer(k=self.aggregate_samples)
+
+        # Entry/exit images. Only a compact copy of each track's best crop is
+        # kept (keyed by track_id, or ('exit', visitor_id) while the visitor
+        # is in pending_exit), never a view that would pin the whole frame.
+        self.crops = crop_store.CropStore(budget_bytes=int(config.get('crop_budget_mb', 64) * 1024 * 1024),
+                                          max_side=config.get('crop_max_side', 160))
         
-        # State Dictionaries:
+        # State Dictionaries (records are updated in place every frame):
         
-        # 1. {track_id (int): {'visitor_id': UUID, 'last_crop': np.array}}
-        #    Maps a *transient* ByteTrack ID to our *persistent* visitor_ID
-        #    and stores the last known image crop for exit logging.
+        # 1. {track_id (int): TrackRecord}
+        #    Maps a *transient* ByteTrack ID to our *persistent* visitor.
+        #    Its best crop (for entry/exit logging) is in self.crops.
         self.active_tracks = {}
 
-        # 2. {visitor_id (UUID): {'timestamp': float, 'last_crop': np.array}}
-        #    A buffer for visitors who have disappeared from frame.
-        #    If they don't reappear within self.exit_timeout, they are
-        #    logged as an 'exit'.
+        # 1b. {track_id (int): PendingTrack}
+        #    Tracks whose identity is being resolved by identity_pool.
+        self.pending_identity = {}
+
+        # 2. {visitor_id (UUID): VisitorRecord}
+        #    Every visitor with an active track or an open visit. Each
+        #    record knows its tracks and whether its 'entry' was logged for
+        #    the *current visit* (prevents duplicate entry logs).
+        self.visitors = {}
+
+        # 3. {visitor_id (UUID): VisitorRecord}
+        #    A buffer for visitors who have disappeared from frame, in the
+        #    order they disappeared. If they don't reappear within
+        #    self.exit_timeout, they are logged as an 'exit'.
         self.pending_exit = {}
-        
-        # 3. {visitor_id (UUID)}
-        #    A set of visitors who have already logged an 'entry' event
-        #    for their *current visit*. This prevents duplicate entry logs.
-        self.logged_entry_this_visit = set()
+
+        # Frame counter; records are stamped with the last frame they were seen in
+        self._frame = 0
+
+        # In-memory counters, so the display never has to query the DB.
+        # unique_visitor_count is seeded from the Visitors table at startup
+        # (see main.py) and incremented on every registration.
+        # current_occupancy goes up on 'entry' and down on 'exit'.
+        self.unique_visitor_count = 0
+        self.current_occupancy = 0
         
         # Ensure log directories exist
         os.makedirs(self.entry_log_dir, exist_ok=True)
@@ -55,142 +192,555 @@ class VisitorTracker:
         Saves a cropped face image to the filesystem.
         Logs to a dated folder structure as required.[12, 13, 1]
         """
+        if self.image_writer is not None:
+            return self.image_writer.save(crop_img, visitor_id, event_type, now=self.clock.to_local(self._now))
         try:
-            today_str = datetime.datetime.now().strftime('%Y-%m-%d')
+            now = self.clock.to_local(self._now)
+            if self.crop_pack is not None:
+                with metrics.timer('imwrite'):
+                    return self.crop_pack.append_image(crop_img, now=now)
+            today_str = now.strftime('%Y-%m-%d')
             today_dir = os.path.join(self.entry_log_dir, today_str)
             os.makedirs(today_dir, exist_ok=True)
             
-            timestamp_str = datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+            timestamp_str = now.strftime('%Y%m%d_%H%M%S_%f')
             filename = f"{visitor_id}_{event_type}_{timestamp_str}.jpg"
             filepath = os.path.join(today_dir, filename)
             
-            cv2.imwrite(filepath, crop_img)
+            with metrics.timer('imwrite'):
+                cv2.imwrite(filepath, crop_img)
             return filepath
         except Exception as e:
             self._log_system_event(f"ERROR: Failed to save image for {visitor_id}: {e}")
             return None
 
-    def update_frame(self, frame, tracks, embedder, db_conn):
+    def _register_visitor(self, db_conn, embedding):
+        metrics.inc('registrations')
+        with metrics.timer('register'):
+            # Visitors.first_seen stays on wall time whatever the tracker clock
+            # says; only Events carry media time. (Gallery syncs read the
+            # server-stamped inserted_at, so they never depend on either.)
+            if self.writer is not None:
+                return self.writer.register_visitor(embedding)
+            return database.register_new_visitor(db_conn, embedding)
+
+    def _log_event(self, db_conn, visitor_id, event_type, image_path, timestamp=None):
+        metrics.inc('events_' + event_type)
+        with metrics.timer('log_event'):
+            if self.writer is not None:
+                self.writer.log_event(visitor_id, event_type, image_path, timestamp=timestamp)
+            else:
+                database.log_event(db_conn, visitor_id, event_type, image_path, timestamp=timestamp)
+
+    def _assign_identity(self, db_conn, embedding, match=None, tiers=None):
+        """
+        Finds (or registers) the visitor for an embedding. `match` is a
+        (visitor_id, similarity) result already computed by a worker.
+        Returns the visitor_id, or None if registration failed.
+        """
+        # Check if this face is already known
+        if match is not None:
+            visitor_id, sim = match
+        else:
+            visitor_id, sim = self._search(db_conn, embedding, tiers)
+
+        if visitor_id is None:
+            # New Unique Visitor. Register them.
+            visitor_id = self._register_visitor(db_conn, embedding)
+            if not visitor_id:
+                return None
+            self.unique_visitor_count += 1
+            if self.gallery is not None:
+                self.gallery.add(visitor_id, embedding)
+            self._log_system_event(f"AUTO-REGISTER: New unique visitor detected: {visitor_id}")
+        else:
+            self._log_system_event(f"RE-ID: Recognized returning visitor {visitor_id} (Sim: {sim:.2f})")
+        if self.hot is not None:
+            self.hot.put(visitor_id, embedding, now=self._now)
+        return visitor_id
+
+    def _search_hot(self, embedding, tiers=None):
+        """
+        Hot tier lookup. Returns (visitor_id, similarity) or (None, 0).
+        The outcome is appended to `tiers` as (tier, hit, seconds); see
+        _record_tiers.
+        """
+        if self.hot is None:
+            return None, 0
+        started = time.perf_counter()
+        visitor_id, sim = self.hot.match(embedding, self.similarity_threshold, now=self._now)
+        elapsed = time.perf_counter() - started
+        if tiers is not None:
+            tiers.append(('hot', visitor_id is not None, elapsed))
+        metrics.observe('search_hot', elapsed)
+        return visitor_id, sim
+
+    def _search(self, db_conn, embedding, tiers=None):
+        """Tiered identity search: hot tier first, then the gallery/index or SQL."""
+        visitor_id, sim = self._search_hot(embedding, tiers)
+        if visitor_id is not None:
+            return visitor_id, sim
+
+        started = time.perf_counter()
+        if self.gallery is not None:
+            visitor_id, sim = self.gallery.match(embedding, self.similarity_threshold)
+        else:
+            visitor_id, sim = database.find_visitor(db_conn, embedding, self.similarity_threshold)
+        elapsed = time.perf_counter() - started
+        if tiers is not None:
+            tiers.append(('global', visitor_id is not None, elapsed))
+        metrics.observe('search', elapsed)
+        return visitor_id, sim
+
+    def _record_tiers(self, tiers):
+        """Counts the tiers of the lookup that decided one track's identity."""
+        for tier, hit, seconds in tiers:
+            self.tier_stats[tier].record(hit, seconds)
+
+    def _commit_identity(self, db_conn, track_id, embedding, first_seen, match=None, tiers=None):
+        """
+        Assigns the track its visitor and makes it active. Returns the
+        TrackRecord, or None if registration failed or the SQL lookup was
+        sent to the async pool (the track is then pending until it returns).
+        `tiers` are the tier outcomes of the lookup that produced `match`;
+        they are counted here, once per identification.
+        """
+        self.scheduler.finish(track_id)
+        tiers = [] if tiers is None else tiers
+        if match is None and self._async_lookups:
+            match = self._search_hot(embedding, tiers)
+            if match[0] is None:
+                self._submit_lookup(track_id, embedding, first_seen, tiers)
+                return None
+        visitor_id = self._assign_identity(db_conn, embedding, match, tiers)
+        self._record_tiers(tiers)
+        if visitor_id is None:
+            return None # Failed to register, skip
+        visitor = self.visitors.get(visitor_id)
+        if visitor is None:
+            visitor = self.visitors[visitor_id] = VisitorRecord(visitor_id)
+        track = TrackRecord(track_id, visitor, first_seen)
+        visitor.tracks.add(track)
+        self.active_tracks[track_id] = track
+        return track
+
+    def _commit_buffered(self, db_conn, track_id, match=None, tiers=None):
+        """Commits a track from its fused samples and frees its buffer slot."""
+        fused = self.samples.fused(track_id)
+        first_seen = self.samples.first_seen(track_id)
+        self.samples.release(track_id)
+        return self._commit_identity(db_conn, track_id, fused, first_seen, match, tiers)
+
+    def _add_sample(self, db_conn, track_id, embedding, quality, first_seen, match=None):
+        """
+        Feeds one embedding of an unidentified track. Returns the TrackRecord
+        once the track's identity is committed, or None while more samples
+        are wanted. `match` is a worker's lookup for this single embedding,
+        only usable when no aggregation is done.
+        """
+        if self.aggregate_samples <= 1:
+            return self._commit_identity(db_conn, track_id, embedding, first_seen, match)
+
+        now = self._now
+        count = self.samples.add(track_id, embedding, quality, first_seen, now)
+        tiers = []
+        if self._async_lookups:
+            # No early commit: one async SQL lookup per track, at commit time
+            match, early = None, False
+        else:
+            # Only the lookup the track is committed with is counted in tier_stats
+            match = self._search(db_conn, self.samples.fused(track_id), tiers)
+            early = match[0] is not None and match[1] >= self.similarity_threshold + self.aggregate_early_margin
+        if not early and count < self.aggregate_samples and self.samples.age(track_id, now) < self.aggregate_window:
+            return None
+        return self._commit_buffered(db_conn, track_id, match, tiers)
+
+    def _submit_lookup(self, track_id, embedding, first_seen, tiers):
+        """Sends a track's SQL identity lookup to the async pool; the track stays pending."""
+        future = self.async_db.submit(self.async_db.find_visitor(embedding, self.similarity_threshold))
+        pending = PendingTrack(first_seen, None, None, 0.0)
+        pending.submitted = True
+        self.pending_identity[track_id] = pending
+        self._lookup_futures.append((future, track_id, embedding, first_seen, tiers, time.perf_counter()))
+
+    def _collect_lookups(self, db_conn):
+        """
+        Commits every track whose async SQL lookup finished. A failed lookup
+        drops the track from pending_identity, so it is embedded again on
+        the next frame it is seen. Returns the VisitorRecords resolved.
+        """
+        resolved = []
+        for entry in [e for e in self._lookup_futures if e[0].done()]:
+            self._lookup_futures.remove(entry)
+            future, track_id, embedding, first_seen, tiers, started = entry
+            if self.pending_identity.pop(track_id, None) is None:
+                continue
+            elapsed = time.perf_counter() - started
+            try:
+                match = future.result()
+            except Exception as e:
+                self._log_system_event(f"ERROR: Identity lookup failed: {e}")
+                continue
+            tiers.append(('global', match[0] is not None, elapsed))
+            metrics.observe('search', elapsed)
+            track = self._commit_identity(db_conn, track_id, embedding, first_seen, match, tiers)
+            if track is not None:
+                resolved.append(track.visitor)
+        return resolved
+
+    def _submit_identities(self):
+        """Sends pending tracks to the worker pool, as far as it has capacity."""
+        waiting = [tid for tid, p in self.pending_identity.items() if not p.submitted]
+        if not waiting or self.identity_pool.capacity() == 0:
+            return
+        crops = [self.pending_identity[tid].last_crop for tid in waiting]
+        kps_list = [self.pending_identity[tid].kps for tid in waiting]
+        for future, start, stop in self.identity_pool.submit(crops, kps_list):
+            self._identity_futures.append((future, waiting[start:stop]))
+        for tid in waiting:
+            self.pending_identity[tid].submitted = True
+            self.pending_identity[tid].last_crop = None
+
+    def _collect_identities(self, db_conn):
+        """
+        Applies every finished worker result. Resolved tracks move to
+        active_tracks; failed ones are dropped from pending_identity and
+        picked up again on the next frame they are seen.
+        Returns the VisitorRecords resolved.
+        """
+        resolved = []
+        for entry in [e for e in self._identity_futures if e[0].done()]:
+            self._identity_futures.remove(entry)
+            future, track_ids = entry
+            try:
+                embeddings, ok, matches = future.result()
+            except Exception as e:
+                self._log_system_event(f"ERROR: Identity worker failed: {e}")
+                self.identity_pool.failed(future, e)  # restarts a broken pool
+                for track_id in track_ids:
+                    self.pending_identity.pop(track_id, None)
+                continue
+
+            for j, track_id in enumerate(track_ids):
+                pending = self.pending_identity.pop(track_id, None)
+                if pending is None:
+                    continue
+                if not ok[j]:
+                    # Bad crop, retried after a backoff if the track is still visible
+                    self.scheduler.record_failure(track_id, self._now)
+                    continue
+                self.scheduler.record_success(track_id, self._now)
+                track = self._add_sample(db_conn, track_id, embeddings[j], pending.quality,
+                                         pending.first_seen, matches[j] if matches is not None else None)
+                if track is not None:
+                    resolved.append(track.visitor)
+        return resolved
+
+    def _sync_gallery(self, db_conn):
+        """Picks up visitors registered by other processes (see gallery.py)."""
+        if self._gallery_sync_future is not None:
+            if not self._gallery_sync_future.done():
+                return
+            future, self._gallery_sync_future = self._gallery_sync_future, None
+            try:
+                self.unique_visitor_count += self.gallery.merge_rows(future.result())
+            except Exception as e:
+                self._log_system_event(f"ERROR: Gallery sync failed: {e}")
+            self._last_gallery_sync = time.time()
+            return
+
+        if time.time() - self._last_gallery_sync < self.gallery_sync_interval:
+            return
+        if self.async_db is not None:
+            self._gallery_sync_future = self.async_db.submit(
+                self.async_db.fetch_visitor_embeddings(since=self.gallery.sync_cutoff()))
+        else:
+            self.unique_visitor_count += self.gallery.sync(db_conn)
+            self._last_gallery_sync = time.time()
+
+    def counters(self):
+        """Returns the live visitor counters shown on the display."""
+        return {
+            'unique_visitors': self.unique_visitor_count,
+            'occupancy': self.current_occupancy,
+        }
+
+    def reid_stats(self):
+        """Per-tier ('hot', 'global') lookups, hit rate and latency of identity searches."""
+        return {tier: stats.summary() for tier, stats in self.tier_stats.items()}
+
+    def image_stats(self):
+        """Background image writer stats (queue depth, written, dropped), or None when writing inline."""
+        return self.image_writer.stats() if self.image_writer is not None else None
+
+    def crop_stats(self):
+        """Retained crops: count, resident_bytes against budget_bytes, copies and evictions."""
+        return self.crops.stats()
+
+    def embedding_stats(self):
+        """Embedding attempt counters: skipped (quality/backoff/cap), attempted, succeeded, failed."""
+        return self.scheduler.stats()
+
+    def _mark_seen(self, visitor, frame_no, seen):
+        """Stamps a visitor as visible in this frame (once) and collects it in `seen`."""
+        if visitor.last_frame != frame_no:
+            visitor.last_frame = frame_no
+            seen.append(visitor)
+            if self.hot is not None:
+                self.hot.touch(visitor.visitor_id, now=self._now)
+
+    def update_frame(self, frame, tracks, embedder, db_conn, keypoints=None, embed_limit=None):
         """
         Main logic loop. Processes all tracks from a single frame.
         'tracks' is the results.boxes object from Ultralytics.
+        'keypoints' (optional) is an (N, 5, 2) array of face keypoints in
+        frame coordinates, one row per box, used to align crops.
+        'embed_limit' (optional) lowers embed_max_per_frame for this frame,
+        e.g. to 0 while the pipeline is overloaded (see pipeline.py).
+        The caller advances self.clock to this frame beforehand.
         """
-        
+        # Every record seen this frame is stamped with the frame number, so
+        # "still visible" and "lost" are checks on the records themselves.
+        self._frame += 1
+        frame_no = self._frame
         current_track_ids = set()
-        current_visitor_ids_in_frame = set()
+        seen_visitors = []  # VisitorRecords visible in this frame, each once
+        self._now = self.clock.now()
+        now = self.clock.to_datetime(self._now)
+
+        if self.gallery is not None and self.gallery_sync_interval > 0:
+            self._sync_gallery(db_conn)
+
+        # Identities that came back from the worker pool since the last frame.
+        # They get their entry logged below even if the track is already gone.
+        resolved_visitors = []
+        if self.identity_pool is not None:
+            resolved_visitors = self._collect_identities(db_conn)
+        if self._lookup_futures:
+            resolved_visitors += self._collect_lookups(db_conn)
 
         if tracks.id is None:
             # No tracks in this frame
             pass
         else:
-            track_ids = tracks.id.int().cpu().tolist()
-            bboxes = tracks.xyxy.int().cpu().tolist()
+            with metrics.timer('to_list'):
+                track_ids = tracks.id.int().cpu().tolist()
+                bboxes = tracks.xyxy.int().cpu().tolist()
+                confs = tracks.conf.cpu().tolist() if getattr(tracks, 'conf', None) is not None else None
+            current_track_ids.update(track_ids)
             
             # --- LOOP 1: Identify all tracks in the current frame ---
-            for track_id, bbox in zip(track_ids, bboxes):
-                current_track_ids.add(track_id)
+            new_tracks = []  # (track_id, crop_img, kps, conf) for tracks we haven't identified yet
+            for i, (track_id, bbox) in enumerate(zip(track_ids, bboxes)):
                 x1, y1, x2, y2 = bbox
                 crop_img = frame[y1:y2, x1:x2]
+                conf = confs[i] if confs is not None else None
 
-                visitor_id = None
-                
-                if track_id in self.active_tracks:
+                # Keep a copy of this track's crop only if it beats the one
+                # held (bigger, more confident face)
+                self.crops.offer(track_id, crop_img, min(x2 - x1, y2 - y1) * (conf if conf is not None else 1.0))
+
+                track = self.active_tracks.get(track_id)
+                if track is not None:
                     # 1.1: This is a known track
-                    visitor_id = self.active_tracks[track_id]['visitor_id']
+                    track.last_frame = frame_no
+                    self._mark_seen(track.visitor, frame_no, seen_visitors)
+                    continue
+
+                kps = None
+                if keypoints is not None and i < len(keypoints):
+                    kps = keypoints[i] - np.array([x1, y1], dtype=np.float32)
+
+                pending = self.pending_identity.get(track_id)
+                if pending is not None:
+                    # 1.1b: Identity still being resolved by a worker
+                    if not pending.submitted:
+                        pending.last_crop = crop_img
+                        pending.kps = kps
+                else:
+                    new_tracks.append((track_id, crop_img, kps, conf))
+
+            # 1.2: Only good enough crops of tracks not in retry backoff are
+            #      embedded, best first and at most embed_max_per_frame.
+            to_embed = self.scheduler.select(new_tracks, self._now, now, limit=embed_limit) if new_tracks else []
+
+            if self.identity_pool is not None:
+                # 1.3: Hand them to the worker pool; they stay pending
+                #      (no entry yet) until their identity comes back.
+                for track_id, crop_img, kps, quality in to_embed:
+                    self.pending_identity[track_id] = PendingTrack(
+                        self.scheduler.first_seen(track_id, now), crop_img, kps, quality)
+                to_embed = []
+
+            # 1.3: Embed the selected tracks of this frame in one batch
+            embeddings, ok = [], []
+            if to_embed:
+                with metrics.timer('embed'):
+                    embeddings, ok = embedder.get_embeddings([t[1] for t in to_embed], [t[2] for t in to_embed])
+                metrics.inc('embeddings', len(to_embed))
+            for (track_id, crop_img, _, quality), embedding, valid in zip(to_embed, embeddings, ok):
+                if not valid:
+                    # Bad crop: back off before trying this track again
+                    self.scheduler.record_failure(track_id, self._now)
+                    continue
+                self.scheduler.record_success(track_id, self._now)
+
+                # 1.4: Add the sample; once enough are in (or one matches
+                #      clearly), match against known visitors or register
+                #      a new one, and add the track to our active state.
+                track = self._add_sample(db_conn, track_id, embedding, quality,
+                                         self.scheduler.first_seen(track_id, now))
+                if track is not None:
+                    track.last_frame = frame_no
+                    self._mark_seen(track.visitor, frame_no, seen_visitors)
+
+        # 1.5: Commit buffered tracks whose window is over, or that left the
+        #      frame before collecting aggregate_samples embeddings.
+        if len(self.samples):
+            for track_id in self.samples.track_ids():
+                if track_id in self.pending_identity:
+                    continue # A sample is still in flight
+                if track_id in current_track_ids and self.samples.age(track_id, self._now) < self.aggregate_window:
+                    continue
+                track = self._commit_buffered(db_conn, track_id)
+                if track is None:
+                    continue
+                if track_id in current_track_ids:
+                    track.last_frame = frame_no
+                    self._mark_seen(track.visitor, frame_no, seen_visitors)
                 else:
-                    # 1.2: This is a new track. Get embedding.
-                    embedding = embedder.get_embedding(crop_img)
-                    
-                    if embedding is None:
-                        continue # Bad crop, skip this track for now
-
-                    # 1.3: Check if this face is already in our DB
-                    visitor_id, sim = database.find_visitor(db_conn, embedding, self.similarity_threshold)
-                    
-                    if visitor_id is None:
-                        # 1.4: New Unique Visitor. Register them.
-                        visitor_id = database.register_new_visitor(db_conn, embedding)
-                        if visitor_id:
-                            self._log_system_event(f"AUTO-REGISTER: New unique visitor detected: {visitor_id}")
-                        else:
-                            continue # Failed to register, skip
-                    else:
-                        self._log_system_event(f"RE-ID: Recognized returning visitor {visitor_id} (Sim: {sim:.2f})")
-
-                    # 1.5: Add this new track_id to our active state
-                    self.active_tracks[track_id] = {
-                        'visitor_id': visitor_id,
-                        'last_crop': crop_img
-                    }
-
-                if visitor_id:
-                    current_visitor_ids_in_frame.add(visitor_id)
-                    # Always update the last_crop image for this active track
-                    self.active_tracks[track_id]['last_crop'] = crop_img
+                    resolved_visitors.append(track.visitor)
+
+        # Forget scheduling state of unidentified tracks that left the frame
+        self.scheduler.retain(current_track_ids | self.pending_identity.keys())
+
+        if self.identity_pool is not None:
+            # Pending tracks that vanished before being submitted are dropped;
+            # submitted ones are kept until their result arrives.
+            for track_id in [t for t, p in self.pending_identity.items()
+                             if not p.submitted and t not in current_track_ids]:
+                self.pending_identity.pop(track_id)
+            self._submit_identities()
 
 
         # --- LOOP 2: Handle Entry/Re-appearance Logic ---
-        for visitor_id in current_visitor_ids_in_frame:
-            # 2.1: If this person was in the 'pending_exit' buffer,
-            #      they just re-appeared. Cancel their exit.
-            if visitor_id in self.pending_exit:
-                self.pending_exit.pop(visitor_id)
-
-            # 2.2: If this person is not in the 'logged_entry' set,
-            #      it's their first appearance this visit. Log ENTRY.
-            if visitor_id not in self.logged_entry_this_visit:
-                # Find their crop image (must be in active_tracks)
-                crop_to_log = None
-                for track_data in self.active_tracks.values():
-                    if track_data['visitor_id'] == visitor_id:
-                        crop_to_log = track_data['last_crop']
-                        break
-                
-                if crop_to_log is not None:
-                    img_path = self._save_cropped_face(crop_to_log, visitor_id, 'entry')
-                    if img_path:
-                        database.log_event(db_conn, visitor_id, 'entry', img_path)
-                        self._log_system_event(f"EVENT: 'ENTRY' logged for {visitor_id}")
-                        self.logged_entry_this_visit.add(visitor_id)
+        self._log_entries(db_conn, seen_visitors + resolved_visitors)
 
 
         # --- LOOP 3: Handle Disappearances (Start Exit Timer) ---
-        lost_track_ids = set(self.active_tracks.keys()) - current_track_ids
+        lost_tracks = [t for t in self.active_tracks.values() if t.last_frame != frame_no]
         
-        for track_id in lost_track_ids:
-            track_data = self.active_tracks.pop(track_id)
-            visitor_id = track_data['visitor_id']
-            last_crop = track_data['last_crop']
+        for track in lost_tracks:
+            del self.active_tracks[track.track_id]
+            visitor = track.visitor
+            visitor.tracks.discard(track)
             
             # Is this visitor *still* in the frame under a *different* track_id?
-            is_still_visible = visitor_id in current_visitor_ids_in_frame
-            
-            if not is_still_visible:
+            if visitor.last_frame != frame_no:
                 # This visitor is truly gone. Start their exit timer.
-                self.pending_exit[visitor_id] = {
-                    'timestamp': time.time(),
-                    'last_crop': last_crop
-                }
+                self._start_exit(visitor, track.track_id, self._now)
+
+        # Release crops of unidentified tracks that are gone
+        self.crops.prune(lambda key: isinstance(key, tuple) or key in current_track_ids
+                         or key in self.active_tracks or key in self.pending_identity or key in self.samples)
                 
         # --- LOOP 4: Process Final Exits (Check Timeout Buffer) ---
-        current_time = time.time()
+        self._process_exits(db_conn)
+
+    def _start_exit(self, visitor, track_id, timestamp):
+        # Re-inserted so pending_exit stays ordered by exit time
+        self.pending_exit.pop(visitor.visitor_id, None)
+        visitor.exit_started = timestamp
+        # The lost track's crop becomes the visitor's exit image
+        self.crops.rename(track_id, ('exit', visitor.visitor_id))
+        self.pending_exit[visitor.visitor_id] = visitor
+
+    def _log_entries(self, db_conn, visitors):
+        """
+        Logs an 'entry' for every VisitorRecord in `visitors` that has not
+        been logged this visit, stamped with the time their track first appeared.
+        """
+        for visitor in visitors:
+            # 2.1: If this person was in the 'pending_exit' buffer,
+            #      they just re-appeared. Cancel their exit.
+            if visitor.exit_started is not None:
+                self.pending_exit.pop(visitor.visitor_id, None)
+                visitor.exit_started = None
+                self.crops.pop(('exit', visitor.visitor_id))
+
+            # 2.2: If this person has no entry this visit, it's their
+            #      first appearance. Log ENTRY with one of their tracks
+            #      (reverse index, no scan over active_tracks).
+            if not visitor.entry_logged and visitor.tracks:
+                entry_track = next(iter(visitor.tracks))
+                crop = self.crops.get(entry_track.track_id)
+                img_path = self._save_cropped_face(crop, visitor.visitor_id, 'entry') if crop is not None else None
+                # A crop evicted by the memory budget (or dropped by the image
+                # writer's queue) still gets its event, without an image
+                if img_path or crop is None or self.image_writer is not None:
+                    self._log_event(db_conn, visitor.visitor_id, 'entry', img_path,
+                                    timestamp=entry_track.first_seen)
+                    self._log_system_event(f"EVENT: 'ENTRY' logged for {visitor.visitor_id}")
+                    visitor.entry_logged = True
+                    self.current_occupancy += 1
+
+    def _process_exits(self, db_conn, force=False):
+        """
+        Logs an 'exit' for every pending visitor whose exit_timeout has
+        expired (or for all of them when force=True).
+        """
+        current_time = self._now
         
-        # Use list() to allow modifying dict during iteration
-        for visitor_id, exit_data in list(self.pending_exit.items()):
-            time_disappeared = current_time - exit_data['timestamp']
+        # pending_exit is ordered by exit time, so stop at the first visitor
+        # whose timeout hasn't expired yet
+        while self.pending_exit:
+            visitor = next(iter(self.pending_exit.values()))
+            time_disappeared = current_time - visitor.exit_started
+            if not force and time_disappeared <= self.exit_timeout:
+                break
+
+            # 4.1: Timeout exceeded. Log 'EXIT'.
+            crop = self.crops.pop(('exit', visitor.visitor_id))
+            img_path = self._save_cropped_face(crop, visitor.visitor_id, 'exit') if crop is not None else None
             
-            if time_disappeared > self.exit_timeout:
-                # 4.1: Timeout exceeded. Log 'EXIT'.
-                last_crop = exit_data['last_crop']
-                img_path = self._save_cropped_face(last_crop, visitor_id, 'exit')
-                
-                if img_path:
-                    database.log_event(db_conn, visitor_id, 'exit', img_path)
-                    self._log_system_event(f"EVENT: 'EXIT' logged for {visitor_id} (disappeared for {time_disappeared:.2f}s)")
-                
-                # 4.2: Remove from pending AND from logged_entry_this_visit
-                #      This "resets" them, allowing a new 'entry' log
-                #      if they return later.
-                self.pending_exit.pop(visitor_id)
-                if visitor_id in self.logged_entry_this_visit:
-                    self.logged_entry_this_visit.remove(visitor_id)
\ No newline at end of file
+            if img_path or crop is None or self.image_writer is not None:
+                self._log_event(db_conn, visitor.visitor_id, 'exit', img_path,
+                                timestamp=self.clock.to_datetime(current_time))
+                self._log_system_event(f"EVENT: 'EXIT' logged for {visitor.visitor_id} (disappeared for {time_disappeared:.2f}s)")
+            
+            # 4.2: Remove from pending and reset entry_logged. This "resets"
+            #      them, allowing a new 'entry' log if they return later.
+            del self.pending_exit[visitor.visitor_id]
+            visitor.exit_started = None
+            if visitor.entry_logged:
+                visitor.entry_logged = False
+                self.current_occupancy = max(0, self.current_occupancy - 1)
+            if not visitor.tracks:
+                self.visitors.pop(visitor.visitor_id, None)
+
+    def end_of_stream(self, db_conn):
+        """
+        Closes every open visit, e.g. when a video file ends. Active tracks
+        are moved to pending_exit and all pending exits are logged right
+        away instead of waiting for exit_timeout.
+        """
+        if self.identity_pool is not None:
+            # Let in-flight identities land first so their entries are logged
+            self._submit_identities()
+            concurrent.futures.wait([f for f, _ in self._identity_futures])
+            self._log_entries(db_conn, self._collect_identities(db_conn))
+
+        # Tracks still collecting samples are committed with what they have
+        committed = [self._commit_buffered(db_conn, track_id) for track_id in self.samples.track_ids()]
+        self._log_entries(db_conn, [track.visitor for track in committed if track is not None])
+        if self._lookup_futures:
+            concurrent.futures.wait([entry[0] for entry in self._lookup_futures])
+            self._log_entries(db_conn, self._collect_lookups(db_conn))
+        self.pending_identity.clear()
+
+        now = self._now
+        for track in self.active_tracks.values():
+            track.visitor.tracks.discard(track)
+            self._start_exit(track.visitor, track.track_id, now)
+        self.active_tracks.clear()
+        self._process_exits(db_conn, force=True)
@@ -0,0 +1,91 @@
+import asyncio
+import concurrent.futures
+import datetime
+import os
+import uuid
+
+import pytest
+
+np = pytest.importorskip('numpy')
+import ann_index
+import state_tracker
+
+OLD = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class DoneAsyncDatabase:
+    """database.AsyncDatabase stand-in whose queries finish as soon as they are submitted."""
+    def __init__(self, rows):
+        self.rows = rows
+
+    async def fetch_visitor_embeddings(self, since=None):
+        return self.rows
+
+    def submit(self, coro):
+        future = concurrent.futures.Future()
+        future.set_result(asyncio.run(coro))
+        return future
+
+
+@pytest.fixture
+def gallery():
+    rng = np.random.default_rng(0)
+    return [uuid.uuid4() for _ in range(300)], rng.standard_normal((300, 64)).astype(np.float32)
+
+
+def test_rebuild_switches_segments_without_renaming(tmp_path, gallery):
+    ids, emb = gallery
+    index_dir = str(tmp_path / 'visitors')
+    first = ann_index.IVFIndex.build(index_dir, ids, emb, watermark=datetime.datetime.now(datetime.timezone.utc))
+    other = ann_index.IVFIndex(index_dir)  # another process mapping the same segment
+    added = uuid.uuid4()
+    other.add(added, emb[0] * -1)
+
+    compacted = ann_index.IVFIndex(index_dir).compact()
+    assert compacted.segment_dir != first.segment_dir
+    assert os.path.isdir(first.segment_dir)  # still mapped elsewhere, not renamed
+    assert compacted.meta['count'] == 301
+
+    # Registered in the old segment after the compact: carried over on reopen
+    late = uuid.uuid4()
+    first.add(late, emb[1] * -1)
+    assert first.reopen_if_rebuilt()
+    assert first.segment_dir == compacted.segment_dir
+    assert first.search(emb[7])[0][0] == ids[7]
+    assert late in first._delta_known and added not in first._delta_known
+    assert ann_index.IVFIndex(index_dir)._delta_known == {late}
+
+
+def test_async_gallery_sync_follows_rebuilds(tmp_path, gallery):
+    ids, emb = gallery
+    index_dir = str(tmp_path / 'visitors')
+    now = datetime.datetime.now(datetime.timezone.utc)
+    ann_index.IVFIndex.build(index_dir, ids, emb, watermark=now)
+    running = ann_index.IVFIndex(index_dir)  # a camera process
+    ann_index.IVFIndex(index_dir).compact()
+    ann_index.IVFIndex(index_dir).compact()  # deletes the segment `running` was opened on
+    assert not os.path.isdir(running.segment_dir)
+
+    elsewhere = uuid.uuid4()  # registered by another camera
+    tracker = state_tracker.VisitorTracker(
+        {'entry_log_dir': str(tmp_path / 'entries'), 'gallery_sync_seconds': 0.001},
+        gallery=running, async_db=DoneAsyncDatabase([(elsewhere, emb[2] * -1, now)]))
+    tracker._last_gallery_sync = 0
+    tracker._sync_gallery(None)  # query submitted
+    tracker._sync_gallery(None)  # rows merged
+    assert running.segment_dir == ann_index.current_segment(index_dir)
+    assert running.search(emb[2] * -1)[0][0] == elsewhere
+
+    registered = uuid.uuid4()
+    running.add(registered, emb[3] * -1)
+    assert ann_index.IVFIndex(index_dir)._delta_known == {registered}
+
+
+def test_merge_rows_decides_by_visitor_id(tmp_path, gallery):
+    ids, emb = gallery
+    index = ann_index.IVFIndex.build(str(tmp_path / 'visitors'), ids, emb,
+                                     watermark=datetime.datetime.now(datetime.timezone.utc))
+    committed_late = uuid.uuid4()  # first_seen before the build, committed after it
+    assert index.merge_rows([(committed_late, emb[0] * -1, OLD), (ids[5], emb[5], OLD)]) == 1
+    assert index.search(emb[0] * -1)[0][0] == committed_late
+    assert len(index) == 301
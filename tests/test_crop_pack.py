@@ -0,0 +1,96 @@
+import datetime
+import multiprocessing as mp
+import threading
+
+import crop_pack
+
+DAY = datetime.datetime(2024, 5, 1, 12, 0, 0)
+
+
+def _payload(writer, i):
+    return f"writer{writer}-crop{i}-".encode() * (1 + i % 7)
+
+
+def _write_many(root, writer, count, out=None):
+    pack = crop_pack.CropPackWriter(root)
+    refs = []
+    for i in range(count):
+        ref = pack.reserve(DAY)
+        pack.write(ref, _payload(writer, i))
+        refs.append(ref)
+    pack.close()
+    if out is not None:
+        out.put((writer, refs))
+    return refs
+
+
+def test_ref_round_trip():
+    ref = crop_pack.make_ref('2024-05-01', 42)
+    assert crop_pack.is_pack_ref(ref)
+    assert crop_pack.parse_ref(ref) == ('2024-05-01', 42)
+    assert not crop_pack.is_pack_ref('logs/entries/a.jpg')
+
+
+def test_append_and_read(tmp_path):
+    writer = crop_pack.CropPackWriter(str(tmp_path))
+    refs = [writer.append(f"crop {i}".encode(), DAY) for i in range(5)]
+    writer.close()
+
+    reader = crop_pack.CropPackReader(str(tmp_path))
+    assert [reader.read(ref) for ref in refs] == [f"crop {i}".encode() for i in range(5)]
+    assert reader.refs('2024-05-01') == refs
+    assert reader.days() == ['2024-05-01']
+    reader.close()
+
+
+def test_reserved_slot_reads_as_missing(tmp_path):
+    writer = crop_pack.CropPackWriter(str(tmp_path))
+    pending = writer.reserve(DAY)
+    written = writer.append(b'data', DAY)
+    reader = crop_pack.CropPackReader(str(tmp_path))
+    assert reader.read(pending) is None
+    assert reader.refs('2024-05-01') == [written]
+
+    writer.write(pending, b'late')
+    reader.close()
+    reader = crop_pack.CropPackReader(str(tmp_path))
+    assert reader.read(pending) == b'late'
+    writer.close()
+    reader.close()
+
+
+def test_two_writers_in_threads_share_a_directory(tmp_path):
+    results = {}
+
+    def run(w):
+        results[w] = _write_many(str(tmp_path), w, 200)
+
+    threads = [threading.Thread(target=run, args=(w,)) for w in (0, 1)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert not set(results[0]) & set(results[1])
+    reader = crop_pack.CropPackReader(str(tmp_path))
+    for w, refs in results.items():
+        assert [reader.read(ref) for ref in refs] == [_payload(w, i) for i in range(200)]
+    assert len(reader) == 400
+    reader.close()
+
+
+def test_two_writer_processes_share_a_directory(tmp_path):
+    out = mp.Queue()
+    procs = [mp.Process(target=_write_many, args=(str(tmp_path), w, 100, out)) for w in (0, 1)]
+    for p in procs:
+        p.start()
+    results = dict(out.get(timeout=60) for _ in procs)
+    for p in procs:
+        p.join(timeout=60)
+        assert p.exitcode == 0
+
+    assert not set(results[0]) & set(results[1])
+    reader = crop_pack.CropPackReader(str(tmp_path))
+    for w, refs in results.items():
+        assert [reader.read(ref) for ref in refs] == [_payload(w, i) for i in range(100)]
+    reader.close()
@@ -0,0 +1,54 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('cv2')
+import crop_store
+
+
+def crop(h=40, w=40, value=0):
+    return np.full((h, w, 3), value, dtype=np.uint8)
+
+
+def test_offer_keeps_a_compact_copy_of_the_best_crop():
+    store = crop_store.CropStore(budget_bytes=0, max_side=32)
+    frame = np.zeros((100, 100, 3), dtype=np.uint8)
+    assert store.offer(1, frame[10:74, 10:42], score=5.0)
+    held = store.get(1)
+    assert held.shape == (32, 16, 3)  # longer side scaled down to max_side
+    assert not np.shares_memory(held, frame)
+
+    small = frame[0:20, 0:20]
+    assert not store.offer(1, small, score=4.0)  # worse: ignored
+    assert store.offer(1, small, score=6.0)
+    assert store.get(1).shape == (20, 20, 3)
+    assert not np.shares_memory(store.get(1), frame)  # copied even when not resized
+    assert store.resident_bytes == 20 * 20 * 3
+    assert store.copies == 2
+    assert not store.offer(2, frame[0:0, 0:10], score=9.0)
+
+
+def test_budget_evicts_the_lowest_scores():
+    one = 40 * 40 * 3
+    store = crop_store.CropStore(budget_bytes=3 * one, max_side=160)
+    for key, score in ((1, 3.0), (2, 1.0), (3, 2.0)):
+        assert store.offer(key, crop(), score)
+    assert store.offer(4, crop(), 4.0)
+    assert 2 not in store and len(store) == 3
+    assert store.resident_bytes == 3 * one
+    assert not store.offer(5, crop(), 0.5)  # stored, then evicted straight away
+    assert 5 not in store
+    assert store.stats()['evictions'] == 2
+
+
+def test_rename_pop_and_prune_keep_the_byte_count():
+    store = crop_store.CropStore(budget_bytes=0)
+    store.offer(1, crop(value=1), 1.0)
+    store.offer(2, crop(value=2), 1.0)
+    store.offer(('exit', 'v'), crop(20, 20), 1.0)
+    store.rename(1, ('exit', 'v'))
+    assert 1 not in store and store.get(('exit', 'v'))[0, 0, 0] == 1
+    assert store.resident_bytes == 2 * 40 * 40 * 3
+    store.prune(lambda key: isinstance(key, tuple))
+    assert len(store) == 1
+    assert store.pop(('exit', 'v')) is not None and store.pop(('exit', 'v')) is None
+    assert store.resident_bytes == 0
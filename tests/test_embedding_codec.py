@@ -0,0 +1,70 @@
+import datetime
+import struct
+import uuid
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('psycopg')
+import embedding_codec
+
+T0 = datetime.datetime(2026, 3, 1, 12, 0, tzinfo=datetime.timezone.utc)
+
+
+def copy_stream(rows, storage):
+    """Binary COPY output of `SELECT visitor_id, embedding, inserted_at`; inserted_at may be None."""
+    parts = [embedding_codec.PGCOPY_HEADER]
+    for visitor_id, embedding, inserted_at in rows:
+        value = embedding_codec.encode(embedding, storage)
+        parts.append(struct.pack('>hi16si', 3, 16, visitor_id.bytes, len(value)) + value)
+        if inserted_at is None:
+            parts.append(struct.pack('>i', -1))
+        else:
+            parts.append(struct.pack('>iq', 8, embedding_codec._pg_timestamp(inserted_at)))
+    parts.append(embedding_codec.PGCOPY_TRAILER)
+    return b''.join(parts)
+
+
+def test_single_values_round_trip():
+    embedding = np.random.default_rng(0).standard_normal(512).astype(np.float32)
+    assert np.array_equal(embedding_codec.decode_bytea(embedding_codec.encode_bytea(embedding)), embedding)
+    assert np.array_equal(embedding_codec.decode_vector(embedding_codec.encode_vector(embedding)), embedding)
+    assert len(embedding_codec.encode_vector(embedding)) == 4 + 512 * 4
+    assert np.allclose(embedding_codec.decode_vector_text(b'[0.5,-1,2.25]'), [0.5, -1.0, 2.25])
+
+
+@pytest.mark.parametrize('storage', ['vector', 'bytea'])
+def test_matrix_reader_parses_chunked_copy_streams(storage):
+    rng = np.random.default_rng(0)
+    ids = [uuid.uuid4() for _ in range(5)]
+    embeddings = rng.standard_normal((5, 512)).astype(np.float32)
+    stamps = [T0, None, T0 + datetime.timedelta(seconds=90), T0, T0 - datetime.timedelta(days=1)]
+    stream = copy_stream(zip(ids, embeddings, stamps), storage)
+
+    reader = embedding_codec.EmbeddingMatrixReader(storage=storage, dim=512, capacity=1)  # grows
+    for start in range(0, len(stream), 7):  # chunk borders fall inside headers and values
+        reader.feed(stream[start:start + 7])
+    got_ids, matrix, newest = reader.result()
+    assert got_ids == ids
+    assert matrix.dtype == np.float32 and np.array_equal(matrix, embeddings)
+    assert newest == T0 + datetime.timedelta(seconds=90)
+
+
+def test_matrix_reader_rejects_other_streams():
+    with pytest.raises(ValueError):
+        embedding_codec.EmbeddingMatrixReader().feed(b'id,embedding\n' + b'0' * 32)
+
+
+def test_pack_visitor_rows_layout():
+    visitor_id = uuid.uuid4()
+    embedding = np.arange(4, dtype=np.float32)
+    payload = embedding_codec.pack_visitor_rows([(visitor_id, embedding, T0)], storage='bytea')
+    assert payload.startswith(embedding_codec.PGCOPY_HEADER)
+    assert payload.endswith(embedding_codec.PGCOPY_TRAILER)
+    row = payload[len(embedding_codec.PGCOPY_HEADER):-2]
+    nfields, id_len, raw_id, emb_len = struct.unpack_from('>hi16si', row)
+    assert (nfields, id_len, uuid.UUID(bytes=raw_id), emb_len) == (4, 16, visitor_id, 16)
+    assert np.array_equal(np.frombuffer(row, dtype='<f4', count=4, offset=26), embedding)
+    first_seen, last_seen = struct.unpack_from('>iqiq', row, 42)[1::2]
+    assert first_seen == last_seen
+    assert embedding_codec._from_pg_timestamp(first_seen) == T0
@@ -0,0 +1,70 @@
+import datetime
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('cv2')
+import embedding_scheduler
+
+NOW_DT = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def face(size=(100, 100), seed=0):
+    """A sharp (noisy) crop."""
+    return np.random.default_rng(seed).integers(0, 255, size + (3,), dtype=np.uint8)
+
+
+def test_crop_quality_factors():
+    sharp = embedding_scheduler.crop_quality(face())
+    assert sharp == pytest.approx(1.0)
+    assert embedding_scheduler.crop_quality(face((30, 30))) == 0.0  # under min_face_size
+    assert embedding_scheduler.crop_quality(face((48, 48))) == pytest.approx(0.5)
+    assert embedding_scheduler.crop_quality(np.full((100, 100, 3), 128, dtype=np.uint8)) == 0.0  # no detail
+    assert embedding_scheduler.crop_quality(face((100, 200))) < sharp  # wide box
+    assert embedding_scheduler.crop_quality(face(), confidence=0.5) == pytest.approx(0.5 * sharp)
+    assert embedding_scheduler.crop_quality(None) == 0.0
+
+
+def test_select_gates_quality_and_caps_best_first():
+    scheduler = embedding_scheduler.EmbeddingScheduler({'embed_min_quality': 0.3, 'embed_max_per_frame': 2})
+    candidates = [(1, face(), None, 0.4), (2, face((30, 30)), None, 0.9), (3, face(), None, 0.9),
+                  (4, face(), None, 0.6), (5, face(), None, 0.2)]
+    chosen = scheduler.select(candidates, 0.0, NOW_DT)
+    assert [c[0] for c in chosen] == [3, 4]
+    assert chosen[0][3] == pytest.approx(0.9)
+    stats = scheduler.stats()
+    assert (stats['skipped_quality'], stats['skipped_cap'], stats['attempted']) == (2, 1, 2)
+    assert scheduler.select(candidates, 0.0, NOW_DT, limit=0) == []
+    assert [c[0] for c in scheduler.select(candidates, 0.0, NOW_DT, limit=1)] == [3]
+
+
+def test_failures_back_off_exponentially():
+    scheduler = embedding_scheduler.EmbeddingScheduler({'embed_retry_base_seconds': 0.25,
+                                                        'embed_retry_max_seconds': 1.0})
+    candidate = [(7, face(), None, 0.9)]
+    now = 0.0
+    for wait in (0.25, 0.5, 1.0, 1.0):
+        assert scheduler.select(candidate, now, NOW_DT)
+        scheduler.record_failure(7, now)
+        assert not scheduler.select(candidate, now + wait - 0.01, NOW_DT)
+        now += wait
+    assert scheduler.select(candidate, now, NOW_DT)
+    assert scheduler.stats()['skipped_backoff'] == 4
+
+    # A success resets the backoff; the next sample waits embed_sample_interval_seconds
+    scheduler.record_success(7, now)
+    assert not scheduler.select(candidate, now + 0.05, NOW_DT)
+    assert scheduler.select(candidate, now + 0.1, NOW_DT)
+    scheduler.record_failure(7, now + 0.1)
+    assert scheduler.select(candidate, now + 0.35, NOW_DT)
+
+
+def test_first_seen_and_forgetting_tracks():
+    scheduler = embedding_scheduler.EmbeddingScheduler({})
+    later = NOW_DT + datetime.timedelta(seconds=5)
+    scheduler.select([(1, face(), None, 0.9), (2, face(), None, 0.9)], 0.0, NOW_DT)
+    assert scheduler.first_seen(1, later) == NOW_DT
+    scheduler.retain({2})
+    assert scheduler.first_seen(1, later) == later  # gone and back: a new track
+    scheduler.finish(2)
+    assert scheduler.stats()['waiting_tracks'] == 1
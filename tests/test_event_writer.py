@@ -0,0 +1,123 @@
+import contextlib
+import datetime
+import uuid
+
+import pytest
+
+np = pytest.importorskip('numpy')
+psycopg = pytest.importorskip('psycopg')
+import database
+import event_writer
+
+
+class FakeConnection:
+    closed = False
+
+    def __init__(self, db):
+        self.db = db
+        self.pending = []
+
+    def commit(self):
+        self.db.rows.extend(self.pending)
+        self.pending = []
+
+    def rollback(self):
+        self.pending = []
+
+
+class FakeDB:
+    """Stands in for the pool and the COPY helpers; `failures` are raised by the next COPYs."""
+    def __init__(self):
+        self.rows = []
+        self.failures = []
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield FakeConnection(self)
+
+    def copy(self, conn, rows):
+        if self.failures:
+            error = self.failures.pop(0)
+            if error is not None:
+                raise error
+        conn.pending.extend(row[0] for row in rows)
+
+    def written_ids(self):
+        return list(self.rows)
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    db = FakeDB()
+    monkeypatch.setattr(database, 'copy_visitors', lambda conn, rows, storage='vector': db.copy(conn, rows))
+    monkeypatch.setattr(database, 'copy_events', lambda conn, rows: db.copy(conn, rows))
+    return db
+
+
+def make_writer(tmp_path, db, **config):
+    config = dict({'event_journal_path': str(tmp_path / 'journal.jsonl'), 'event_flush_seconds': 0.01,
+                   'event_reconnect_seconds': 0.0}, **config)
+    return event_writer.EventWriter(config, pool=db)
+
+
+def queue_rows(writer, n):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    ids = []
+    for _ in range(n):
+        ids.append(writer.register_visitor(np.ones(4, dtype=np.float32)))
+    for visitor_id in ids:
+        writer.log_event(visitor_id, 'entry', None, timestamp=now)
+    return ids
+
+
+def test_batch_is_written_once(tmp_path, fake_db):
+    writer = make_writer(tmp_path, fake_db)
+    ids = queue_rows(writer, 3)
+    assert writer.flush(5)
+    writer.close()
+    assert fake_db.written_ids() == ids + ids
+
+
+def test_outage_during_row_fallback_journals_the_rest(tmp_path, fake_db):
+    writer = make_writer(tmp_path, fake_db, event_batch_size=100)
+    # Batch COPY fails on a bad row, the first row-by-row write succeeds,
+    # then the connection drops.
+    fake_db.failures = [ValueError('bad row'), None, psycopg.OperationalError('server closed')]
+    ids = [uuid.uuid4() for _ in range(3)]
+    now = datetime.datetime.now(datetime.timezone.utc)
+    batch = [('visitor', (vid, np.ones(4, dtype=np.float32), now)) for vid in ids]
+    batch += [('event', (vid, 'entry', None, now)) for vid in ids]
+    writer.close()  # the test drives _write() directly
+
+    writer._write(batch)
+    assert fake_db.written_ids() == ids[:1]
+    journaled = [row[0] for _, row in writer._read_journal()]
+    assert journaled == ids[1:] + ids  # nothing dropped, nothing written twice
+
+    writer._write([])  # connection is back: the journal is replayed
+    assert fake_db.written_ids() == ids + ids
+    assert not (tmp_path / 'journal.jsonl').exists()
+
+
+def test_unwritable_journal_does_not_stop_the_writer(tmp_path, fake_db):
+    # Rows are only written on flush(), so each phase is one batch
+    writer = make_writer(tmp_path, fake_db, event_flush_seconds=60.0,
+                         event_journal_path=str(tmp_path / 'gone' / 'journal.jsonl'))
+    (tmp_path / 'gone').rmdir()
+    fake_db.failures = [psycopg.OperationalError('server closed')]
+    queue_rows(writer, 1)
+    assert writer.flush(5)
+    assert writer._thread.is_alive()
+    assert writer.stats()['rows_dropped'] == 2
+
+    ids = queue_rows(writer, 2)  # the next batch goes through
+    assert writer.flush(5)
+    writer.close()
+    assert fake_db.written_ids() == ids + ids
+
+
+def test_producers_do_not_block_on_a_dead_writer(tmp_path, fake_db):
+    writer = make_writer(tmp_path, fake_db, event_queue_size=2)
+    writer.close()
+    queue_rows(writer, 5)  # would block forever on the full queue before
+    assert writer.stats()['rows_dropped'] == 10
@@ -0,0 +1,68 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('insightface')
+from insightface.utils import face_align
+import face_embedder
+
+
+class FakeRecognition:
+    """ArcFace stand-in: the mean colour of each aligned face, unnormalized."""
+    def __init__(self):
+        self.batches = []
+
+    def get_feat(self, faces):
+        self.batches.append([face.shape for face in faces])
+        feats = np.zeros((len(faces), face_embedder.EMBEDDING_DIM), dtype=np.float32)
+        feats[:, :3] = [face.reshape(-1, 3).mean(axis=0) + 1.0 for face in faces]
+        return feats
+
+
+def embedder(max_batch_size=2):
+    # No model files: only the aligned path around the recognition model
+    fe = face_embedder.FaceEmbedder.__new__(face_embedder.FaceEmbedder)
+    fe.mode = 'aligned'
+    fe.max_batch_size = max_batch_size
+    fe.rec_model = FakeRecognition()
+    fe.app = None
+    return fe
+
+
+def test_align_crop_with_keypoints_warps_to_the_arcface_template():
+    rng = np.random.default_rng(0)
+    face = rng.integers(0, 255, (112, 112, 3), dtype=np.uint8)
+    # A face already at the template position comes back unchanged
+    aligned = face_embedder.FaceEmbedder.align_crop(face, face_align.arcface_dst)
+    assert aligned.shape == (112, 112, 3)
+    assert np.abs(aligned[8:-8, 8:-8].astype(int) - face[8:-8, 8:-8]).mean() < 1.0
+
+    # Twice the size: scaled down onto the template
+    big = np.repeat(np.repeat(face, 2, axis=0), 2, axis=1)
+    aligned = face_embedder.FaceEmbedder.align_crop(big, face_align.arcface_dst * 2)
+    assert np.abs(aligned[8:-8, 8:-8].astype(int) - face[8:-8, 8:-8]).mean() < 20.0
+
+
+def test_align_crop_without_keypoints_pads_to_a_square():
+    crop = np.zeros((60, 30, 3), dtype=np.uint8)
+    crop[:, :, 2] = 200
+    kps = face_align.arcface_dst.copy()
+    kps[3] = 0  # a keypoint the detector missed
+    for points in (None, kps):
+        aligned = face_embedder.FaceEmbedder.align_crop(crop, points)
+        assert aligned.shape == (112, 112, 3)
+        assert (aligned[:, :, 2] == 200).all()  # border replicated, not black
+
+
+def test_get_embeddings_batches_and_normalizes():
+    fe = embedder(max_batch_size=2)
+    rng = np.random.default_rng(0)
+    crops = [rng.integers(0, 255, (h, 50, 3), dtype=np.uint8) for h in (50, 70, 90)]
+    crops.insert(1, np.zeros((0, 10, 3), dtype=np.uint8))
+    embeddings, ok = fe.get_embeddings(crops)
+    assert list(ok) == [True, False, True, True]
+    assert fe.rec_model.batches == [[(112, 112, 3)] * 2, [(112, 112, 3)]]
+    assert embeddings.shape == (4, face_embedder.EMBEDDING_DIM)
+    assert np.allclose(np.linalg.norm(embeddings[ok], axis=1), 1.0)
+    assert not embeddings[1].any()
+    assert fe.get_embedding(crops[1]) is None
+    assert fe.get_embeddings([])[0].shape == (0, face_embedder.EMBEDDING_DIM)
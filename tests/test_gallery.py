@@ -0,0 +1,187 @@
+import contextlib
+import datetime
+import sqlite3
+import time
+import uuid
+
+import pytest
+
+np = pytest.importorskip('numpy')
+import database
+import detection_log
+import gallery
+import media_clock
+import state_tracker
+
+UTC = datetime.timezone.utc
+
+
+class SqliteVisitors:
+    """
+    A Visitors table in sqlite behind the small part of the psycopg
+    connection API that database.fetch_visitor_embeddings uses, so the
+    real sync query runs against real rows.
+    """
+    def __init__(self):
+        self.db = sqlite3.connect(':memory:')
+        self.db.execute("CREATE TABLE Visitors (visitor_id TEXT PRIMARY KEY, embedding BLOB, "
+                        "first_seen TEXT, inserted_at TEXT)")
+
+    def insert(self, visitor_id, embedding, first_seen, inserted_at):
+        self.db.execute("INSERT INTO Visitors VALUES (?, ?, ?, ?)",
+                        (str(visitor_id), np.asarray(embedding, dtype='<f4').tobytes(),
+                         first_seen.isoformat(), inserted_at.isoformat()))
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=()):
+        params = [p.isoformat() if isinstance(p, datetime.datetime) else p for p in params]
+        self._rows = self.db.execute(sql.replace('%s', '?'), params).fetchall()
+
+    def fetchall(self):
+        return [(uuid.UUID(vid), emb, datetime.datetime.fromisoformat(ts)) for vid, emb, ts in self._rows]
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FixedEmbedder:
+    def __init__(self, embedding):
+        self.embedding = embedding
+
+    def get_embeddings(self, crops, kps_list=None):
+        return [self.embedding for _ in crops], [True] * len(crops)
+
+
+class NullConnection:
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class NullPool:
+    @contextlib.contextmanager
+    def connection(self):
+        yield NullConnection()
+
+
+def unit(rng, dim=32):
+    v = rng.standard_normal(dim).astype(np.float32)
+    return v / np.linalg.norm(v)
+
+
+def test_add_and_search_grow_and_dedupe():
+    rng = np.random.default_rng(0)
+    store = gallery.VisitorGallery(dim=32, initial_capacity=2)
+    ids = [uuid.uuid4() for _ in range(5)]
+    embeddings = np.stack([unit(rng) for _ in ids])
+    store.add(ids[0], embeddings[0] * 3.0)  # stored normalized
+    store.add(ids[0], embeddings[1])  # already known: ignored
+    store.add_many(ids, embeddings * 2.0)
+    assert len(store) == 5
+    assert store.matrix.shape == (5, 32)
+    assert np.allclose(np.linalg.norm(store.matrix, axis=1), 1.0, atol=1e-5)
+
+    hits = store.search(embeddings[3], k=3)
+    assert hits[0][0] == ids[3] and hits[0][1] == pytest.approx(1.0, abs=1e-5)
+    assert [sim for _, sim in hits] == sorted([sim for _, sim in hits], reverse=True)
+    assert store.match(-embeddings[3], 0.5) == (None, 0)
+    assert gallery.VisitorGallery(dim=32).search(embeddings[0]) == []
+
+
+def test_merge_keeps_the_newest_watermark():
+    rng = np.random.default_rng(0)
+    t0 = datetime.datetime(2026, 1, 1, tzinfo=UTC)
+    store = gallery.VisitorGallery(dim=32)
+    assert store.sync_cutoff() is None
+    known = uuid.uuid4()
+
+    ids = [known, uuid.uuid4()]
+    assert store.merge_matrix(ids, np.stack([unit(rng), unit(rng)]), newest=t0) == 2
+    assert store.last_seen_watermark == t0
+    # Overlap rows already held, and an older stamp, don't move anything back
+    late = uuid.uuid4()
+    rows = [(known, unit(rng), t0 - datetime.timedelta(seconds=30)), (late, unit(rng), t0 + datetime.timedelta(seconds=1))]
+    assert store.merge_rows(rows) == 1
+    assert store.merge_rows(rows[:1]) == 0
+    assert store.last_seen_watermark == t0 + datetime.timedelta(seconds=1)
+    assert store.merge_matrix([], np.zeros((0, 32), dtype=np.float32), newest=t0) == 0
+    assert store.last_seen_watermark == t0 + datetime.timedelta(seconds=1)
+    assert store.sync_cutoff() == store.last_seen_watermark - gallery.VisitorGallery.SYNC_OVERLAP
+    assert store.merge_rows([]) == 0
+
+
+def test_sync_picks_up_rows_committed_with_an_old_first_seen():
+    rng = np.random.default_rng(0)
+    table = SqliteVisitors()
+    now = datetime.datetime(2026, 1, 1, 12, 0, tzinfo=UTC)
+    known = uuid.uuid4()
+    table.insert(known, unit(rng), now, now)
+
+    store = gallery.VisitorGallery(dim=32)
+    assert store.merge_rows(database.fetch_visitor_embeddings(table, since=store.sync_cutoff())) == 1
+    assert store.sync_cutoff() == now - gallery.VisitorGallery.SYNC_OVERLAP
+
+    # Registered during an outage an hour ago, replayed from the journal now:
+    # first_seen is far below the cutoff, inserted_at is not.
+    replayed = uuid.uuid4()
+    embedding = unit(rng)
+    table.insert(replayed, embedding, now - datetime.timedelta(hours=1), now + datetime.timedelta(seconds=5))
+    assert store.merge_rows(database.fetch_visitor_embeddings(table, since=store.sync_cutoff())) == 1
+    assert store.match(embedding, 0.9)[0] == replayed
+    assert store.last_seen_watermark == now + datetime.timedelta(seconds=5)
+
+
+def test_visitor_registered_during_replay_gets_wall_clock_first_seen(tmp_path, monkeypatch):
+    pytest.importorskip('psycopg')
+    import event_writer
+
+    visitors, events = [], []
+    monkeypatch.setattr(database, 'copy_visitors', lambda conn, rows, storage='vector': visitors.extend(rows))
+    monkeypatch.setattr(database, 'copy_events', lambda conn, rows: events.extend(rows))
+    writer = event_writer.EventWriter({'event_journal_path': str(tmp_path / 'journal.jsonl'),
+                                       'event_flush_seconds': 0.01}, pool=NullPool())
+
+    # Footage recorded a year ago, processed now
+    recorded = time.time() - 365 * 86400
+    config = {'entry_log_dir': str(tmp_path / 'entries'), 'image_writer_threads': 0, 'hot_cache_size': 0,
+              'embed_min_quality': 0.0, 'aggregate_samples': 1}
+    tracker = state_tracker.VisitorTracker(config, gallery=gallery.VisitorGallery(dim=512), writer=writer,
+                                           clock=media_clock.MediaClock(start=recorded, fps=25.0))
+    embedding = unit(np.random.default_rng(1), dim=512)
+    frame = np.random.default_rng(2).integers(0, 255, (120, 120, 3), dtype=np.uint8)
+    boxes = detection_log.RecordedBoxes(np.array([1]), np.array([[20, 20, 100, 100]]), np.array([0.9]))
+    before = datetime.datetime.now(UTC)
+    for frame_index in range(3):
+        tracker.clock.advance(frame_index)
+        tracker.update_frame(frame, boxes, FixedEmbedder(embedding), None)
+    tracker.end_of_stream(None)
+    writer.close()
+    after = datetime.datetime.now(UTC)
+
+    (visitor_id, _, first_seen), = visitors
+    assert before <= first_seen <= after
+    assert [row[1] for row in events] == ['entry', 'exit']
+    assert all(row[3] < before - datetime.timedelta(days=300) for row in events)  # media time
+
+    # Another process that synced just before the registration committed
+    table = SqliteVisitors()
+    existing = uuid.uuid4()
+    table.insert(existing, unit(np.random.default_rng(3), dim=512), before, before)
+    elsewhere = gallery.VisitorGallery(dim=512)
+    elsewhere.merge_rows(database.fetch_visitor_embeddings(table, since=elsewhere.sync_cutoff()))
+    table.insert(visitor_id, embedding, first_seen, after)
+    assert elsewhere.merge_rows(database.fetch_visitor_embeddings(table, since=elsewhere.sync_cutoff())) == 1
+    assert elsewhere.match(embedding, 0.9)[0] == visitor_id
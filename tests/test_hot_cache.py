@@ -0,0 +1,65 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+import hot_cache
+
+
+def unit(rng, dim=16):
+    v = rng.standard_normal(dim).astype(np.float32)
+    return v / np.linalg.norm(v)
+
+
+def test_entries_expire_ttl_after_last_seen():
+    rng = np.random.default_rng(0)
+    cache = hot_cache.HotVisitorCache(dim=16, capacity=4, ttl=10.0)
+    a, b = unit(rng), unit(rng)
+    cache.put('a', a * 5.0, now=0.0)
+    cache.put('b', b, now=0.0)
+    assert cache.match(a, 0.99, now=5.0)[0] == 'a'
+    cache.touch('b', now=8.0)
+    assert cache.match(b, 0.99, now=15.0)[0] == 'b'  # seen at 8
+    assert cache.match(a, 0.99, now=15.0) == (None, 0)  # expired at 10
+    assert len(cache) == 1
+    cache.expire(now=18.0)
+    assert len(cache) == 1
+    assert cache.match(b, -1.0, now=18.5) == (None, 0)  # matching doesn't refresh
+    assert len(cache) == 0
+
+
+def test_full_cache_evicts_the_least_recently_seen():
+    rng = np.random.default_rng(0)
+    cache = hot_cache.HotVisitorCache(dim=16, capacity=2, ttl=100.0)
+    a, b, c = unit(rng), unit(rng), unit(rng)
+    cache.put('a', a, now=0.0)
+    cache.put('b', b, now=1.0)
+    cache.touch('a', now=2.0)
+    cache.put('c', c, now=3.0)  # evicts b, seen longest ago
+    assert len(cache) == 2
+    assert cache.match(b, 0.99, now=3.0) == (None, 0)
+    assert cache.match(a, 0.99, now=3.0)[0] == 'a'
+    assert cache.match(c, 0.99, now=3.0)[0] == 'c'
+
+    # Refreshing replaces the embedding in the same slot
+    cache.put('a', b, now=4.0)
+    assert len(cache) == 2
+    assert cache.match(b, 0.99, now=4.0)[0] == 'a'
+    assert cache.match(a, 0.99, now=4.0) == (None, 0)
+
+
+def test_free_slots_never_match():
+    cache = hot_cache.HotVisitorCache(dim=16, capacity=4, ttl=100.0)
+    cache.put('a', np.eye(16, dtype=np.float32)[0], now=0.0)
+    # Orthogonal query: the zero rows of free slots score 0 too, above the threshold
+    visitor_id, sim = cache.match(np.eye(16, dtype=np.float32)[1], -0.5, now=0.0)
+    assert visitor_id == 'a' and sim == pytest.approx(0.0)
+
+
+def test_tier_stats_summary():
+    stats = hot_cache.TierStats()
+    assert stats.summary()['hit_rate'] == 0.0
+    stats.record(True, 0.002)
+    stats.record(False, 0.004)
+    summary = stats.summary()
+    assert (summary['lookups'], summary['hits'], summary['hit_rate']) == (2, 1, 0.5)
+    assert summary['mean_ms'] == pytest.approx(3.0)
+    assert summary['max_ms'] == pytest.approx(4.0)
@@ -0,0 +1,102 @@
+import concurrent.futures
+import concurrent.futures.process
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('insightface')
+import identity_workers
+import state_tracker
+
+
+class StubEmbedder:
+    def get_embeddings(self, crops, kps_list=None):
+        return [np.full(4, float(c.sum()), dtype=np.float32) for c in crops], [True] * len(crops)
+
+
+class InlineExecutor:
+    """Runs each job at submit time."""
+    def submit(self, fn, *args):
+        future = concurrent.futures.Future()
+        future.set_result(fn(*args))
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+
+class DyingExecutor(InlineExecutor):
+    """A worker died: the first job fails, every later submit raises."""
+    def __init__(self):
+        self.dead = False
+
+    def submit(self, fn, *args):
+        if self.dead:
+            raise concurrent.futures.process.BrokenProcessPool("a child process terminated abruptly")
+        self.dead = True
+        future = concurrent.futures.Future()
+        future.set_exception(concurrent.futures.process.BrokenProcessPool("a child process terminated abruptly"))
+        return future
+
+
+@pytest.fixture
+def make_pool(monkeypatch):
+    """IdentityWorkerPool whose executors are taken from `executors` in turn, without spawning processes."""
+    monkeypatch.setattr(identity_workers, '_embedder', StubEmbedder())
+    monkeypatch.setattr(identity_workers, '_init_worker', lambda config: None)
+
+    def make(executors, **config):
+        executors = iter(executors)
+        monkeypatch.setattr(identity_workers.IdentityWorkerPool, '_new_executor', lambda self: next(executors))
+        return identity_workers.IdentityWorkerPool(dict({'embedding_workers': 1}, **config))
+    return make
+
+
+def crops(n):
+    return [np.full((2, 2), i, dtype=np.uint8) for i in range(n)]
+
+
+def test_submit_restarts_a_broken_pool(make_pool):
+    dying = DyingExecutor()
+    dying.dead = True
+    pool = make_pool([dying, InlineExecutor()])
+    [(future, start, stop)] = pool.submit(crops(3), [None] * 3)
+    embeddings, ok, matches = future.result()
+    assert (start, stop) == (0, 3) and all(ok) and matches is None
+    assert [float(e[0]) for e in embeddings] == [0.0, 4.0, 8.0]
+    assert pool.restarts == 1 and not pool.in_process
+
+
+def test_broken_result_restarts_once_per_executor(make_pool):
+    pool = make_pool([DyingExecutor(), InlineExecutor()], embedding_workers=2)
+    submitted = pool.submit(crops(4), [None] * 4)
+    failed, retried = submitted[0][0], submitted[1][0]
+    error = failed.exception()
+    assert isinstance(error, concurrent.futures.process.BrokenProcessPool)
+    assert retried.result()[1] == [True, True]  # submitted after the restart
+    assert pool.restarts == 1
+    pool.failed(failed, error)  # from the executor already replaced
+    assert pool.restarts == 1
+
+
+def test_falls_back_to_in_process_embedding(make_pool):
+    pool = make_pool([DyingExecutor(), DyingExecutor()], embedding_worker_restarts=1)
+    first = pool.submit(crops(1), [None])[0][0]
+    pool.failed(first, first.exception())
+    assert pool.restarts == 1
+    second = pool.submit(crops(1), [None])[0][0]
+    pool.failed(second, second.exception())
+    assert pool.in_process
+    [(future, _, _)] = pool.submit(crops(2), [None] * 2)
+    assert future.result()[1] == [True, True]
+    assert pool.stats()['in_process']
+
+
+def test_tracker_drops_tracks_of_a_broken_pool_and_restarts_it(make_pool, tmp_path):
+    pool = make_pool([DyingExecutor(), InlineExecutor()])
+    tracker = state_tracker.VisitorTracker({'entry_log_dir': str(tmp_path)}, identity_pool=pool)
+    tracker.pending_identity[7] = state_tracker.PendingTrack(None, crops(1)[0], None, 1.0)
+    tracker._submit_identities()
+    assert tracker._collect_identities(None) == []
+    assert 7 not in tracker.pending_identity  # embedded again on its next frame
+    assert pool.restarts == 1
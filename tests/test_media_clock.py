@@ -0,0 +1,75 @@
+import datetime
+import os
+import time
+
+import pytest
+
+import media_clock
+
+
+def test_wall_clock_follows_time():
+    clock = media_clock.WallClock()
+    before = time.time()
+    clock.advance(10, 400.0)
+    assert before <= clock.now() <= time.time()
+
+
+def test_media_clock_uses_position():
+    clock = media_clock.MediaClock(start=1000.0, fps=25.0)
+    clock.advance(0, 0.0)
+    assert clock.now() == 1000.0
+    clock.advance(50, 2000.0)
+    assert clock.now() == 1002.0
+
+
+def test_media_clock_falls_back_to_frame_index():
+    clock = media_clock.MediaClock(start=0.0, fps=20.0)
+    clock.advance(40, 0.0)  # backend reports no position
+    assert clock.now() == 2.0
+    clock = media_clock.MediaClock(start=0.0, fps=10.0, source='frame_index')
+    clock.advance(5, 99999.0)
+    assert clock.now() == 0.5
+
+
+def test_media_clock_never_moves_backwards():
+    clock = media_clock.MediaClock(start=0.0, fps=25.0)
+    clock.advance(100, 4000.0)
+    clock.advance(90, 3600.0)
+    assert clock.now() == 4.0
+    clock.seek(1.0)
+    assert clock.now() == 4.0
+    clock.seek(6.5)
+    assert clock.now() == 6.5
+
+
+def test_unknown_source_rejected():
+    with pytest.raises(ValueError):
+        media_clock.MediaClock(source='pts')
+    with pytest.raises(ValueError):
+        media_clock.for_source({'media_clock': 'pts'}, 0)
+
+
+def test_for_source_auto(tmp_path):
+    video = tmp_path / 'clip.mp4'
+    video.write_bytes(b'')
+    assert type(media_clock.for_source({}, 0)) is media_clock.WallClock
+    assert type(media_clock.for_source({}, 'rtsp://camera/1')) is media_clock.WallClock
+    clock = media_clock.for_source({}, str(video), fps=25.0)
+    assert isinstance(clock, media_clock.MediaClock) and clock.source == 'pos_msec'
+
+
+def test_media_start(tmp_path):
+    video = tmp_path / 'clip.mp4'
+    video.write_bytes(b'')
+    os.utime(video, (5000.0, 5000.0))
+    clock = media_clock.for_source({'media_start': 'file_mtime'}, str(video), fps=25.0, frame_count=250)
+    assert clock.start == 4990.0
+
+    start = '2024-05-01T10:00:00+00:00'
+    clock = media_clock.for_source({'media_start': start}, str(video), fps=25.0)
+    assert clock.start == datetime.datetime.fromisoformat(start).timestamp()
+
+
+def test_to_datetime_is_utc():
+    dt = media_clock.WallClock.to_datetime(0.0)
+    assert dt == datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
@@ -0,0 +1,76 @@
+import urllib.request
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture(autouse=True)
+def clean_metrics():
+    metrics.reset()
+    metrics.configure(True)
+    yield
+    metrics.stop()
+    metrics.configure(False)
+    metrics.reset()
+
+
+def test_disabled_records_nothing():
+    metrics.configure(False)
+    with metrics.timer('detect'):
+        pass
+    metrics.inc('frames')
+    metrics.observe('detect', 0.01)
+    assert metrics.snapshot() == {'stages': {}, 'counters': {}}
+
+
+def test_histogram_quantiles():
+    hist = metrics.LatencyHistogram()
+    for ms in range(1, 101):
+        hist.observe(ms / 1000.0)
+    assert hist.count == 100
+    assert hist.max == pytest.approx(0.1)
+    # Buckets are ~19% wide, so quantiles are within a bucket of the true value
+    assert hist.quantile(0.5) == pytest.approx(0.050, rel=0.2)
+    assert hist.quantile(0.99) == pytest.approx(0.099, rel=0.2)
+    assert hist.quantile(1.0) <= hist.max
+    assert metrics.LatencyHistogram().quantile(0.5) == 0.0
+
+
+def test_buckets_are_cumulative():
+    hist = metrics.LatencyHistogram()
+    for seconds in (1e-6, 0.001, 0.001, 100.0):
+        hist.observe(seconds)
+    buckets = hist.buckets()
+    counts = [n for _, n in buckets]
+    assert counts == sorted(counts)
+    assert buckets[-1] == (float('inf'), 4)
+
+
+def test_snapshot_and_counters():
+    metrics.observe('detect', 0.020)
+    metrics.observe('detect', 0.040)
+    metrics.inc('frames')
+    metrics.inc('faces', 3)
+    snap = metrics.snapshot()
+    assert snap['counters'] == {'frames': 1, 'faces': 3}
+    assert snap['stages']['detect']['count'] == 2
+    assert snap['stages']['detect']['mean_ms'] == pytest.approx(30.0)
+    assert metrics.summary_lines()[-1] == 'counters: faces=3, frames=1'
+
+
+def test_prometheus_label_values_are_escaped():
+    metrics.observe('detect', 0.01)
+    metrics.inc('frames')
+    text = metrics.render_prometheus({'camera': 'C:\\videos\\a "door".mp4\nx'})
+    assert 'camera="C:\\\\videos\\\\a \\"door\\".mp4\\nx"' in text
+    assert 'facetrack_stage_seconds_count{stage="detect",camera="C:\\\\videos' in text
+    assert 'facetrack_frames_total{camera="C:\\\\videos' in text
+
+
+def test_serve_exposes_metrics():
+    metrics.inc('frames', 2)
+    server = metrics.serve(0)  # any free port
+    port = server.server_address[1]
+    body = urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5).read().decode()
+    assert 'facetrack_frames_total 2' in body
@@ -0,0 +1,234 @@
+import random
+import threading
+import time
+
+import pytest
+
+np = pytest.importorskip('numpy')
+import detection_log
+import pipeline
+
+
+def gated_stage(policy, queue_size=2, **kwargs):
+    """Stage whose single worker holds the first item until `gate` is set."""
+    started = threading.Event()
+    gate = threading.Event()
+
+    def fn(item):
+        started.set()
+        gate.wait(5.0)
+        return item
+
+    stage = pipeline.Stage('work', fn, queue_size=queue_size, policy=policy, **kwargs)
+    return stage, started, gate
+
+
+def run(stage, items, started=None):
+    """Chains `stage` to a collecting sink, feeds the first item and waits until it is being worked on."""
+    out = []
+    stages = pipeline.Pipeline([stage, pipeline.Stage('sink', out.append)]).start()
+    stages.put(items[0])
+    if started is not None:
+        assert started.wait(5.0)
+    return stages, out, [stages.put(item) for item in items[1:]]
+
+
+def test_results_keep_input_order_with_several_workers():
+    def fn(item):
+        time.sleep(random.random() * 0.005)
+        return item * 2
+
+    stage = pipeline.Stage('work', fn, workers=4, queue_size=8)
+    stages, out, _ = run(stage, list(range(200)))
+    stages.close()
+    stages.join(5.0)
+    assert out == [i * 2 for i in range(200)]
+    assert stage.stats()['processed'] == 200
+
+
+def test_errors_and_none_results_are_skipped_in_order():
+    def fn(item):
+        if item % 3 == 0:
+            raise RuntimeError("bad frame")
+        return None if item % 3 == 1 else item
+
+    stage = pipeline.Stage('work', fn, workers=3)
+    stages, out, _ = run(stage, list(range(30)))
+    stages.close()
+    stages.join(5.0)
+    assert out == [i for i in range(30) if i % 3 == 2]
+    assert stage.errors == 10
+
+
+def test_drop_newest_discards_incoming_items():
+    stage, started, gate = gated_stage('drop_newest')
+    stages, out, accepted = run(stage, list(range(10)), started)
+    assert accepted == [True, True] + [False] * 7
+    gate.set()
+    stages.close()
+    stages.join(5.0)
+    assert out == [0, 1, 2]
+    assert stage.processed + stage.dropped == 10
+    assert stage.dropped == 7
+
+
+def test_drop_oldest_keeps_the_latest_items():
+    stage, started, gate = gated_stage('drop_oldest')
+    stages, out, accepted = run(stage, list(range(10)), started)
+    assert all(accepted)
+    gate.set()
+    stages.close()
+    stages.join(5.0)
+    assert out == [0, 8, 9]
+    assert stage.processed == 3
+    assert stage.dropped == 7
+
+
+def test_drop_oldest_never_drops_the_end_marker():
+    stage, started, gate = gated_stage('drop_oldest')
+    stages, out, _ = run(stage, [0], started)
+    stages.close()
+    # Late items pushing on a full queue that holds the end marker
+    assert stages.put(1)
+    assert not stages.put(2)
+    gate.set()
+    stages.join(5.0)
+    assert not stages.is_alive()
+    assert out == [0, 1]
+    assert stage.dropped == 1
+
+
+def test_stalled_next_stage_does_not_block_dropping_producers():
+    stage = pipeline.Stage('work', lambda item: item, workers=2, queue_size=2, policy='drop_newest')
+    stalled, started, gate = gated_stage('block', queue_size=1)
+    out = []
+    stages = pipeline.Pipeline([stage, stalled, pipeline.Stage('sink', out.append)]).start()
+    stages.put(0)
+    assert started.wait(5.0)
+
+    feeder = threading.Thread(target=lambda: [stages.put(item) or time.sleep(0.001) for item in range(1, 50)])
+    feeder.start()
+    feeder.join(5.0)
+    stalled_feeder = feeder.is_alive()
+    gate.set()
+    feeder.join(5.0)
+    stages.close()
+    stages.join(5.0)
+    assert not stalled_feeder
+    assert not stages.is_alive()
+    assert out == sorted(out) and out[:2] == [0, 1]
+    assert stage.processed + stage.dropped == 50
+    assert stage.processed == len(out)
+
+
+def test_close_drains_the_queue_and_closes_the_next_stage():
+    stage = pipeline.Stage('work', lambda item: time.sleep(0.002) or item, queue_size=4)
+    stages, out, _ = run(stage, list(range(20)))
+    stages.close()
+    stages.join(5.0)
+    assert not stages.is_alive()
+    assert out == list(range(20))
+    assert stage.stats()['queue_depth'] == 0
+
+
+def test_stop_discards_queued_items():
+    stage, started, gate = gated_stage('block', queue_size=4)
+    stages, out, accepted = run(stage, list(range(4)), started)
+    assert all(accepted)
+    stages.stop()
+    gate.set()
+    stages.join(5.0)
+    assert not stages.is_alive()
+    assert stage.processed == 1
+    assert out == []  # the sink was stopped too
+
+
+def test_degrade_threshold():
+    stage, started, gate = gated_stage('degrade', queue_size=4)
+    assert stage.degrade_at == 2
+    stages, _, _ = run(stage, [0, 1], started)
+    assert not stage.overloaded()
+    stages.put(2)
+    assert stage.overloaded()
+    gate.set()
+    stages.close()
+    stages.join(5.0)
+    assert not stage.overloaded()
+    assert stage.dropped == 0
+
+    stage = pipeline.Stage('work', lambda item: item, queue_size=8, policy='degrade', degrade_at=5)
+    assert stage.degrade_at == 5
+
+
+def test_from_config():
+    config = {'detect_workers': 3, 'pipeline_queue_size': 6, 'pipeline_policy': 'drop_newest',
+              'track_policy': 'degrade', 'pipeline_degrade_at': 3}
+    detect = pipeline.Stage.from_config(config, 'detect', lambda item: item)
+    assert (detect.workers, detect.inbox.maxsize, detect.policy) == (3, 6, 'drop_newest')
+    track = pipeline.Stage.from_config(config, 'track', lambda item: item, workers=1)
+    assert (track.workers, track.policy, track.degrade_at) == (1, 'degrade', 3)
+    with pytest.raises(ValueError):
+        pipeline.Stage.from_config({'pipeline_policy': 'newest'}, 'detect', lambda item: item)
+
+
+class FakeResult:
+    def __init__(self, boxes):
+        self.boxes = boxes
+        self.keypoints = None
+
+
+class OneFaceYOLO:
+    """Detector stand-in: ByteTrack id 1 at the same place in every frame."""
+    def __init__(self, path=None):
+        pass
+
+    def track(self, frame, **kwargs):
+        return [FakeResult(detection_log.RecordedBoxes(np.array([1]), np.array([[8, 8, 56, 56]]), np.array([0.9])))]
+
+
+class FixedEmbedder:
+    def __init__(self, **kwargs):
+        pass
+
+    def get_embeddings(self, crops, kps_list=None):
+        return [np.ones(512, dtype=np.float32) for _ in crops], [True] * len(crops)
+
+
+class FakePool:
+    def close(self):
+        pass
+
+
+def test_run_pipeline_closes_visits_at_end_of_file(tmp_path, monkeypatch):
+    pytest.importorskip('ultralytics')
+    import cv2
+    import database
+    import face_embedder
+    import main
+
+    video = str(tmp_path / 'door.avi')
+    out = cv2.VideoWriter(video, cv2.VideoWriter_fourcc(*'MJPG'), 10.0, (64, 64))
+    rng = np.random.default_rng(0)
+    for _ in range(8):
+        out.write(rng.integers(0, 255, (64, 64, 3), dtype=np.uint8))
+    out.release()
+
+    events = []
+    monkeypatch.setattr(main, 'YOLO', OneFaceYOLO)
+    monkeypatch.setattr(face_embedder, 'FaceEmbedder', FixedEmbedder)
+    monkeypatch.setattr(database, 'get_db_pool', lambda config: FakePool())
+    monkeypatch.setattr(database, 'count_visitors', lambda conn: 0)
+    monkeypatch.setattr(database, 'find_visitor', lambda conn, embedding, threshold: (None, 0))
+    monkeypatch.setattr(database, 'register_new_visitor', lambda conn, embedding: 'visitor-1')
+    monkeypatch.setattr(database, 'log_event',
+                        lambda conn, visitor_id, event_type, path, timestamp=None: events.append((visitor_id, event_type)))
+
+    config = {
+        'yolo_model_path': 'face.pt', 'frame_skip': 1, 'embedding_workers': 0, 'identity_backend': 'sql',
+        'write_behind': False, 'db_async': False, 'image_writer_threads': 0, 'hot_cache_size': 0,
+        'entry_log_dir': str(tmp_path / 'entries'), 'embed_min_quality': 0.0,
+        # The track is still collecting samples and visible when the file ends
+        'aggregate_samples': 50, 'aggregate_window_seconds': 60.0, 'exit_timeout_seconds': 60.0,
+    }
+    main.run_pipeline(config, video, headless=True)
+    assert events == [('visitor-1', 'entry'), ('visitor-1', 'exit')]
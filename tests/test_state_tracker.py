@@ -0,0 +1,178 @@
+import asyncio
+import concurrent.futures
+import uuid
+
+import pytest
+
+np = pytest.importorskip('numpy')
+import detection_log
+import gallery
+import media_clock
+import state_tracker
+
+
+class LookupDatabase:
+    """database.AsyncDatabase stand-in: find_visitor returns `match` and finishes on submit."""
+    def __init__(self, match):
+        self.match = match
+
+    async def find_visitor(self, embedding, threshold):
+        return self.match
+
+    def submit(self, coro):
+        future = concurrent.futures.Future()
+        future.set_result(asyncio.run(coro))
+        return future
+
+
+class RecordingWriter:
+    """event_writer.EventWriter stand-in that keeps the events in a list."""
+    def __init__(self):
+        self.events = []
+
+    def register_visitor(self, embedding, timestamp=None):
+        return uuid.uuid4()
+
+    def log_event(self, visitor_id, event_type, image_path, timestamp=None):
+        self.events.append((visitor_id, event_type))
+
+
+class FixedEmbedder:
+    def __init__(self, embedding):
+        self.embedding = embedding
+
+    def get_embeddings(self, crops, kps_list=None):
+        return [self.embedding for _ in crops], [True] * len(crops)
+
+
+def near(target, sim, rng):
+    """Unit vector with cosine similarity `sim` to the unit vector `target`."""
+    other = rng.standard_normal(target.shape).astype(np.float32)
+    other -= other.dot(target) * target
+    other /= np.linalg.norm(other)
+    return (sim * target + np.sqrt(1 - sim ** 2) * other).astype(np.float32)
+
+
+def make_tracker(tmp_path, **kwargs):
+    config = {'entry_log_dir': str(tmp_path / 'entries'), 'aggregate_samples': 3,
+              'aggregate_window_seconds': 60.0}
+    return state_tracker.VisitorTracker(config, **kwargs)
+
+
+def test_tiers_are_counted_once_per_identification(tmp_path):
+    rng = np.random.default_rng(0)
+    known = uuid.uuid4()
+    stored = near(np.eye(512, dtype=np.float32)[0], 0.0, rng)
+    store = gallery.VisitorGallery(dim=512)
+    store.add(known, stored)
+    tracker = make_tracker(tmp_path, gallery=store)
+
+    # Matches, but not by the early-commit margin: all three samples are searched
+    sample = near(stored, 0.65, rng)
+    assert tracker._add_sample(None, 1, sample, 1.0, 0.0) is None
+    assert tracker._add_sample(None, 1, sample, 1.0, 0.0) is None
+    track = tracker._add_sample(None, 1, sample, 1.0, 0.0)
+    assert track.visitor.visitor_id == known
+    stats = tracker.reid_stats()
+    assert (stats['hot']['lookups'], stats['hot']['hits']) == (1, 0)
+    assert (stats['global']['lookups'], stats['global']['hits']) == (1, 1)
+
+    # The next track of the same visitor is found in the hot tier, well
+    # above the margin: committed on its first sample
+    track = tracker._add_sample(None, 2, sample, 1.0, 0.0)
+    assert track.visitor.visitor_id == known
+    stats = tracker.reid_stats()
+    assert (stats['hot']['lookups'], stats['hot']['hits']) == (2, 1)
+    assert stats['global']['lookups'] == 1
+
+
+def test_async_sql_lookups_are_counted_when_they_resolve(tmp_path):
+    known = uuid.uuid4()
+    tracker = make_tracker(tmp_path, async_db=LookupDatabase((known, 0.9)))
+    sample = near(np.eye(512, dtype=np.float32)[0], 0.0, np.random.default_rng(0))
+    for _ in range(3):
+        assert tracker._add_sample(None, 1, sample, 1.0, 0.0) is None
+    assert 1 in tracker.pending_identity
+    assert tracker.reid_stats()['hot']['lookups'] == 0  # not resolved yet
+
+    assert [v.visitor_id for v in tracker._collect_lookups(None)] == [known]
+    stats = tracker.reid_stats()
+    assert (stats['hot']['lookups'], stats['hot']['hits']) == (1, 0)
+    assert (stats['global']['lookups'], stats['global']['hits']) == (1, 1)
+
+
+class Door:
+    """Feeds a tracker one face (the same person) under the given ByteTrack ids per frame, at 10 fps."""
+    def __init__(self, tmp_path):
+        self.writer = RecordingWriter()
+        config = {'entry_log_dir': str(tmp_path / 'entries'), 'aggregate_samples': 1, 'embed_min_quality': 0.0,
+                  'exit_timeout_seconds': 1.0}
+        self.tracker = state_tracker.VisitorTracker(
+            config, gallery=gallery.VisitorGallery(dim=512), writer=self.writer,
+            clock=media_clock.MediaClock(start=0.0, fps=10.0, source='frame_index'))
+        self.tracker._save_cropped_face = lambda crop, visitor_id, event_type: f"{event_type}.jpg"
+        self.embedder = FixedEmbedder(near(np.eye(512, dtype=np.float32)[0], 0.0, np.random.default_rng(0)))
+        self.frame = np.random.default_rng(1).integers(0, 255, (120, 360, 3), dtype=np.uint8)
+        self.frame_index = 0
+
+    def step(self, *track_ids):
+        xyxy = np.array([[10 + 120 * i, 10, 110 + 120 * i, 110] for i in range(len(track_ids))]).reshape(-1, 4)
+        boxes = detection_log.RecordedBoxes(np.array(track_ids, dtype=int), xyxy, np.full(len(track_ids), 0.9))
+        self.tracker.clock.advance(self.frame_index)
+        self.tracker.update_frame(self.frame, boxes, self.embedder, None)
+        self.frame_index += 1
+
+    def visitor(self):
+        (visitor,) = self.tracker.visitors.values()
+        return visitor
+
+
+def test_reverse_index_keeps_a_visitor_in_frame_while_any_track_is(tmp_path):
+    door = Door(tmp_path)
+    door.step(1)
+    visitor = door.visitor()
+    assert [t.track_id for t in visitor.tracks] == [1]
+    assert door.tracker.active_tracks[1].visitor is visitor
+
+    # ByteTrack gives the same face a second id (and then drops the first)
+    door.step(1, 2)
+    assert {t.track_id for t in visitor.tracks} == {1, 2}
+    door.step(2)
+    assert [t.track_id for t in visitor.tracks] == [2]
+    assert 1 not in door.tracker.active_tracks
+    assert not door.tracker.pending_exit
+    assert door.writer.events == [(visitor.visitor_id, 'entry')]
+
+    # Gone: the exit waits for exit_timeout, then the record is dropped
+    door.step()
+    assert not visitor.tracks
+    assert door.tracker.pending_exit == {visitor.visitor_id: visitor}
+    for _ in range(12):
+        door.step()
+    assert door.writer.events == [(visitor.visitor_id, 'entry'), (visitor.visitor_id, 'exit')]
+    assert not door.tracker.pending_exit and not door.tracker.visitors
+    assert door.tracker.current_occupancy == 0
+
+
+def test_coming_back_before_the_exit_timeout_continues_the_visit(tmp_path):
+    door = Door(tmp_path)
+    door.step(1)
+    visitor = door.visitor()
+    for _ in range(5):
+        door.step()
+    assert visitor.exit_started is not None
+
+    door.step(7)  # a new track, re-identified as the same visitor
+    assert door.visitor() is visitor
+    assert visitor.exit_started is None and not door.tracker.pending_exit
+    assert [t.track_id for t in visitor.tracks] == [7]
+    assert door.writer.events == [(visitor.visitor_id, 'entry')]
+    assert door.tracker.current_occupancy == 1
+
+
+def test_records_use_slots():
+    visitor = state_tracker.VisitorRecord(uuid.uuid4())
+    track = state_tracker.TrackRecord(1, visitor, None)
+    for record in (visitor, track):
+        with pytest.raises(AttributeError):
+            record.extra = 1
@@ -0,0 +1,86 @@
+import numpy as np
+
+
+class TrackEmbeddingBuffer:
+    """
+    Holds the best K embeddings of every track whose identity is not
+    committed yet, so VisitorTracker can decide on a fused embedding instead
+    of the first crop that happened to embed.
+
+    All samples live in one preallocated (slots, K, dim) float32 array; a
+    track owns one slot until it is released. When a slot is full, a new
+    sample replaces the lowest-quality one if it is better.
+    """
+    def __init__(self, k=3, dim=512, slots=64):
+        self.k = max(1, int(k))
+        self.dim = dim
+        self._embeddings = np.zeros((slots, self.k, dim), dtype=np.float32)
+        self._quality = np.zeros((slots, self.k), dtype=np.float32)
+        self._count = np.zeros(slots, dtype=np.int32)
+        self._slots = {}  # track_id -> slot
+        self._free = list(range(slots - 1, -1, -1))
+        # {track_id: {'started': float, 'first_seen': datetime}}
+        self._meta = {}
+
+    def __contains__(self, track_id):
+        return track_id in self._slots
+
+    def __len__(self):
+        return len(self._slots)
+
+    def track_ids(self):
+        return list(self._slots)
+
+    def _grow(self):
+        slots = self._embeddings.shape[0]
+        self._embeddings = np.concatenate([self._embeddings, np.zeros_like(self._embeddings)])
+        self._quality = np.concatenate([self._quality, np.zeros_like(self._quality)])
+        self._count = np.concatenate([self._count, np.zeros_like(self._count)])
+        self._free.extend(range(2 * slots - 1, slots - 1, -1))
+
+    def add(self, track_id, embedding, quality, first_seen, now):
+        """Stores one sample. Returns the number of samples held for the track."""
+        slot = self._slots.get(track_id)
+        if slot is None:
+            if not self._free:
+                self._grow()
+            slot = self._free.pop()
+            self._slots[track_id] = slot
+            self._count[slot] = 0
+            self._meta[track_id] = {'started': now, 'first_seen': first_seen}
+
+        n = self._count[slot]
+        if n < self.k:
+            pos = n
+            self._count[slot] = n + 1
+        else:
+            pos = int(np.argmin(self._quality[slot]))
+            if quality <= self._quality[slot, pos]:
+                return self.k
+        self._embeddings[slot, pos] = embedding
+        self._quality[slot, pos] = quality
+        return int(self._count[slot])
+
+    def fused(self, track_id):
+        """Quality-weighted mean of the track's samples, L2-normalized."""
+        slot = self._slots[track_id]
+        n = self._count[slot]
+        weights = self._quality[slot, :n]
+        if weights.sum() <= 0:
+            weights = np.ones(n, dtype=np.float32)
+        fused = weights @ self._embeddings[slot, :n]
+        norm = np.linalg.norm(fused)
+        return fused / norm if norm > 0 else fused
+
+    def age(self, track_id, now):
+        """Seconds since the track's first sample."""
+        return now - self._meta[track_id]['started']
+
+    def first_seen(self, track_id):
+        return self._meta[track_id]['first_seen']
+
+    def release(self, track_id):
+        slot = self._slots.pop(track_id, None)
+        if slot is not None:
+            self._free.append(slot)
+            self._meta.pop(track_id, None)
@@ -0,0 +1,151 @@
+import os
+import queue
+import threading
+import time
+import cv2
+
+import metrics
+
+
+class ThreadedCapture:
+    """
+    Decodes a cv2.VideoCapture source on its own thread into a bounded queue,
+    so that slow detection/embedding/DB work never stalls the decoder.
+
+    Policies:
+      'drop_oldest' - when the queue is full the oldest frame is discarded.
+                      Use for live sources (webcam / RTSP) to keep latency flat.
+      'block'       - the reader waits for room in the queue. Use for files,
+                      where every frame must be seen.
+      'auto'        - 'block' for existing files, 'drop_oldest' otherwise.
+
+    Frames that would be skipped by `frame_skip` are advanced with grab()
+    and never decoded. `captured_at` (wall time of decode) lets callers
+    measure how far behind the live stream they are; `pos_msec` is the
+    decoder's position in the media (see media_clock.py).
+    """
+    def __init__(self, source, frame_skip=1, queue_size=4, policy='auto'):
+        self.source = source
+        self.frame_skip = max(1, int(frame_skip))
+        self.policy = self._resolve_policy(source, policy)
+
+        self.cap = cv2.VideoCapture(source)
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS) or 0.0
+        self.frame_count = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+        self.frames = queue.Queue(maxsize=max(1, int(queue_size)))
+        self._stop = threading.Event()
+        self._thread = None
+
+        # Stats (written by the reader thread only)
+        self.frames_grabbed = 0
+        self.frames_decoded = 0
+        self.frames_dropped = 0
+        self._started_at = None
+        self._finished_at = None
+
+    @staticmethod
+    def _resolve_policy(source, policy):
+        if policy in ('drop_oldest', 'block'):
+            return policy
+        if policy != 'auto':
+            raise ValueError(f"Unknown capture policy: {policy}")
+        if isinstance(source, str) and os.path.isfile(source):
+            return 'block'
+        return 'drop_oldest'
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def start(self):
+        """Starts the reader thread. Returns self for chaining."""
+        self._started_at = time.time()
+        self._thread = threading.Thread(target=self._reader, name="capture-reader", daemon=True)
+        self._thread.start()
+        return self
+
+    def _put(self, item):
+        if self.policy == 'block':
+            while not self._stop.is_set():
+                try:
+                    self.frames.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+            return
+
+        # drop_oldest: make room by discarding the stalest frame
+        while True:
+            try:
+                self.frames.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.frames.get_nowait()
+                    self.frames_dropped += 1
+                    metrics.inc('frames_dropped')
+                except queue.Empty:
+                    pass
+
+    def _reader(self):
+        frame_index = 0
+        try:
+            while not self._stop.is_set():
+                # Skipped frames: advance the stream without decoding
+                if frame_index % self.frame_skip != 0:
+                    if not self.cap.grab():
+                        break
+                    self.frames_grabbed += 1
+                    frame_index += 1
+                    continue
+
+                with metrics.timer('decode'):
+                    ret, frame = self.cap.read()
+                if not ret:
+                    break
+                self.frames_grabbed += 1
+                self.frames_decoded += 1
+                self._put((frame_index, time.time(), frame, self.cap.get(cv2.CAP_PROP_POS_MSEC)))
+                frame_index += 1
+        finally:
+            self._finished_at = time.time()
+            # End-of-stream marker. Always delivered, even under drop_oldest.
+            self._put(None)
+
+    def read(self, timeout=None):
+        """
+        Returns (frame_index, captured_at, frame, pos_msec), or None once the stream has ended.
+        Raises queue.Empty if `timeout` elapses first.
+        """
+        return self.frames.get(timeout=timeout)
+
+    def __iter__(self):
+        while True:
+            item = self.read()
+            if item is None:
+                return
+            yield item
+
+    def stats(self):
+        """Returns a dict with decode fps and drop counts."""
+        end = self._finished_at or time.time()
+        elapsed = max(end - (self._started_at or end), 1e-6)
+        return {
+            'policy': self.policy,
+            'frames_grabbed': self.frames_grabbed,
+            'frames_decoded': self.frames_decoded,
+            'frames_dropped': self.frames_dropped,
+            'decode_fps': self.frames_decoded / elapsed,
+            'queue_depth': self.frames.qsize(),
+        }
+
+    def release(self):
+        self._stop.set()
+        # Unblock a reader waiting on a full queue
+        try:
+            while True:
+                self.frames.get_nowait()
+        except queue.Empty:
+            pass
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+        self.cap.release()